@@ -0,0 +1,380 @@
+import time
+import numpy as np
+from scipy import sparse
+from solve import initial_state, find_root, steady_rate, is_stable_root, direct_sol, root_info, oscillatory
+
+#Dormand-Prince 5(4) tableau, same embedded pair used by scipy's RK45
+A = [np.array([]),
+	np.array([1/5]),
+	np.array([3/40, 9/40]),
+	np.array([44/45, -56/15, 32/9]),
+	np.array([19372/6561, -25360/2187, 64448/6561, -212/729]),
+	np.array([9017/3168, -355/33, 46732/5247, 49/176, -5103/18656]),
+	np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84])]
+B_sol = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0])
+E_err = np.array([-71/57600, 0, 71/16695, -71/1920, 17253/339200, -22/525, 1/40])
+
+def stack_models(models):
+	'''
+	Stack the parameters of several models into arrays so that the ODE system can be
+	evaluated for all of them at once
+
+	Args:
+		models: List of Model class instances with the same number of genotypes
+
+	Returns:
+		params: Dictionary with C [n, S], B [n, S, I], M [S^2, S] (dense or sparse) or [n, S^2, S],
+			k [n], mu [n] and the genotype count nS
+	'''
+
+	params = {}
+	params['C'] = np.stack([model.C for model in models])
+	params['B'] = np.stack([model.B for model in models])
+	params['k'] = np.array([model.k for model in models], dtype=float)
+	params['mu'] = np.array([model.mu for model in models], dtype=float)
+	params['nS'] = models[0].S_genotypes
+
+	#Share a single mating matrix when every model uses the same one (the usual raster case),
+	#sparse mating matrices of larger architectures can only be shared
+	if all(model.M is models[0].M for model in models[1:]):
+		params['M'] = models[0].M
+	elif sparse.issparse(models[0].M):
+		raise ValueError('Models with sparse mating matrices must share the same recombination map')
+	elif all(np.array_equal(model.M, models[0].M) for model in models[1:]):
+		params['M'] = models[0].M
+	else:
+		params['M'] = np.stack([model.M for model in models])
+
+	return params
+
+def df_batch(X, params, idx=None):
+	'''
+	Right hand side of the ODE system evaluated for a stack of models
+
+	Args:
+		X: State array [n, S + I]
+		params: Stacked parameters from stack_models
+		idx: Indices of the models corresponding to the rows of X, all models if None
+
+	Returns:
+		dX: Time derivative of the state array [n, S + I]
+	'''
+
+	if idx is None:
+		idx = slice(None)
+
+	C = params['C'][idx]
+	B = params['B'][idx]
+	k = params['k'][idx]
+	mu = params['mu'][idx]
+	M = params['M'] if params['M'].ndim == 2 else params['M'][idx]
+	nS = params['nS']
+
+	#Seperate out uninfected and infected hosts
+	S = X[:, :nS]
+	I = X[:, nS:]
+
+	S_tot = np.sum(S, axis=1)
+	N = S_tot + np.sum(I, axis=1)
+
+	#Get parental pair frequencies and adjust by fecundity costs
+	genotype_freq = S / S_tot[:, None]
+	pair_freq = ((C*genotype_freq)[:, :, None] * genotype_freq[:, None, :]).reshape(X.shape[0], -1)
+
+	if M.ndim == 2:
+		births = pair_freq @ M
+	else:
+		births = np.einsum('np,npk->nk', pair_freq, M)
+
+	dX = np.empty_like(X)
+	dX[:, :nS] = S_tot[:, None]*births - \
+		S*((k*N + mu)[:, None] + np.einsum('nij,nj->ni', B, I)/N[:, None])
+	dX[:, nS:] = I*(np.einsum('nij,ni->nj', B, S)/N[:, None] - mu[:, None])
+
+	return dX
+
+def integrate_batch(params, X_0, t=(0,5000), rtol=1e-3, atol=1e-6, max_iter=1000000,
+	steady_tol=None, window=100, t_max=None, handoff=None, stats=None):
+	'''
+	Integrate a stack of models with an explicit Dormand-Prince 5(4) scheme. Each model
+	keeps its own time and step size, so stiff or slow members do not hold back the rest,
+	but the right hand side is always evaluated for all active members in one call.
+
+	With steady_tol, members are retired as soon as their relative rate of change has stayed
+	below steady_tol for a time window and handoff accepts them, as in get_sol, and members that have
+	not settled by the end of t are integrated on up to t_max.
+
+	Args:
+		params: Stacked parameters from stack_models
+		X_0: Initial conditions [n, S + I]
+		t: Time range to integrate over
+		rtol: Relative tolerance of the local error estimate
+		atol: Absolute tolerance of the local error estimate
+		max_iter: Maximum number of step attempts before giving up
+		steady_tol: Relative rate of change below which a member counts as steady, None to
+			integrate every member over the whole of t
+		window: Time a member has to stay steady before it is retired
+		t_max: End time for members that are still changing at the end of t, the end of t if None
+		handoff: Function of (index, state) deciding whether a steady member can be retired, members
+			that are not accepted are checked again after another window
+		stats: Optional dictionary that is filled with the right hand side evaluations (n_rhs) and
+			step attempts (n_steps) of each member, the wall time until it stopped (wall) and the
+			time it reached (t_end)
+
+	Returns:
+		X: State of each model at the end of its integration [n, S + I]
+		success: Whether each model settled or reached the end of the time range
+		steady: Whether each model was retired early because it settled
+	'''
+
+	X = np.array(X_0, dtype=float)
+	n = X.shape[0]
+	t_0, t_end = t
+	if steady_tol is not None and t_max is not None:
+		t_end = t_max
+
+	start = time.perf_counter()
+	n_rhs = np.ones(n, dtype=int)
+	n_steps = np.zeros(n, dtype=int)
+	wall = np.zeros(n)
+
+	t_cur = np.full(n, float(t_0))
+	t_steady = np.full(n, np.nan)
+	steady = np.zeros(n, dtype=bool)
+	active = np.arange(n)
+
+	#Initial step size from the scale of the initial derivative
+	K_first = df_batch(X, params)
+	scale = atol + rtol*np.abs(X)
+	d_0 = np.sqrt(np.mean((X/scale)**2, axis=1))
+	d_1 = np.sqrt(np.mean((K_first/scale)**2, axis=1))
+	h = np.where((d_0 < 1e-5) | (d_1 < 1e-5), 1e-6, 0.01*d_0/np.maximum(d_1, 1e-300))
+	h = np.minimum(h, t_end - t_0)
+
+	K_last = K_first
+	for _ in range(max_iter):
+		if len(active) == 0:
+			break
+
+		X_a = X[active]
+		h_a = np.minimum(h[active], t_end - t_cur[active])
+
+		#Evaluate the Runge-Kutta stages for every active member at once
+		K = np.empty((7,) + X_a.shape)
+		K[0] = K_last
+		for s in range(1, 7):
+			dX = np.tensordot(A[s], K[:s], axes=(0, 0))
+			K[s] = df_batch(X_a + h_a[:, None]*dX, params, active)
+
+		n_rhs[active] += 6
+		n_steps[active] += 1
+
+		X_new = X_a + h_a[:, None]*np.tensordot(B_sol, K, axes=(0, 0))
+		err = h_a[:, None]*np.tensordot(E_err, K, axes=(0, 0))
+
+		scale = atol + rtol*np.maximum(np.abs(X_a), np.abs(X_new))
+		err_norm = np.sqrt(np.mean((err/scale)**2, axis=1))
+		accept = err_norm <= 1
+
+		#Standard step size controller, without growth after a rejected step
+		with np.errstate(divide='ignore'):
+			factor = np.where(err_norm == 0, 10, 0.9*err_norm**(-1/5))
+		factor = np.clip(factor, 0.2, 10)
+		factor[~accept] = np.minimum(factor[~accept], 1)
+		h[active] = h_a*factor
+
+		X[active[accept]] = X_new[accept]
+		t_cur[active[accept]] += h_a[accept]
+
+		#First same as last, the final stage is the derivative at the accepted point
+		K_next = np.where(accept[:, None], K[6], K[0])
+		running = t_cur[active] < t_end - 1e-12*max(1, abs(t_end))
+
+		#Retire members whose rate of change has stayed small for a whole window
+		if steady_tol is not None:
+			done = active[accept]
+			slow = steady_rate(X_new[accept], K[6][accept]) < steady_tol
+			t_steady[done[~slow]] = np.nan
+			t_steady[done[slow]] = np.where(np.isnan(t_steady[done[slow]]), t_cur[done[slow]], t_steady[done[slow]])
+			for i in active[t_cur[active] - t_steady[active] >= window]:
+				if handoff is None or handoff(i, X[i]):
+					steady[i] = True
+				else:
+					t_steady[i] = t_cur[i]
+			running &= ~steady[active]
+
+		wall[active[~running]] = time.perf_counter() - start
+		active = active[running]
+		K_last = K_next[running]
+
+	wall[active] = time.perf_counter() - start
+	success = steady | (t_cur >= t_end - 1e-12*max(1, abs(t_end)))
+
+	if stats is not None:
+		stats.update({'n_rhs': n_rhs, 'n_steps': n_steps, 'wall': wall, 't_end': t_cur})
+
+	return X, success, steady
+
+def get_sol_batch(models, af_S, af_I, t=(0,5000), init_hosts=400, init_inf=10, steady_tol=3e-4,
+	window=200, t_max=None, rtol=1e-4, atol=1e-7, info=False, X_0=None):
+	'''
+	Compute the equilibria of many models at once, integrating them together as a single
+	stacked system before polishing each with the root finder as in get_sol. Models are
+	retired from the integration once they settle and the root finder reaches a stable
+	equilibrium from their state, as in get_sol.
+
+	A batch takes as long as its slowest member, so unlike get_sol, models that are still
+	changing at the end of t are not extended unless t_max is given. At rtol=1e-3 the drift
+	of the fifth order scheme near a stable equilibrium stays around steady_tol, so most models
+	would never be retired; at the default rtol=1e-4 the drift is well below it, and models
+	settle as early as with get_sol.
+
+	Args:
+		models: List of Model class instances
+		af_S: Initial allele frequencies for each of the three host allele
+		af_I: Initial frequency of the Avir pathogen genotype
+		t: Time range used for initial guess, used so that solution is interior equilibrium
+		init_hosts: Initial susceptible host abundance
+		init_inf: Initial infected host abundance
+		steady_tol: Relative rate of change below which a model counts as steady, None to always
+			integrate over the whole of t
+		window: Time a model has to stay steady before it is retired
+		t_max: End time for models that are still changing at the end of t, the end of t if None
+		rtol: Relative tolerance of the integration
+		atol: Absolute tolerance of the integration
+		info: Return (S, I, eigs, status) tuples with status dictionaries as in get_sol, the
+			wall time of a model being the time until it left the batch plus its final root solve.
+			Models that reached the end of the integration without settling are flagged as
+			reached_t_max, and as cycling if the equilibrium they end near is oscillatory
+		X_0: Initial state of each model [n, S + I], overriding af_S, af_I, init_hosts and init_inf
+
+	Returns:
+		results: List of (S, I, eigs) tuples, one for each model, as returned by get_sol
+	'''
+
+	params = stack_models(models)
+	if X_0 is None:
+		X_0 = np.stack([initial_state(model, af_S, af_I, init_hosts, init_inf) for model in models])
+
+	def make_df(i):
+		return lambda t, x: df_batch(x[None, :], params, [i])[0]
+
+	#Models are only retired once the root finder reaches a stable equilibrium from their state
+	roots = {}
+	root_iter = np.zeros(len(models), dtype=int)
+	def handoff(i, X):
+		eq, eigs = find_root(models[i], X, make_df(i))
+		roots[i] = (eq, eigs)
+		root_iter[i] += eq.nfev
+		return is_stable_root(models[i], eq, X_0[i] > 0)
+
+	stats = {}
+	X, success, steady = integrate_batch(params, X_0, t, rtol=rtol, atol=atol, steady_tol=steady_tol,
+		window=window, t_max=t_max, handoff=handoff, stats=stats)
+
+	results = []
+	for i, model in enumerate(models):
+		start = time.perf_counter()
+		if steady[i]:
+			eq, eigs = roots[i]
+		else:
+			eq, eigs = find_root(model, X[i], make_df(i))
+			root_iter[i] += eq.nfev
+			if not eq.success:
+				print(eq.message)
+
+		S, I = eq.x[:params['nS']], eq.x[params['nS']:]
+		if not info:
+			results.append((S, I, eigs))
+			continue
+
+		reached = bool(success[i] and not steady[i])
+		status = {'t_end': float(stats['t_end'][i]), 'steady': bool(steady[i]), 'reached_t_max': reached,
+			'cycling': reached and oscillatory(eigs), 'n_rhs': int(stats['n_rhs'][i]),
+			'n_steps': int(stats['n_steps'][i]), 'wall': float(stats['wall'][i] + time.perf_counter() - start),
+			**root_info(eq, eigs, make_df(i)), 'root_iter': int(root_iter[i])}
+		results.append((S, I, eigs, status))
+
+	return results
+
+def get_sol_direct(models, af_S, af_I, t=(0,5000), init_hosts=400, init_inf=10, info=False):
+	'''
+	Compute the equilibria of many models with the direct solver, integrating only the models
+	for which it finds no stable equilibrium with get_sol
+
+	Args:
+		models: List of Model class instances
+		af_S: Initial allele frequencies for each of the three host allele
+		af_I: Initial frequency of the Avir pathogen genotype
+		t: Time range used for the models that are integrated
+		init_hosts: Initial susceptible host abundance
+		init_inf: Initial infected host abundance
+		info: Return (S, I, eigs, status) tuples with status dictionaries as in get_sol
+
+	Returns:
+		results: List of (S, I, eigs) tuples, one for each model, as returned by get_sol
+	'''
+
+	#Models without a stable equilibrium are integrated on their own with get_sol, as they are usually few
+	return [direct_sol(model, af_S, af_I, init_hosts, init_inf, info=info, t=t) for model in models]
+
+def get_sol_row(models, af_S, af_I, t=(0,5000), init_hosts=400, init_inf=10, info=False, **options):
+	'''
+	Compute the equilibria along a row of neighbouring models by continuation. The root solve of
+	each model is seeded with the equilibrium of the last model solved before it, and the root is
+	kept only if it is stable within the genotypes present initially (is_stable_root). Seeds that
+	lost any of those genotypes are not used, as the root finder cannot bring a genotype back and
+	would stay on a boundary equilibrium that the genotype can invade. The first model and those
+	whose seeded root is rejected are integrated together with get_sol_batch.
+
+	Args:
+		models: List of Model class instances, ordered along the row
+		af_S: Initial allele frequencies for each of the three host allele
+		af_I: Initial frequency of the Avir pathogen genotype
+		t: Time range used for the models that are integrated
+		init_hosts: Initial susceptible host abundance
+		init_inf: Initial infected host abundance
+		info: Return (S, I, eigs, status) tuples with status dictionaries as in get_sol
+		options: Further settings of get_sol_batch for the models that are integrated, e.g. steady_tol
+
+	Returns:
+		results: List of (S, I, eigs) tuples, one for each model, as returned by get_sol
+	'''
+
+	params = stack_models(models)
+	n_S = params['nS']
+	X_0 = np.stack([initial_state(model, af_S, af_I, init_hosts, init_inf) for model in models])
+	support = X_0 > 0
+
+	def integrate(idx):
+		results = get_sol_batch([models[i] for i in idx], af_S, af_I, t, info=True, X_0=X_0[idx], **options)
+		return dict(zip(idx, results))
+
+	#Seeds have to keep every genotype present initially
+	def seed(X, i):
+		return X if np.all(X[support[i]] > 1e-6*np.sum(X)) else None
+
+	results = integrate([0])
+	X_prev = seed(np.append(*results[0][:2]), 0)
+	failed = []
+	for i in range(1, len(models)):
+		if X_prev is None:
+			failed.append(i)
+			continue
+
+		start = time.perf_counter()
+		df = lambda t, x, i=i: df_batch(x[None, :], params, [i])[0]
+		eq, eigs = find_root(models[i], X_prev, df)
+		if not is_stable_root(models[i], eq, support[i]):
+			failed.append(i)
+			continue
+
+		status = {'t_end': np.nan, 'steady': False, 'reached_t_max': False, 'cycling': False, 'n_rhs': 0,
+			'n_steps': 0, 'wall': time.perf_counter() - start, **root_info(eq, eigs, df)}
+		results[i] = (eq.x[:n_S], eq.x[n_S:], eigs, status)
+		X_prev = seed(eq.x, i)
+
+	if len(failed) > 0:
+		results.update(integrate(failed))
+
+	return [results[i] if info else results[i][:3] for i in range(len(models))]
@@ -0,0 +1,331 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+import numpy as np
+
+from model import Model, build_mating_matrix
+from solve import get_sol, run_sim, initial_state, compiled_df
+from store import RasterStore
+from utilities import load_data
+from executor import make_executor, chunk_tasks, default_workers, backends
+
+'''
+Benchmarks of the solve and raster pipeline. Each benchmark is run at a few sizes and reports
+its wall time (best and mean over repeats, after a warm up run that absorbs e.g. numba
+compilation) and the peak memory allocated during one further run, traced with tracemalloc.
+Results are appended to a JSON lines history together with the commit, host and backend, and
+compared with the last run of the same benchmark on the same host to flag regressions:
+
+	python benchmark.py							#All benchmarks
+	python benchmark.py get_sol load_data		#Selected benchmarks
+	python benchmark.py --quick					#Smallest size of each benchmark only
+'''
+
+#Parameters of the cov_gs scenario, used by all benchmarks
+PARAMS = {'k': 0.001, 'mu': 0.2, 'b': 1, 'beta': 0.5, 'nh': 0.1, 'g': 0.3, 's': 0.9,
+	'rho': [0.05, 0.05], 'c_g': 0.1, 'c_s': 0.2, 'v': 0.2, 'sel': 'soft'}
+S_INIT = [1, 0.1, 0.1]
+I_INIT = 0.9
+
+benchmarks = {}
+
+def register_benchmark(name, sizes, unit=None):
+	'''
+	Register a benchmark. The decorated function does the setup for one size and returns a
+	function of no arguments that runs the benchmarked code once
+
+	Args:
+		name: Name of the benchmark
+		sizes: Sizes the benchmark is run at, smallest first
+		unit: Name of the items processed per run, for benchmarks that report a throughput,
+			in which case the setup returns (run, n_items)
+	'''
+
+	def register(setup):
+		benchmarks[name] = {'setup': setup, 'sizes': sizes, 'unit': unit}
+		return setup
+
+	return register
+
+@register_benchmark('model_init', sizes=[3, 5, 7])
+def bench_model_init(n_loci):
+	#Building a Model, dominated by the mating matrix for larger numbers of loci, which is memoized
+	#and so has to be cleared for every run to be timed
+	def run():
+		build_mating_matrix.cache_clear()
+		return Model(**dict(PARAMS, n_loci=n_loci))
+
+	return run
+
+@register_benchmark('get_sol', sizes=[1])
+def bench_get_sol(size):
+	#A single equilibrium solve of the default cov_gs cell
+	model = Model(**PARAMS)
+	return lambda: get_sol(model, S_INIT, I_INIT)
+
+@register_benchmark('run_sim', sizes=[1000, 10000])
+def bench_run_sim(t_end):
+	#A fixed length simulation returning every solver step
+	model = Model(**PARAMS)
+	X_0 = initial_state(model, S_INIT, I_INIT)
+	return lambda: run_sim(model, X_0[:model.S_genotypes], X_0[model.S_genotypes:], t=(0, t_end))
+
+@register_benchmark('load_data', sizes=[50, 100, 200], unit='cells')
+def bench_load_data(size):
+	#Loading a synthetic size x size raster
+	path = raster_fixture(size)
+	return (lambda: load_data(path, 'c_s', 'c_g')), size**2
+
+@register_benchmark('gen_raster', sizes=[4, 8], unit='cells')
+def bench_gen_raster(size):
+	#Solving a size x size raster with the executor and writing it to a store, as gen_raster does
+	x_vals = np.linspace(0, 0.2, size)
+	y_vals = np.linspace(0, 0.4, size)
+	settings = {'params': PARAMS, 'var_1': 'c_g', 'x_vals': x_vals.tolist(), 'var_2': 'c_s',
+		'y_vals': y_vals.tolist(), 'S_init': S_INIT, 'I_init': I_INIT}
+
+	def run():
+		with tempfile.TemporaryDirectory(prefix='gfg_bench_') as path:
+			store = RasterStore.create(os.path.join(path, 'raster'), 'c_g', x_vals, 'c_s', y_vals,
+				PARAMS, S_INIT, I_INIT)
+
+			options = {'queue_dir': os.path.join(path, 'queue')} if _options['backend'] == 'queue' else {}
+			executor = make_executor(_options['backend'], settings, _options['cores'], **options)
+			try:
+				for i, js, results in executor.map(chunk_tasks(store.pending(), 64)):
+					store.write(i, js, results)
+			finally:
+				executor.close()
+
+	return run, size**2
+
+#Backend and number of workers of the gen_raster benchmark, set from the command line
+_options = {'backend': 'pool', 'cores': default_workers()}
+
+#Raster stores of raster_fixture by size, in a temporary directory removed by clear_fixtures
+_fixtures = {}
+_fixture_dir = []
+
+def raster_fixture(size):
+	'''
+	Synthetic raster store over c_g and c_s, filled with a solved equilibrium perturbed by a few
+	percent in each cell, so that load_data does the same work as on a real raster (all cells
+	are polymorphic for general resistance and need a transitivity slope)
+
+	Args:
+		size: Raster dimension
+
+	Returns:
+		path: Raster filename to pass to load_data
+	'''
+
+	if size in _fixtures:
+		return _fixtures[size]
+
+	model = Model(**PARAMS)
+	S, I, eigs = get_sol(model, S_INIT, I_INIT)
+
+	if len(_fixture_dir) == 0:
+		_fixture_dir.append(tempfile.TemporaryDirectory(prefix='gfg_bench_'))
+	path = os.path.join(_fixture_dir[0].name, 'raster_%d.p' % size)
+	store = RasterStore.create(os.path.splitext(path)[0], 'c_g', np.linspace(0, 0.2, size),
+		'c_s', np.linspace(0, 0.4, size), PARAMS, S_INIT, I_INIT)
+
+	rng = np.random.default_rng(size)
+	store.S[:] = S * rng.uniform(0.97, 1.03, store.S.shape)
+	store.I[:] = I * rng.uniform(0.97, 1.03, store.I.shape)
+	store.eigs[:] = eigs
+	store.done[:] = True
+	for field in store.fields + ('done',):
+		getattr(store, field).flush()
+
+	_fixtures[size] = path
+	return path
+
+def clear_fixtures():
+	#Remove the raster stores of raster_fixture
+	_fixtures.clear()
+	while len(_fixture_dir) > 0:
+		_fixture_dir.pop().cleanup()
+
+def measure(run, repeat=3):
+	'''
+	Time a function and trace its peak memory
+
+	Args:
+		run: Function of no arguments
+		repeat: Number of timed runs
+
+	Returns:
+		result: Dictionary with the warm up, best and mean times in seconds and the peak traced
+			memory in bytes
+	'''
+
+	start = time.perf_counter()
+	run()
+	warmup = time.perf_counter() - start
+
+	times = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		run()
+		times.append(time.perf_counter() - start)
+
+	#Tracing slows allocation heavy code down, so memory is measured on a separate run
+	tracemalloc.start()
+	run()
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+
+	return {'warmup': warmup, 'best': min(times), 'mean': float(np.mean(times)), 'peak_bytes': peak}
+
+def run_benchmarks(names=None, quick=False, repeat=3):
+	'''
+	Run benchmarks at each of their sizes
+
+	Args:
+		names: Benchmarks to run, all if None
+		quick: Only run the smallest size of each benchmark
+		repeat: Number of timed runs of each benchmark
+
+	Returns:
+		results: List of result dictionaries, with the benchmark name and size, the measurements
+			of measure and, for throughput benchmarks, items per second and per core
+	'''
+
+	names = names or list(benchmarks)
+	for name in names:
+		if name not in benchmarks:
+			raise ValueError('Unknown benchmark %s, expected one of %s' % (name, ', '.join(benchmarks)))
+
+	results = []
+	try:
+		for name in names:
+			bench = benchmarks[name]
+			for size in bench['sizes'][:1] if quick else bench['sizes']:
+				run = bench['setup'](size)
+				n_items = None
+				if bench['unit'] is not None:
+					run, n_items = run
+
+				result = dict({'name': name, 'size': size}, **measure(run, repeat))
+				if n_items is not None:
+					result['unit'] = bench['unit']
+					result['rate'] = n_items / result['best']
+					if name == 'gen_raster':
+						workers = 1 if _options['backend'] == 'serial' else _options['cores']
+						result['rate_per_core'] = result['rate'] / workers
+
+				results.append(result)
+				print(format_result(result))
+	finally:
+		clear_fixtures()
+
+	return results
+
+def format_result(result):
+	line = '%-12s %8s  best %9.4fs  mean %9.4fs  warmup %9.4fs  peak %9.1f MB' % (result['name'],
+		result['size'], result['best'], result['mean'], result['warmup'], result['peak_bytes'] / 2**20)
+	if 'rate' in result:
+		line += '  %10.1f %s/s' % (result['rate'], result['unit'])
+	if 'rate_per_core' in result:
+		line += ' (%.1f per core)' % result['rate_per_core']
+	return line
+
+def environment():
+	'''
+	Description of where the benchmarks ran, stored with each entry of the history
+
+	Returns:
+		env: Dictionary with the time, commit, host, Python and NumPy versions and backends
+	'''
+
+	try:
+		commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+			cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+	except OSError:
+		commit = None
+
+	return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'host': socket.gethostname(),
+		'python': sys.version.split()[0], 'numpy': np.__version__,
+		'compiled_df': compiled_df(Model(**PARAMS)) is not None, 'backend': _options['backend'],
+		'cores': _options['cores']}
+
+def load_history(path):
+	if not os.path.exists(path):
+		return []
+	with open(path, 'r') as f:
+		return [json.loads(line) for line in f if line.strip()]
+
+def compare(history, env, results, threshold=1.2):
+	'''
+	Compare results with the last run of the same benchmarks on the same host and backend
+
+	Args:
+		history: Earlier entries of the history
+		env: Environment of the current run
+		results: Results of the current run
+		threshold: Ratio of best times (or peak memory) above which a result counts as a regression
+
+	Returns:
+		regressions: List of (name, size, measure, ratio) tuples
+	'''
+
+	previous = {}
+	for entry in history:
+		if (entry['env']['host'], entry['env']['backend'], entry['env']['cores']) == \
+			(env['host'], env['backend'], env['cores']):
+			for result in entry['results']:
+				previous[(result['name'], result['size'])] = result
+
+	regressions = []
+	for result in results:
+		old = previous.get((result['name'], result['size']))
+		if old is None:
+			continue
+
+		for key in ('best', 'peak_bytes'):
+			ratio = result[key] / max(old[key], 1e-12)
+			if ratio > threshold:
+				regressions.append((result['name'], result['size'], key, ratio))
+
+	return regressions
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Benchmark the solve and raster pipeline')
+	parser.add_argument('names', nargs='*', help='Benchmarks to run (default: all of %s)' % ', '.join(benchmarks))
+	parser.add_argument('--quick', action='store_true', help='Only run the smallest size of each benchmark')
+	parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs')
+	parser.add_argument('--history', default='./benchmarks.jsonl', help='JSON lines file results are appended to')
+	parser.add_argument('--threshold', type=float, default=1.2,
+		help='Slowdown (or memory growth) relative to the last run flagged as a regression')
+	parser.add_argument('--fail-on-regression', action='store_true', help='Exit with status 1 if there are regressions')
+	parser.add_argument('--backend', choices=sorted(backends), default='pool', help='Backend of the gen_raster benchmark')
+	parser.add_argument('--cores', type=int, default=default_workers(), help='Workers of the gen_raster benchmark')
+	args = parser.parse_args(argv)
+
+	_options['backend'] = args.backend
+	_options['cores'] = args.cores
+
+	env = environment()
+	results = run_benchmarks(args.names, args.quick, args.repeat)
+
+	history = load_history(args.history)
+	regressions = compare(history, env, results, args.threshold)
+	for name, size, key, ratio in regressions:
+		print('Regression: %s at size %s, %s is %.2fx the last run' % (name, size, key, ratio))
+
+	with open(args.history, 'a') as f:
+		f.write(json.dumps({'env': env, 'results': results}) + '\n')
+
+	if args.fail_on_regression and len(regressions) > 0:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,254 @@
+import os
+import re
+import sys
+import json
+import glob
+import shutil
+import hashlib
+import argparse
+import subprocess
+import numpy as np
+
+import gen_raster
+from store import RasterStore, store_path, is_store
+from executor import default_workers, backends
+from cache import cache_key, file_hash, solver_code
+
+'''
+Builds the figures, generating the rasters they read on demand. The rasters a figure needs are
+found from the ./data/*.p paths in its script, matched to the filenames of the scenarios in
+rasters.json. A raster is regenerated when it is missing, when its scenario in rasters.json or
+the raster size has changed, or when the solver code has changed since it was computed, and is
+resumed when it is unfinished. A figure is redrawn when its script, the shared plotting code or
+any of its rasters has changed, so after editing one scenario only that raster and the figures
+reading it are rebuilt:
+
+	python build.py					#All figures
+	python build.py fig_2 fig_S1	#Only these figures
+	python build.py --dry-run		#Show what would be rebuilt
+'''
+
+#Files shared by the figure scripts
+PLOT_FILES = ('utilities.py', 'style.py', 'store.py')
+
+#Directory of the plotting code
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+#Record of the figures drawn, and of the inputs they were drawn from
+FIGURE_RECORD = './figures/.build.json'
+
+def figure_scenarios(script, param_sets):
+	'''
+	Scenarios whose rasters a figure script reads
+
+	Args:
+		script: Filename of the figure script
+		param_sets: Scenarios from rasters.json
+
+	Returns:
+		scenarios: Names of the scenarios, in the order the script reads them
+		unknown: Raster filenames read by the script that no scenario produces
+	'''
+
+	with open(script, 'r') as f:
+		paths = re.findall(r'''['"]((?:\./)?data/[\w.-]+\.p)['"]''', f.read())
+
+	filenames = {os.path.normpath(param_set['filename']): name for name, param_set in param_sets.items()}
+
+	scenarios, unknown = [], []
+	for path in paths:
+		name = filenames.get(os.path.normpath(path))
+		if name is None:
+			unknown.append(path)
+		elif name not in scenarios:
+			scenarios.append(name)
+
+	return scenarios, unknown
+
+def build_record(param_set, size, code):
+	#What a raster was computed from, written next to its store once it is complete
+	return {'raster': cache_key('raster', param_set, size), 'code': code, 'size': size}
+
+def write_record(param_set, size, code):
+	with open(os.path.join(store_path(param_set['filename']), 'build.json'), 'w') as f:
+		json.dump(build_record(param_set, size, code), f, indent=4)
+
+def figure_outputs(script):
+	#Files a figure script saves
+	with open(script, 'r') as f:
+		return re.findall(r'''savefig\(\s*['"]([^'"]+)['"]''', f.read())
+
+def load_figure_record():
+	if not os.path.exists(FIGURE_RECORD):
+		return {}
+	with open(FIGURE_RECORD, 'r') as f:
+		return json.load(f)
+
+def raster_status(param_set, size, code):
+	'''
+	Check whether the raster of a scenario is up to date
+
+	Args:
+		param_set: Scenario dictionary from rasters.json
+		size: Raster dimension
+		code: Hash of the solver source, cache.solver_code
+
+	Returns:
+		status: One of 'current', 'missing', 'unfinished', 'stale' (the scenario or size changed)
+			or 'stale code' (the solver code changed)
+	'''
+
+	if not is_store(param_set['filename']):
+		return 'missing'
+
+	path = store_path(param_set['filename'])
+	store = RasterStore(path)
+	record_path = os.path.join(path, 'build.json')
+	expected = build_record(param_set, size, code)
+
+	if os.path.exists(record_path):
+		with open(record_path, 'r') as f:
+			record = json.load(f)
+		if record['code'] != code:
+			return 'stale code'
+		if record['raster'] != expected['raster']:
+			return 'stale'
+		return 'current' if np.all(store.done) else 'unfinished'
+
+	#Stores from before builds were recorded are kept if they match the scenario, as there is no
+	#telling which code computed them
+	x_vals, y_vals = gen_raster.raster_axes(param_set, size)
+	same = store.var_1 == param_set['var_1'] and store.var_2 == param_set['var_2'] and \
+		np.array_equal(store.x_vals, x_vals) and np.array_equal(store.y_vals, y_vals) and \
+		store.params == param_set['params'] and store.meta['S_init'] == param_set['S_init'] and \
+		store.meta['I_init'] == param_set['I_init']
+
+	if not same:
+		return 'stale'
+	return 'current' if np.all(store.done) else 'unfinished'
+
+def build_raster(scenario, param_set, size, code, status, cores=None, backend='pool'):
+	'''
+	Generate or resume the raster of a scenario with gen_raster, and record what it was built from
+
+	Args:
+		scenario: Name of the scenario in rasters.json
+		param_set: Scenario dictionary from rasters.json
+		size: Raster dimension
+		code: Hash of the solver source, cache.solver_code
+		status: Status of the raster from raster_status
+		cores: Number of worker processes
+		backend: Executor backend of gen_raster
+	'''
+
+	path = store_path(param_set['filename'])
+	if status.startswith('stale'):
+		shutil.rmtree(path)
+
+	argv = [scenario, str(size), '--backend', backend]
+	if cores is not None:
+		argv += ['--cores', str(cores)]
+
+	gen_raster.main(argv)
+	write_record(param_set, size, code)
+
+def raster_hashes(scenarios, param_sets, size, code):
+	#Identity of the rasters a figure reads
+	return [build_record(param_sets[name], size, code)['raster'] for name in scenarios]
+
+def draw_figures(scripts, cores=None):
+	'''
+	Run figure scripts, several at a time
+
+	Args:
+		scripts: Filenames of the figure scripts
+		cores: Largest number of scripts run at once
+
+	Returns:
+		failed: Scripts that exited with an error
+	'''
+
+	cores = cores or default_workers()
+	running, failed = [], []
+	queue = list(scripts)
+
+	while len(queue) > 0 or len(running) > 0:
+		while len(queue) > 0 and len(running) < cores:
+			script = queue.pop(0)
+			running.append((script, subprocess.Popen([sys.executable, script])))
+
+		script, proc = running.pop(0)
+		if proc.wait() != 0:
+			failed.append(script)
+
+	return failed
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Build the figures, generating missing or stale rasters first')
+	parser.add_argument('figures', nargs='*', help='Figure scripts or names, e.g. fig_2 (default: all fig_*.py)')
+	parser.add_argument('--size', type=int, default=200, help='Raster dimension')
+	parser.add_argument('--cores', type=int, default=None,
+		help='Number of worker processes (default: GFG_CORES or the number of CPUs)')
+	parser.add_argument('--backend', choices=sorted(backends), default='pool', help='Executor backend of gen_raster')
+	parser.add_argument('--force', action='store_true', help='Redraw the figures even if they are up to date')
+	parser.add_argument('--dry-run', action='store_true', help='Only show what would be rebuilt')
+	args = parser.parse_args(argv)
+
+	with open('rasters.json', 'r') as f:
+		param_sets = json.load(f)
+
+	scripts = [name if name.endswith('.py') else name + '.py' for name in args.figures] or sorted(glob.glob('fig_*.py'))
+	code = solver_code()
+	plot = file_hash([os.path.join(SOURCE_DIR, name) for name in PLOT_FILES])
+
+	#Figures reading rasters that no scenario produces cannot be built
+	needs = {}
+	for script in scripts:
+		scenarios, unknown = figure_scenarios(script, param_sets)
+		if len(unknown) > 0:
+			print('Skipping %s, no scenario in rasters.json produces %s' % (script, ', '.join(unknown)))
+		else:
+			needs[script] = scenarios
+
+	rasters = [name for scenarios in needs.values() for name in scenarios]
+	rasters = sorted(set(rasters), key=rasters.index)
+	status = {name: raster_status(param_sets[name], args.size, code) for name in rasters}
+
+	drawn = load_figure_record()
+
+	#A figure depends on its script, the plotting code, the solvers (for its own simulations) and its rasters
+	figure_hash = {script: cache_key('figure', file_hash([script]), plot, code,
+		raster_hashes(scenarios, param_sets, args.size, code)) for script, scenarios in needs.items()}
+	stale = [script for script in needs if args.force or drawn.get(script) != figure_hash[script] or
+		any(status[name] != 'current' for name in needs[script]) or
+		not all(os.path.exists(output) for output in figure_outputs(script))]
+
+	for name in rasters:
+		print('%-16s %s' % (name, status[name]))
+	print('Figures to draw: %s' % (', '.join(stale) or 'none'))
+
+	if args.dry_run:
+		return
+
+	for name in rasters:
+		if status[name] != 'current':
+			print('Building %s (%s)...' % (name, status[name]))
+			build_raster(name, param_sets[name], args.size, code, status[name], args.cores, args.backend)
+		elif not os.path.exists(os.path.join(store_path(param_sets[name]['filename']), 'build.json')):
+			write_record(param_sets[name], args.size, code)
+
+	failed = draw_figures(stale, args.cores)
+
+	for script in stale:
+		if script not in failed:
+			drawn[script] = figure_hash[script]
+
+	os.makedirs(os.path.dirname(FIGURE_RECORD), exist_ok=True)
+	with open(FIGURE_RECORD, 'w') as f:
+		json.dump(drawn, f, indent=4)
+
+	if len(failed) > 0:
+		raise RuntimeError('Failed to draw %s' % ', '.join(failed))
+
+if __name__ == '__main__':
+	main()
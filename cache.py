@@ -0,0 +1,287 @@
+import os
+import json
+import glob
+import inspect
+import hashlib
+import functools
+import time
+import pickle as pkl
+import numpy as np
+
+from model import Model
+
+'''
+Content addressed cache of simulation results. A result is stored under the hash of a canonical
+description of everything it depends on: the function that computed it, the Model parameters,
+the initial conditions and the time span and solver settings (with defaults filled in), and the
+source of the solvers, so identical solves in different figure scripts or overlapping raster
+scenarios are only run once, and results of older code are never returned. The cache directory
+is bounded in size, evicting the least recently used results first.
+'''
+
+#Bumped whenever the results or their layout change other than through SOLVER_FILES, invalidating old entries
+CACHE_VERSION = 2
+
+#Files whose contents decide the values of the solvers, part of every key
+SOLVER_FILES = ('model.py', 'solve.py', 'batch.py', 'sweep.py', 'executor.py', 'gen_raster.py', 'periodic.py',
+	'store.py', 'refine.py')
+
+#Model attributes that are computed from the parameters rather than set
+DERIVED = ('S_genotypes', 'G', 'C', 'B', 'M')
+
+def canonical(obj):
+	'''
+	Convert an object into a JSON serialisable form that only depends on its value, so that e.g.
+	a list, tuple or array with the same entries, or dictionaries in a different order, hash equal
+
+	Args:
+		obj: Parameters, arrays, dictionaries or lists of these
+
+	Returns:
+		obj: Canonical form of the object
+	'''
+
+	if isinstance(obj, Model):
+		return canonical(model_params(obj))
+	if isinstance(obj, dict):
+		return {str(canonical(key)): canonical(value) for key, value in sorted(obj.items(), key=lambda item: str(item[0]))}
+	if isinstance(obj, (list, tuple, np.ndarray)):
+		return [canonical(x) for x in obj]
+	if isinstance(obj, (bool, np.bool_)) or obj is None or isinstance(obj, str):
+		return obj.item() if isinstance(obj, np.bool_) else obj
+	if isinstance(obj, (int, np.integer)):
+		return int(obj)
+	if isinstance(obj, (float, np.floating)):
+		#Floats are written exactly, and integral floats hash the same as integers
+		return int(obj) if float(obj).is_integer() else float(obj).hex()
+	if callable(obj):
+		return getattr(obj, '__qualname__', repr(obj))
+	if hasattr(obj, '__dict__'):
+		#Other objects, e.g. the reducers of reduce_sim, are described by their class and state
+		return canonical({'class': type(obj).__qualname__, 'state': vars(obj)})
+
+	raise TypeError('Cannot build a cache key from %s' % type(obj).__name__)
+
+def model_params(model):
+	'''
+	Parameters of a Model, i.e. all attributes that are not derived from the others
+
+	Args:
+		model: Model class instance
+
+	Returns:
+		params: Dictionary of parameters
+	'''
+
+	return {key: value for key, value in vars(model).items() if key not in DERIVED}
+
+def file_hash(files):
+	'''
+	Hash of the contents of a set of files
+
+	Args:
+		files: List of filenames
+
+	Returns:
+		digest: Hex digest
+	'''
+
+	h = hashlib.sha256()
+	for path in files:
+		with open(path, 'rb') as f:
+			h.update(os.path.basename(path).encode() + b'\0' + f.read() + b'\0')
+
+	return h.hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def solver_code():
+	#Hash of SOLVER_FILES, read once per process
+	source = os.path.dirname(os.path.abspath(__file__))
+	return file_hash([os.path.join(source, name) for name in SOLVER_FILES])
+
+def cache_key(name, *args):
+	'''
+	Hash of a canonical description of a computation, together with the solver source
+
+	Args:
+		name: Name of the computation
+		*args: Everything the result depends on
+
+	Returns:
+		key: Hex digest
+	'''
+
+	text = json.dumps(canonical([CACHE_VERSION, solver_code(), name, list(args)]), sort_keys=True, separators=(',', ':'))
+	return hashlib.sha256(text.encode()).hexdigest()
+
+class ResultCache:
+	'''
+	Directory of results, one pickle per key. Reading a result updates the modification time of
+	its file, which is used as the last access time for least recently used eviction. Results are
+	written atomically, so several processes can share a cache directory. The sizes and access
+	times of the entries are kept in memory, from a scan of the directory when it is opened and the
+	reads and writes since, so each process evicts among the entries it knows of.
+	'''
+
+	def __init__(self, path='./cache', max_bytes=2**30, low_water=0.9):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.low_water = low_water
+		os.makedirs(path, exist_ok=True)
+
+		#Access time and size of each entry
+		self.index = {}
+		for f in self.entries():
+			try:
+				stat = os.stat(f)
+			except FileNotFoundError:
+				continue
+			self.index[f] = (stat.st_mtime, stat.st_size)
+		self.size = sum(size for _, size in self.index.values())
+
+	def entries(self):
+		return glob.glob(os.path.join(self.path, '*', '*.pkl'))
+
+	def entry_path(self, key):
+		#Entries are spread over subdirectories by the first two characters of their key
+		return os.path.join(self.path, key[:2], key + '.pkl')
+
+	def record(self, path, size):
+		#Add or refresh an entry of the index
+		self.size += size - self.index.get(path, (0, 0))[1]
+		self.index[path] = (time.time(), size)
+
+	def forget(self, path):
+		#Drop an entry from the index, e.g. after another process evicted it
+		if path in self.index:
+			self.size -= self.index.pop(path)[1]
+
+	def get(self, key):
+		'''
+		Look up a result
+
+		Args:
+			key: Key from cache_key
+
+		Returns:
+			hit: Whether the result was found
+			result: The cached result, or None
+		'''
+
+		path = self.entry_path(key)
+
+		try:
+			with open(path, 'rb') as f:
+				result = pkl.load(f)
+				size = f.tell()
+			os.utime(path)
+		except (FileNotFoundError, EOFError, pkl.UnpicklingError):
+			self.forget(path)
+			return False, None
+
+		self.record(path, size)
+		return True, result
+
+	def put(self, key, result):
+		'''
+		Store a result, evicting the least recently used results if the cache grows too large
+
+		Args:
+			key: Key from cache_key
+			result: Picklable result
+		'''
+
+		path = self.entry_path(key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+
+		tmp = '%s.%d.tmp' % (path, os.getpid())
+		with open(tmp, 'wb') as f:
+			pkl.dump(result, f, protocol=pkl.HIGHEST_PROTOCOL)
+			size = f.tell()
+		os.replace(tmp, path)
+		self.record(path, size)
+
+		if self.size > self.max_bytes:
+			self.evict()
+
+	def evict(self):
+		#Remove the least recently used entries until the cache is below its low water mark, so
+		#that the next eviction is only needed after many more writes
+		for f in sorted(self.index, key=lambda f: self.index[f][0]):
+			if self.size <= self.low_water*self.max_bytes:
+				break
+			try:
+				os.remove(f)
+			except FileNotFoundError:
+				pass
+			self.forget(f)
+
+	def clear(self):
+		for f in self.entries():
+			os.remove(f)
+		self.index = {}
+		self.size = 0
+
+	def call(self, func, *args, **kwargs):
+		'''
+		Return the cached result of func(*args, **kwargs), computing and storing it on a miss.
+		Arguments are bound to the signature of func with its defaults filled in, so calls that
+		only differ in whether a default is given explicitly share a result.
+
+		Args:
+			func: Function to call, its arguments must be accepted by canonical
+			*args: Positional arguments of func
+			**kwargs: Keyword arguments of func
+
+		Returns:
+			result: Result of func
+		'''
+
+		bound = inspect.signature(func).bind(*args, **kwargs)
+		bound.apply_defaults()
+		key = cache_key(func.__module__ + '.' + func.__qualname__, bound.arguments)
+
+		hit, result = self.get(key)
+		if not hit:
+			result = func(*args, **kwargs)
+			self.put(key, result)
+
+		return result
+
+def default_cache():
+	'''
+	Cache used by the figure scripts and gen_raster, in ./cache or the directory given by the
+	GFG_CACHE environment variable (set it to an empty string to disable caching), bounded to
+	GFG_CACHE_MB megabytes (1024 by default)
+
+	Returns:
+		cache: ResultCache, or None if caching is disabled
+	'''
+
+	path = os.environ.get('GFG_CACHE', './cache')
+	if path == '':
+		return None
+
+	return ResultCache(path, int(float(os.environ.get('GFG_CACHE_MB', 1024)) * 2**20))
+
+def cached(func, cache=None):
+	'''
+	Wrap a function so that its results are looked up in a cache
+
+	Args:
+		func: Function to wrap, e.g. run_sim or get_sol
+		cache: ResultCache, default_cache() if None
+
+	Returns:
+		func: Function with the same arguments, or func itself if caching is disabled
+	'''
+
+	cache = default_cache() if cache is None else cache
+	if cache is None:
+		return func
+
+	def wrapper(*args, **kwargs):
+		return cache.call(func, *args, **kwargs)
+
+	wrapper.__doc__ = func.__doc__
+	return wrapper
@@ -0,0 +1,726 @@
+import os
+import json
+import argparse
+import numpy as np
+
+from model import Model
+from solve import get_sol, make_df, jacobian, initial_state
+from sweep import set_param
+from utilities import trans_slopes
+from gen_raster import raster_axes
+
+'''
+Numerical continuation of the regime boundaries of a raster scenario, tracing each boundary as
+a curve in the plane of the two rastered parameters instead of locating it cell by cell. A
+boundary is the set of solutions of a defining system (see Boundary) with one more unknown than
+equations, which is followed by pseudo-arclength continuation:
+
+	fold			An equilibrium with a zero eigenvalue, where two equilibria meet
+	transcritical	An equilibrium without some genotypes (e.g. with G lost or fixed) at which the
+					growth rate of the missing genotypes is zero, so that they can just invade
+	hopf			An equilibrium with a pair of imaginary eigenvalues, where it loses stability
+					to oscillations
+	slope			An equilibrium at which the transitivity slope changes sign
+
+Starting points are found by following the equilibrium branch along rows of the raster (again by
+pseudo-arclength continuation, from the solution of get_sol) and watching for changes in the
+unstable eigenvalues, allele loss and the sign of the slope:
+
+	python continuation.py cov_gs --rows 3
+'''
+
+KINDS = ('fold', 'transcritical', 'hopf', 'slope')
+
+def fd_jacobian(f, z, f_z, eps=1e-7, columns=None):
+	#Forward difference Jacobian of f at z, given f_z = f(z), only differencing the given columns
+	#(the others are left at zero) if columns is set
+	J = np.zeros((len(f_z), len(z)))
+	for k in range(len(z)) if columns is None else columns:
+		dz = eps*max(1, abs(z[k]))
+		z_k = z.copy()
+		z_k[k] += dz
+		J[:, k] = (f(z_k) - f_z) / dz
+	return J
+
+def newton(f, z, tol=1e-9, max_iter=10, jac=None):
+	'''
+	Solve a square system with Newton's method
+
+	Args:
+		f: Function of z returning the residual
+		z: Initial guess
+		tol: Size of the last Newton step at which the iteration has converged
+		max_iter: Largest number of iterations
+		jac: Function of z returning the Jacobian of f, forward differences if None
+
+	Returns:
+		z: Solution, or the last iterate
+		converged: Whether the iteration converged
+		n_iter: Number of iterations
+	'''
+
+	for n_iter in range(1, max_iter + 1):
+		f_z = f(z)
+		if not np.all(np.isfinite(f_z)):
+			return z, False, n_iter
+
+		try:
+			J = fd_jacobian(f, z, f_z) if jac is None else jac(z)
+			dz = np.linalg.solve(J, -f_z)
+		except np.linalg.LinAlgError:
+			return z, False, n_iter
+
+		z = z + dz
+		if np.linalg.norm(dz) < tol*max(1, np.linalg.norm(z)):
+			return z, True, n_iter
+
+	return z, False, max_iter
+
+def tangent(f, z, previous=None, jac=None):
+	#Unit tangent of the curve f(z) = 0 at z, the null vector of its Jacobian, oriented along previous
+	t = np.linalg.svd(fd_jacobian(f, z, f(z)) if jac is None else jac(z))[2][-1]
+	if previous is not None and np.dot(t, previous) < 0:
+		t = -t
+	return t
+
+def continue_curve(f, z_0, h=0.02, h_min=1e-4, h_max=0.1, max_points=500, stop=None, update=None,
+	directions=(1, -1), t_0=None, jac=None):
+	'''
+	Trace a curve of solutions of f(z) = 0, with one more unknown than equations, by
+	pseudo-arclength continuation. Each step predicts along the tangent and corrects with Newton's
+	method on the curve and the hyperplane orthogonal to the tangent through the prediction, and
+	the step length grows while Newton converges quickly and is halved when it fails.
+
+	Args:
+		f: Function of z returning the residual
+		z_0: Point on the curve
+		h: Initial step length
+		h_min: Step length below which continuation stops
+		h_max: Largest step length
+		max_points: Largest number of points in each direction
+		stop: Function of z returning True at the last point of the curve, e.g. once it leaves
+			the parameter range, the point is included
+		update: Function of z called at each new point, e.g. to renormalise the defining system,
+			returning the (possibly rescaled) point
+		directions: Directions along the initial tangent to follow the curve in
+		t_0: Initial tangent, giving its orientation
+		jac: Function of z returning the Jacobian of f, forward differences if None
+
+	Returns:
+		points: Points on the curve, in order along it [n, len(z_0)]
+	'''
+
+	t_start = tangent(f, z_0, t_0, jac)
+	branches = []
+	closed = False
+
+	for direction in directions:
+		#The system is renormalised around the starting point for each direction
+		z, t, step = z_0 if update is None else update(z_0), direction*t_start, h
+		branch = []
+
+		while len(branch) < max_points and step >= h_min and not closed:
+			z_pred = z + step*t
+
+			def corrector(w, t=t, z_pred=z_pred):
+				return np.append(f(w), np.dot(t, w - z_pred))
+
+			def corrector_jac(w, t=t):
+				return np.vstack([jac(w), t])
+
+			w, converged, n_iter = newton(corrector, z_pred, jac=None if jac is None else corrector_jac)
+			if not converged or np.linalg.norm(w - z_pred) > step:
+				step /= 2
+				continue
+
+			if update is not None:
+				w = update(w)
+			t = tangent(f, w, t, jac)
+			z = w
+			branch.append(z)
+
+			if stop is not None and stop(z):
+				break
+
+			#A curve that comes back to its starting point is closed, and is not followed backwards
+			if len(branch) > 3 and np.linalg.norm(z - z_0) < step:
+				closed = True
+
+			if n_iter <= 3:
+				step = min(1.5*step, h_max)
+
+		branches.append(branch)
+
+	points = branches[1][::-1] + [z_0] + branches[0] if len(branches) == 2 else [z_0] + branches[0]
+	return np.array(points)
+
+class Boundary:
+	'''
+	Defining system of a boundary in the plane of two parameters. Its unknowns are the abundances
+	of the genotypes in support, the eigenvector of the Jacobian restricted to the genotypes in
+	space (real and imaginary parts and the frequency for a Hopf boundary) and the two parameters,
+	scaled so that the abundances and parameters vary on similar scales.
+
+	Genotypes in space but not in support are held at zero abundance. For a transcritical
+	boundary the equilibrium is then the one without them, and the zero eigenvalue is the growth
+	rate of the genotypes invading it. Genotypes outside space (e.g. the foreign pathogen, or
+	carriers of an allele that is absent initially) are absent throughout and play no part.
+	'''
+
+	def __init__(self, kind, params, var_1, var_2, space, support, scale):
+		if kind not in KINDS:
+			raise ValueError('Unknown boundary %s, expected one of %s' % (kind, ', '.join(KINDS)))
+
+		self.kind = kind
+		self.params = params
+		self.var_1 = var_1
+		self.var_2 = var_2
+		self.space = np.flatnonzero(space)
+		self.support = np.flatnonzero(support)
+		self.n_X = len(space)
+
+		#Scales of the abundances and of the two parameters
+		self.scale = np.asarray(scale, dtype=float)
+
+		#Eigenvector normalisation, c @ v = 1 (and c_2 @ Im(v) = 0 for a Hopf boundary)
+		self.c = None
+		self.c_2 = None
+
+		self.models = {}
+
+	def model(self, p):
+		#Models are reused while only the state changes, e.g. between columns of a Jacobian
+		key = (float(p[0]), float(p[1]))
+		if key not in self.models:
+			if len(self.models) > 16:
+				self.models.clear()
+			model = Model(**set_param(set_param(self.params, self.var_1, key[0]), self.var_2, key[1]))
+			self.models[key] = (model, make_df(model))
+		return self.models[key]
+
+	def pack(self, X, p, v=None, omega=None):
+		'''
+		Build the vector of unknowns
+
+		Args:
+			X: State, host abundances followed by infected abundances
+			p: Values of var_1 and var_2
+			v: Eigenvector over space, complex for a Hopf boundary
+			omega: Imaginary part of the eigenvalue of a Hopf boundary
+
+		Returns:
+			z: Scaled unknowns
+		'''
+
+		parts = [np.asarray(X)[self.support] / self.scale[0]]
+		if self.kind in ('fold', 'transcritical'):
+			parts.append(np.real(v))
+		elif self.kind == 'hopf':
+			parts += [np.real(v), np.imag(v), [omega]]
+		parts.append(np.asarray(p, dtype=float) / self.scale[1:])
+
+		return np.concatenate(parts)
+
+	def unpack(self, z):
+		'''
+		Split a vector of unknowns
+
+		Args:
+			z: Scaled unknowns
+
+		Returns:
+			X: Full state, with genotypes outside support at zero
+			p: Values of var_1 and var_2
+			v: Eigenvector over space (complex for a Hopf boundary), None for a slope boundary
+			omega: Imaginary part of the eigenvalue of a Hopf boundary, None otherwise
+		'''
+
+		n_sup, n_sp = len(self.support), len(self.space)
+
+		X = np.zeros(self.n_X)
+		X[self.support] = z[:n_sup] * self.scale[0]
+		p = z[-2:] * self.scale[1:]
+
+		v, omega = None, None
+		if self.kind in ('fold', 'transcritical'):
+			v = z[n_sup:n_sup + n_sp]
+		elif self.kind == 'hopf':
+			v = z[n_sup:n_sup + n_sp] + 1j*z[n_sup + n_sp:n_sup + 2*n_sp]
+			omega = z[n_sup + 2*n_sp]
+
+		return X, p, v, omega
+
+	def normalise(self, z):
+		'''
+		Rescale the eigenvector of a point and renormalise the system around it, so that the
+		normalisation stays well conditioned as the eigenvector turns along the boundary
+
+		Args:
+			z: Scaled unknowns
+
+		Returns:
+			z: Scaled unknowns with the eigenvector normalised
+		'''
+
+		X, p, v, omega = self.unpack(z)
+		if v is None:
+			return z
+
+		if self.kind == 'hopf':
+			#Rotate the phase so that the real and imaginary parts are orthogonal
+			a, b = np.real(v), np.imag(v)
+			theta = np.arctan2(-2*np.dot(a, b), np.dot(a, a) - np.dot(b, b)) / 2
+			v = v*np.exp(1j*theta)
+			v = v / np.linalg.norm(np.real(v))
+			self.c, self.c_2 = np.real(v), np.real(v)
+		else:
+			v = np.real(v) / np.linalg.norm(v)
+			self.c = v
+
+		return self.pack(X, p, v, omega)
+
+	def residual(self, z):
+		'''
+		Residual of the defining system
+
+		Args:
+			z: Scaled unknowns
+
+		Returns:
+			residual: Equilibrium conditions of the genotypes in support followed by the conditions
+				on the eigenvalue (or the transitivity slope)
+		'''
+
+		X, p, v, omega = self.unpack(z)
+		model, df = self.model(p)
+		F = df(None, X)[self.support] / self.scale[0]
+
+		if self.kind == 'slope':
+			n_S = model.S_genotypes
+			return np.append(F, trans_slopes(model, X[None, :n_S], X[None, n_S:])[0])
+
+		J = jacobian(model, X)[np.ix_(self.space, self.space)]
+		if self.kind == 'hopf':
+			v_r, v_i = np.real(v), np.imag(v)
+			return np.concatenate([F, J @ v_r + omega*v_i, J @ v_i - omega*v_r,
+				[np.dot(self.c, v_r) - 1, np.dot(self.c_2, v_i)]])
+
+		return np.concatenate([F, J @ v, [np.dot(self.c, v) - 1]])
+
+	def equilibrium_jacobian(self, z):
+		'''
+		Jacobian of the equilibrium conditions (the first rows of the residual), exact in the
+		abundances and by forward differences in the parameters
+
+		Args:
+			z: Scaled unknowns
+
+		Returns:
+			J: Jacobian [len(support), len(z)], zero in the eigenvector columns
+		'''
+
+		def equilibrium(w):
+			X, p, _, _ = self.unpack(w)
+			return self.model(p)[1](None, X)[self.support] / self.scale[0]
+
+		J = fd_jacobian(equilibrium, z, equilibrium(z), columns=[len(z) - 2, len(z) - 1])
+
+		#Abundances and equilibrium conditions are scaled alike, so the scaling cancels
+		X, p, _, _ = self.unpack(z)
+		n_sup = len(self.support)
+		J[:, :n_sup] = jacobian(self.model(p)[0], X)[np.ix_(self.support, self.support)]
+
+		return J
+
+	def jacobian(self, z):
+		'''
+		Jacobian of the defining system. The eigenvalue conditions are linear in the eigenvector
+		and frequency, and the equilibrium conditions use the analytic Jacobian of the ODE system,
+		which leaves forward differences for the parameters and for the dependence of the
+		eigenvalue (or slope) conditions on the abundances, which would need second derivatives
+
+		Args:
+			z: Scaled unknowns
+
+		Returns:
+			J: Jacobian [len(residual), len(z)]
+		'''
+
+		X, p, v, omega = self.unpack(z)
+		n_sup, n_sp = len(self.support), len(self.space)
+
+		if self.kind in ('fold', 'transcritical', 'hopf'):
+			#Only the abundance and parameter columns are differenced, the equilibrium rows of the
+			#abundance columns are then replaced by their exact values
+			columns = list(range(n_sup)) + [len(z) - 2, len(z) - 1]
+			J = fd_jacobian(self.residual, z, self.residual(z), columns=columns)
+			J[:n_sup, :n_sup] = self.equilibrium_jacobian(z)[:, :n_sup]
+		else:
+			def slope(w):
+				return self.residual(w)[-1:]
+			return np.vstack([self.equilibrium_jacobian(z), fd_jacobian(slope, z, slope(z))])
+
+		J_s = jacobian(self.model(p)[0], X)[np.ix_(self.space, self.space)]
+		a = n_sup
+		if self.kind == 'hopf':
+			v_r, v_i = np.real(v), np.imag(v)
+			r, i, w = slice(a, a + n_sp), slice(a + n_sp, a + 2*n_sp), a + 2*n_sp
+			J[r, r], J[r, i], J[r, w] = J_s, omega*np.eye(n_sp), v_i
+			J[i, r], J[i, i], J[i, w] = -omega*np.eye(n_sp), J_s, -v_r
+			J[w, r], J[w + 1, i] = self.c, self.c_2
+		else:
+			v_cols = slice(a, a + n_sp)
+			J[v_cols, v_cols] = J_s
+			J[a + n_sp, v_cols] = self.c
+
+		return J
+
+def spectrum(model, X, space):
+	#Eigenvalues and eigenvectors of the Jacobian restricted to space
+	J = jacobian(model, X)[np.ix_(space, space)]
+	return np.linalg.eig(J)
+
+def unstable_counts(model, X, genotypes, eig_tol=1e-8):
+	#Numbers of real and of complex eigenvalues with positive real part, of the Jacobian restricted to genotypes
+	if len(genotypes) == 0:
+		return 0, 0
+	eigs = np.linalg.eigvals(jacobian(model, X)[np.ix_(genotypes, genotypes)])
+	unstable = np.real(eigs) > eig_tol
+	return int(np.sum(unstable & (np.imag(eigs) == 0))), int(np.sum(unstable & (np.imag(eigs) != 0)))
+
+def boundary_guess(boundary, X, p):
+	'''
+	Initial guess for the defining system of a boundary from an approximate point, taking the
+	eigenvector of the eigenvalue closest to zero (or the imaginary axis for a Hopf boundary)
+
+	Args:
+		boundary: Boundary
+		X: Approximate state at the boundary
+		p: Approximate parameter values
+
+	Returns:
+		z: Scaled unknowns, normalised
+	'''
+
+	X = np.where(np.isin(np.arange(len(X)), boundary.support), X, 0)
+	model, _ = boundary.model(p)
+	eigs, vecs = spectrum(model, X, boundary.space)
+
+	v, omega = None, None
+	if boundary.kind in ('fold', 'transcritical'):
+		real = np.abs(np.imag(eigs)) < 1e-12*np.maximum(1, np.abs(eigs))
+		if boundary.kind == 'transcritical':
+			#Only eigenvectors pointing out of the support are growth rates of the missing genotypes
+			outside = ~np.isin(boundary.space, boundary.support)
+			real &= np.linalg.norm(vecs[outside], axis=0) > 1e-3
+		k = np.argmin(np.where(real, np.abs(eigs), np.inf))
+		v = np.real(vecs[:, k])
+	elif boundary.kind == 'hopf':
+		complex_pair = np.imag(eigs) > 0
+		k = np.argmin(np.where(complex_pair, np.abs(np.real(eigs)), np.inf))
+		v, omega = vecs[:, k], np.imag(eigs[k])
+
+	#The eigenvector is rotated and scaled, and the normalisation set from it
+	return boundary.normalise(boundary.pack(X, p, v, omega))
+
+def locate(boundary, z, fixed=1):
+	'''
+	Solve the defining system of a boundary with one parameter held at its value in z
+
+	Args:
+		boundary: Boundary
+		z: Initial guess from boundary_guess
+		fixed: Index of the parameter held fixed, 0 for var_1 and 1 for var_2
+
+	Returns:
+		z: Point on the boundary, None if Newton's method failed
+	'''
+
+	index = len(z) - 2 + fixed
+	value = z[index]
+
+	row = np.zeros(len(z))
+	row[index] = 1
+	z, converged, _ = newton(lambda w: np.append(boundary.residual(w), w[index] - value), z, max_iter=20,
+		jac=lambda w: np.vstack([boundary.jacobian(w), row]))
+	return boundary.normalise(z) if converged else None
+
+def trace(boundary, z, box, h=0.02, max_points=500):
+	'''
+	Trace a boundary through a point on it until it leaves the parameter box in both directions,
+	closes on itself or, for a Hopf boundary, the frequency reaches zero
+
+	Args:
+		boundary: Boundary
+		z: Point on the boundary from locate
+		box: Parameter ranges ((low, high) of var_1, (low, high) of var_2)
+		h: Initial step length, in units of the box size
+		max_points: Largest number of points in each direction
+
+	Returns:
+		curve: Dictionary with the kind of boundary, the genotypes present at its equilibria
+			(support), the values x of var_1 and y of var_2 along it, the states X [n, S + I], and
+			for a Hopf boundary the frequencies omega
+	'''
+
+	def stop(w):
+		X, p, _, omega = boundary.unpack(w)
+		outside = any(p[k] < box[k][0] or p[k] > box[k][1] for k in range(2))
+		return outside or (omega is not None and omega <= 0) or np.min(X) < -1e-6*np.sum(X)
+
+	points = continue_curve(boundary.residual, z, h, max_points=max_points, stop=stop,
+		update=boundary.normalise, jac=boundary.jacobian)
+
+	states = [boundary.unpack(w) for w in points]
+	curve = {'kind': boundary.kind, 'support': boundary.support.tolist(), 'var_1': boundary.var_1,
+		'var_2': boundary.var_2, 'x': [float(p[0]) for _, p, _, _ in states], 'y': [float(p[1]) for _, p, _, _ in states],
+		'X': [X.tolist() for X, _, _, _ in states]}
+	if boundary.kind == 'hopf':
+		curve['omega'] = [float(omega) for _, _, _, omega in states]
+
+	return curve
+
+def lost_genotypes(model, X, space, tol=1e-2):
+	'''
+	Genotypes that vanish when host alleles are lost or fixed, or pathogen genotypes are lost
+
+	Args:
+		model: Model class instance
+		X: State
+		space: Boolean mask of the genotypes considered
+		tol: Frequency below which an allele or pathogen genotype counts as lost
+
+	Returns:
+		lost: Boolean mask of the genotypes that vanish
+	'''
+
+	n_S = model.S_genotypes
+	S, I = np.maximum(X[:n_S], 0), np.maximum(X[n_S:], 0)
+
+	freqs = (S / np.sum(S)) @ model.G
+	lost = np.zeros(len(X), dtype=bool)
+	for locus, freq in enumerate(freqs):
+		if freq < tol:
+			lost[:n_S] |= model.G[:, locus] == 1
+		elif freq > 1 - tol:
+			lost[:n_S] |= model.G[:, locus] == 0
+	lost[n_S:] = I / np.sum(I) < tol
+
+	return lost & space
+
+def follow(params, var_1, var_2, box, x, y, af_S, af_I, h=0.01, eig_tol=1e-8, max_points=1000):
+	'''
+	Follow the equilibrium reached by get_sol at (x, y) along var_1, until the end of the row or
+	the first change in its stability or support, and find the boundaries crossed on the way
+
+	Args:
+		params: Base parameters of the scenario
+		var_1: Parameter varied along the row
+		var_2: Parameter held at y
+		box: Parameter ranges ((start, end) of var_1, (low, high) of var_2)
+		x: Value of var_1 to start from
+		y: Value of var_2
+		af_S: Initial allele frequencies for each host locus
+		af_I: Initial frequency of the Avr pathogen genotype
+		h: Initial step length, in units of the row length
+		eig_tol: Largest real part counted as negative
+		max_points: Largest number of points along the branch
+
+	Returns:
+		events: List of (boundary, z) pairs of a Boundary and a point on it from locate
+		x_end: Value of var_1 where the equilibrium changed stability or support, None if it
+			reached the end of the row
+	'''
+
+	x_range = box[0]
+	model = Model(**set_param(set_param(params, var_1, x), var_2, y))
+	S, I, _ = get_sol(model, af_S, af_I)
+	X_0 = np.append(S, I)
+
+	#Genotypes present initially, and those present at the equilibrium
+	space = initial_state(model, af_S, af_I) > 0
+	support = space & (X_0 > 1e-6*np.sum(X_0))
+
+	#Abundances are scaled by their mean and parameters by their ranges
+	scale = (np.sum(X_0) / len(X_0), abs(box[0][1] - box[0][0]), abs(box[1][1] - box[1][0]))
+	branch = Boundary('slope', params, var_1, var_2, space, support, scale)
+
+	#Genotypes that are missing from the equilibrium but could invade it. Their block of the
+	#Jacobian is decoupled from the support, as there is no mutation, so its eigenvalues are the
+	#growth rates of the missing genotypes and changes in them mark transcritical boundaries
+	outside = np.flatnonzero(space & ~support)
+
+	def point(z):
+		X, p, _, _ = branch.unpack(np.append(z, y / scale[2]))
+		model, df = branch.model(p)
+		return X, p, model, df
+
+	def describe(z):
+		X, p, model, _ = point(z)
+		n_S = model.S_genotypes
+
+		polymorphic = 1e-2 < ((X[:n_S] / np.sum(X[:n_S])) @ model.G)[1] < 1 - 1e-2
+		real, complex_pairs = unstable_counts(model, X, branch.support, eig_tol)
+		return {'X': X, 'p': p, 'real': real, 'complex': complex_pairs,
+			'invading': sum(unstable_counts(model, X, outside, eig_tol)),
+			'slope': trans_slopes(model, X[None, :n_S], X[None, n_S:])[0] if polymorphic else np.nan,
+			'feasible': np.min(X[branch.support]) >= 0}
+
+	#The branch keeps var_2 fixed, its defining system is the equilibrium condition alone
+	def f(z):
+		X, _, _, df = point(z)
+		return df(None, X)[branch.support] / scale[0]
+
+	def f_jac(z):
+		return branch.equilibrium_jacobian(np.append(z, y / scale[2]))[:, :-1]
+
+	#Points are classified as the branch is followed, which stops at the first change in stability
+	#or support, as the equilibrium is then no longer the one the system settles at
+	found = []
+	previous = [describe(branch.pack(X_0, (x, y))[:-1])]
+
+	def stop(z):
+		current = describe(z)
+		last = previous[0]
+		X_mid, p_mid = (last['X'] + current['X']) / 2, (last['p'] + current['p']) / 2
+		previous[0] = current
+
+		if not current['feasible']:
+			#Interpolate to where the first abundance crosses zero, and drop the genotypes lost there
+			X, p = current['X'], current['p']
+			ratio = last['X'] / np.where(X < 0, last['X'] - X, np.inf)
+			w = np.min(ratio[branch.support])
+			X_cross, p_cross = last['X'] + w*(X - last['X']), last['p'] + w*(p - last['p'])
+			model = point(z)[2]
+			lost = lost_genotypes(model, X_cross, space) | (np.abs(X_cross) < 1e-9*np.sum(np.abs(X_cross)))
+			found.append(('transcritical', support & ~lost, X_cross, p_cross))
+			return True
+
+		if np.sign(current['slope']) * np.sign(last['slope']) < 0:
+			found.append(('slope', support, X_mid, p_mid))
+
+		changed = False
+		for kind, key in (('transcritical', 'invading'), ('fold', 'real'), ('hopf', 'complex')):
+			if current[key] != last[key]:
+				found.append((kind, support, X_mid, p_mid))
+				changed = True
+
+		return changed or (current['p'][0] - x_range[1])*np.sign(x_range[1] - x_range[0]) > 0
+
+	direction = np.zeros(len(branch.support) + 1)
+	direction[-1] = np.sign(x_range[1] - x_range[0])
+	z_0 = branch.pack(X_0, (x, y))[:-1]
+	continue_curve(f, z_0, h, max_points=max_points, stop=stop, directions=(1,), t_0=direction, jac=f_jac)
+
+	events = []
+	x_end = None
+	for kind, sub, X_guess, p_guess in found:
+		boundary = Boundary(kind, params, var_1, var_2, space, sub, scale)
+		z = locate(boundary, boundary_guess(boundary, X_guess, p_guess))
+		if z is not None:
+			events.append((boundary, z))
+		if kind != 'slope':
+			x_end = p_guess[0]
+
+	return events, x_end
+
+def scan(params, var_1, var_2, box, y, af_S, af_I, h=0.01, eig_tol=1e-8, restart=0.01):
+	'''
+	Find where a row of the raster crosses boundaries, following the equilibrium the system
+	settles at along var_1. Each time the equilibrium changes stability or support, the row is
+	solved again with get_sol just beyond the change and followed from there
+
+	Args:
+		params: Base parameters of the scenario
+		var_1: Parameter varied along the row
+		var_2: Parameter held at y
+		box: Parameter ranges ((start, end) of var_1, (low, high) of var_2), the row running from
+			the start to the end of var_1
+		y: Value of var_2
+		af_S: Initial allele frequencies for each host locus
+		af_I: Initial frequency of the Avr pathogen genotype
+		h: Initial step length, in units of the row length
+		eig_tol: Largest real part counted as negative
+		restart: Distance beyond a change at which the row is solved again, in units of the row length
+
+	Returns:
+		events: List of (boundary, z) pairs of a Boundary and a point on it from locate
+	'''
+
+	(start, end) = box[0]
+	step = restart*(end - start)
+
+	events = []
+	x = start
+	while (end - x)*np.sign(end - start) > 0:
+		found, x_end = follow(params, var_1, var_2, box, x, y, af_S, af_I, h, eig_tol)
+		events += found
+		if x_end is None:
+			break
+		x = max(x_end, x) + step if end > start else min(x_end, x) + step
+
+	return events
+
+def on_curve(curve, x, y, box, tol=0.02):
+	#Whether (x, y) lies within tol of a traced curve, in units of the box size
+	dx = (np.array(curve['x']) - x) / (box[0][1] - box[0][0])
+	dy = (np.array(curve['y']) - y) / (box[1][1] - box[1][0])
+	return np.min(np.hypot(dx, dy)) < tol
+
+def boundaries(param_set, rows=3, h=0.02):
+	'''
+	Find and trace the boundaries of a raster scenario, scanning a few rows for starting points.
+	Each boundary is traced once, even if several rows cross it
+
+	Args:
+		param_set: Scenario dictionary from rasters.json
+		rows: Number of rows scanned, evenly spaced over the interior of the var_2 range
+		h: Initial step length, in units of the box size
+
+	Returns:
+		curves: List of curves as returned by trace
+	'''
+
+	x_vals, y_vals = raster_axes(param_set, 2)
+	box = ((x_vals[0], x_vals[-1]), (y_vals[0], y_vals[-1]))
+	var_1, var_2 = param_set['var_1'], param_set['var_2']
+
+	curves = []
+	for y in np.linspace(box[1][0], box[1][1], rows + 2)[1:-1]:
+		events = scan(param_set['params'], var_1, var_2, box, y, param_set['S_init'], param_set['I_init'])
+
+		for boundary, z in events:
+			_, p, _, _ = boundary.unpack(z)
+			if any(curve['kind'] == boundary.kind and curve['support'] == boundary.support.tolist() and
+				on_curve(curve, p[0], p[1], box) for curve in curves):
+				continue
+
+			curves.append(trace(boundary, z, box, h))
+
+	return curves
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Trace the regime boundaries of a raster scenario in rasters.json')
+	parser.add_argument('scenario', nargs='?', default='cov_gs', help='Name of raster scenario')
+	parser.add_argument('--rows', type=int, default=3, help='Number of rows scanned for boundaries')
+	parser.add_argument('--step', type=float, default=0.02, help='Initial continuation step, relative to the parameter ranges')
+	parser.add_argument('--output', default=None, help='Output file (default: ./data/boundaries/<scenario>.json)')
+	args = parser.parse_args(argv)
+
+	with open('rasters.json', 'r') as f:
+		param_set = json.load(f)[args.scenario]
+
+	curves = boundaries(param_set, args.rows, args.step)
+
+	output = args.output or os.path.join('./data/boundaries', args.scenario + '.json')
+	os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+	with open(output, 'w') as f:
+		json.dump(curves, f)
+
+	for curve in curves:
+		print('%-13s %4d points, %s from %.4g to %.4g' % (curve['kind'], len(curve['x']), curve['var_1'],
+			min(curve['x']), max(curve['x'])))
+	print('Saved %d boundaries to %s' % (len(curves), output))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,179 @@
+import os
+import json
+import argparse
+import numpy as np
+from scipy.stats import qmc
+from scipy.optimize import OptimizeResult
+
+from model import Model
+from solve import initial_state, is_stable_root
+from batch import get_sol_batch
+from sweep import set_param
+from gen_raster import raster_axes
+
+'''
+Initial condition ensembles, for finding multistability that a single solve from S_init and
+I_init cannot show. Each parameter cell is solved from a set of initial conditions spread over
+allele frequency space (the frequencies of the resistance alleles and of the Avr genotype, drawn
+as a Latin hypercube, with other loci kept at their S_init frequencies), all cells and initial
+conditions being integrated together as one stacked system by get_sol_batch. The equilibria
+each cell reaches are clustered into distinct attractors, and the fraction of initial
+conditions reaching each estimates the size of its basin:
+
+	python ensemble.py cov_gs 20 --n-init 32
+'''
+
+def sample_frequencies(n, af_S, loci=(1, 2), seed=None):
+	'''
+	Initial conditions spread over allele frequency space
+
+	Args:
+		n: Number of initial conditions
+		af_S: Host allele frequencies of the loci that are not sampled
+		loci: Host loci whose allele frequencies are sampled, by default general and specific
+			resistance. Neutral loci, e.g. the linkage modifier when rho[0] == rho[1], have a line
+			of equilibria rather than distinct attractors and are best kept fixed
+		seed: Seed of the Latin hypercube
+
+	Returns:
+		af_S: Host allele frequencies [n, n_loci]
+		af_I: Avr pathogen frequencies [n]
+	'''
+
+	points = qmc.LatinHypercube(d=len(loci) + 1, seed=seed).random(n)
+
+	af = np.tile(np.asarray(af_S, dtype=float), (n, 1))
+	af[:, list(loci)] = points[:, :-1]
+
+	return af, points[:, -1]
+
+def cluster(states, tol=1e-2):
+	'''
+	Group equilibria that are the same attractor reached from different initial conditions. An
+	equilibrium joins the first cluster whose representative is within a relative distance tol,
+	and otherwise starts a new cluster
+
+	Args:
+		states: Equilibrium states [n, S + I]
+		tol: Relative distance below which two equilibria are the same
+
+	Returns:
+		labels: Cluster of each equilibrium [n]
+		reps: Index of the representative equilibrium of each cluster
+	'''
+
+	labels = np.zeros(len(states), dtype=int)
+	reps = []
+	for n, X in enumerate(states):
+		for label, rep in enumerate(reps):
+			scale = max(np.linalg.norm(X), np.linalg.norm(states[rep]), 1)
+			if np.linalg.norm(X - states[rep]) < tol*scale:
+				labels[n] = label
+				break
+		else:
+			labels[n] = len(reps)
+			reps.append(n)
+
+	return labels, reps
+
+def get_sol_ensemble(models, af_S, n_init=32, loci=(1, 2), t=(0,5000), init_hosts=400, init_inf=10,
+	seed=None, tol=1e-2, eig_tol=1e-8, max_rows=4096, **kwargs):
+	'''
+	Find the attractors of many models from an ensemble of initial conditions. Every model is
+	started from the same n_init initial conditions, and the models times initial conditions are
+	solved with get_sol_batch, at most max_rows at a time.
+
+	Args:
+		models: List of Model class instances with the same number of genotypes
+		af_S: Host allele frequencies of the loci that are not sampled, e.g. the scenario's S_init
+		n_init: Number of initial conditions per model
+		loci: Host loci whose allele frequencies are sampled
+		t: Time range of the integration
+		init_hosts: Initial susceptible host abundance
+		init_inf: Initial infected host abundance
+		seed: Seed of the initial conditions
+		tol: Relative distance below which two equilibria count as the same attractor
+		eig_tol: Tolerance on the real parts of eigenvalues for an attractor to count as stable
+		max_rows: Largest number of systems integrated together
+		**kwargs: Further arguments of get_sol_batch, e.g. steady_tol, rtol or atol
+
+	Returns:
+		results: List of dictionaries, one for each model, with the number of attractors
+			n_attractors, their basin fractions (largest first), equilibria S [n_attractors,
+			S_genotypes] and I [n_attractors, I_genotypes], and the fraction of initial conditions
+			unresolved, whose runs ended on a root that failed or is not stable within the
+			genotypes present initially (is_stable_root) and so is no attractor
+	'''
+
+	af_S, af_I = sample_frequencies(n_init, af_S, loci, seed)
+	X_init = np.stack([initial_state(models[0], af_S[n], af_I[n], init_hosts, init_inf) for n in range(n_init)])
+	n_S = models[0].S_genotypes
+
+	#Genotypes absent from every initial condition (e.g. the foreign pathogen) stay absent, so
+	#stability is judged within the others
+	support = np.any(X_init > 0, axis=0)
+
+	#Rows are grouped by model, each model running through all initial conditions
+	rows = [(m, n) for m in range(len(models)) for n in range(n_init)]
+	solved = []
+	for start in range(0, len(rows), max_rows):
+		block = rows[start:start + max_rows]
+		solved += get_sol_batch([models[m] for m, _ in block], None, None, t,
+			X_0=X_init[[n for _, n in block]], info=True, **kwargs)
+
+	results = []
+	for m in range(len(models)):
+		cell = solved[m*n_init:(m + 1)*n_init]
+		states = np.array([np.append(S, I) for S, I, _, _ in cell])
+		success = [status['root_success'] for _, _, _, status in cell]
+		labels, reps = cluster(states, tol)
+
+		#Only clusters of stable equilibria are attractors
+		counts = np.bincount(labels, minlength=len(reps))
+		stable = np.array([is_stable_root(models[m], OptimizeResult(x=states[rep], success=success[rep]),
+			support, eig_tol) for rep in reps], dtype=bool)
+		order = [label for label in np.argsort(-counts, kind='stable') if stable[label]]
+		reps = [reps[label] for label in order]
+
+		results.append({'n_attractors': len(reps), 'fractions': counts[order] / n_init,
+			'S': states[reps, :n_S], 'I': states[reps, n_S:], 'unresolved': np.sum(counts[~stable]) / n_init})
+
+	return results
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Map the number of attractors over a raster scenario in rasters.json')
+	parser.add_argument('scenario', nargs='?', default='cov_gs', help='Name of raster scenario')
+	parser.add_argument('size', nargs='?', type=int, default=20, help='Raster dimension')
+	parser.add_argument('--n-init', type=int, default=32, help='Number of initial conditions per cell')
+	parser.add_argument('--seed', type=int, default=0, help='Seed of the initial conditions')
+	parser.add_argument('--output', default=None, help='Output file (default: ./data/ensembles/<scenario>.npz)')
+	args = parser.parse_args(argv)
+
+	with open('rasters.json', 'r') as f:
+		param_set = json.load(f)[args.scenario]
+
+	x_vals, y_vals = raster_axes(param_set, args.size)
+	models = [Model(**set_param(set_param(param_set['params'], param_set['var_1'], x), param_set['var_2'], y))
+		for x in x_vals for y in y_vals]
+
+	results = get_sol_ensemble(models, param_set['S_init'], args.n_init, seed=args.seed)
+
+	#Rasters of the number of attractors, the basin fraction of the largest and the fraction of
+	#initial conditions that reached none
+	shape = (len(x_vals), len(y_vals))
+	n_attractors = np.array([r['n_attractors'] for r in results]).reshape(shape)
+	largest = np.array([r['fractions'][0] if r['n_attractors'] > 0 else 0 for r in results]).reshape(shape)
+	unresolved = np.array([r['unresolved'] for r in results]).reshape(shape)
+
+	output = args.output or os.path.join('./data/ensembles', args.scenario + '.npz')
+	os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+	np.savez(output, var_1=param_set['var_1'], x_vals=x_vals, var_2=param_set['var_2'], y_vals=y_vals,
+		n_attractors=n_attractors, largest_basin=largest, unresolved=unresolved)
+
+	print('%d of %d cells have more than one attractor, saved to %s' % (np.sum(n_attractors > 1),
+		n_attractors.size, output))
+	if np.any(unresolved > 0):
+		print('%d cells have initial conditions that reached no stable equilibrium' % np.sum(unresolved > 0))
+
+if __name__ == '__main__':
+	main()
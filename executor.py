@@ -0,0 +1,394 @@
+import os
+import sys
+import json
+import time
+import glob
+import threading
+import subprocess
+import numpy as np
+import multiprocessing as mp
+
+from model import Model
+from sweep import Sweep, set_param
+from batch import get_sol_batch, get_sol_row, get_sol_direct
+from cache import ResultCache, cache_key
+from periodic import periodic_sol
+from solve import oscillatory
+from store import STATS_DTYPE, stats_record, orbit_dtype, orbit_record, orbit_dict
+
+'''
+Executors run raster tasks and yield their results as they finish. A task is an (i, js) tuple,
+the row index and the column indices of a chunk of cells (or a task number and the flat indices
+of points of a sweep), and the settings needed to build the models of a task (base parameters,
+swept parameters and their values, initial conditions) are sent to each worker once, so only
+indices travel between processes.
+'''
+
+def default_workers():
+	'''
+	Number of workers, taken from the GFG_CORES environment variable or the number of CPUs
+
+	Returns:
+		workers: Number of worker processes
+	'''
+
+	return int(os.environ.get('GFG_CORES', os.cpu_count() or 1))
+
+def chunk_tasks(rows, chunk):
+	'''
+	Split row tasks into chunks of at most chunk cells, so that rows with slow cells are spread
+	over several workers
+
+	Args:
+		rows: List of (i, js) row tasks
+		chunk: Maximum number of cells per task
+
+	Returns:
+		tasks: List of (i, js) tasks
+	'''
+
+	return [(i, js[start:start + chunk]) for i, js in rows for start in range(0, len(js), chunk)]
+
+_caches = {}
+
+def _cache(settings):
+	#Each process opens a cache directory once, settings are (path, max_bytes) or None
+	if settings is None:
+		return None
+	path, max_bytes = settings
+	if path not in _caches:
+		_caches[path] = ResultCache(path, max_bytes)
+	return _caches[path]
+
+def solve_task(settings, task):
+	'''
+	Build the models of a task from the raster or sweep settings and solve them
+
+	Args:
+		settings: Dictionary with params, var_1, x_vals, var_2, y_vals (or a sweep dictionary
+			from Sweep.to_dict), S_init, I_init, the continuation, direct and periodic flags and an
+			optional cache, a (path, max_bytes) pair of a ResultCache shared by the workers
+		task: (i, js) tuple of a row index and column indices, for sweeps js are the flat indices
+			of the points and i only numbers the task
+
+	Returns:
+		i, js, results: Task indices and the list of (S, I, eigs, status) tuples, status being the
+			solver telemetry of the cell as returned by get_sol with info set, with the periodic
+			flag holding the limit cycle of oscillating cells under 'orbit'
+	'''
+
+	i, js = task
+
+	if 'sweep' in settings:
+		models = Sweep.from_dict(settings['sweep']).models(js)
+	else:
+		models = []
+		for j in js:
+			params = set_param(settings['params'], settings['var_1'], settings['x_vals'][i])
+			models.append(Model(**set_param(params, settings['var_2'], settings['y_vals'][j])))
+
+	if settings.get('continuation', False):
+		mode, solve = 'row', get_sol_row
+	elif settings.get('direct', False):
+		mode, solve = 'direct', get_sol_direct
+	else:
+		mode, solve = 'batch', get_sol_batch
+
+	if settings.get('periodic', False):
+		mode, solve = mode + '+periodic', with_orbits(solve)
+
+	#Cells solved before, e.g. by a scenario sharing part of its raster, are taken from the cache.
+	#Every cell is solved with telemetry, results are (S, I, eigs, status) tuples
+	cache = _cache(settings.get('cache'))
+	if cache is None:
+		return i, js, solve(models, settings['S_init'], settings['I_init'], info=True)
+
+	keys = [cache_key('cell', mode, model, settings['S_init'], settings['I_init']) for model in models]
+	results = [cache.get(key) for key in keys]
+	missing = [n for n, (hit, _) in enumerate(results) if not hit]
+
+	#Cached cells keep the telemetry of their original solve, flagged as cached
+	results = [None if not hit else result[:3] + (dict(result[3] if len(result) > 3 else {}, cached=True),)
+		for hit, result in results]
+
+	if len(missing) > 0:
+		solved = solve([models[n] for n in missing], settings['S_init'], settings['I_init'], info=True)
+		for n, result in zip(missing, solved):
+			results[n] = result
+			cache.put(keys[n], result)
+
+	return i, js, results
+
+def with_orbits(solve):
+	'''
+	Wrap a raster solver so that cells whose equilibrium is oscillatory (an unstable complex pair
+	of eigenvalues) are checked for a stable limit cycle with periodic_sol, which is recorded in
+	their status under 'orbit' (None if there is none)
+
+	Args:
+		solve: Solver with the signature of get_sol_batch
+
+	Returns:
+		solve: Solver returning (S, I, eigs, status) tuples
+	'''
+
+	def solve_orbits(models, af_S, af_I, info=True):
+		results = solve(models, af_S, af_I, info=True)
+		for model, (_, _, eigs, status) in zip(models, results):
+			if oscillatory(eigs):
+				start = time.perf_counter()
+				status['orbit'] = periodic_sol(model, af_S, af_I)
+				status['wall'] += time.perf_counter() - start
+		return results
+
+	return solve_orbits
+
+class SerialExecutor:
+	'''
+	Runs tasks one after the other in the current process, mostly useful for debugging
+	'''
+
+	def __init__(self, settings, workers=1):
+		self.settings = settings
+
+	def map(self, tasks):
+		for task in tasks:
+			yield solve_task(self.settings, task)
+
+	def close(self):
+		pass
+
+_settings = None
+
+def _init_worker(settings):
+	global _settings
+	_settings = settings
+
+def _pool_task(task):
+	return solve_task(_settings, task)
+
+class PoolExecutor:
+	'''
+	Runs tasks on a local process pool. Tasks are handed out one at a time, so workers that
+	finish early pick up the remaining tasks instead of waiting on a fixed assignment.
+	'''
+
+	def __init__(self, settings, workers=None):
+		self.workers = workers or default_workers()
+		self.pool = mp.Pool(processes=self.workers, initializer=_init_worker, initargs=(settings,))
+
+	def map(self, tasks):
+		for result in self.pool.imap_unordered(_pool_task, tasks, chunksize=1):
+			yield result
+
+	def close(self):
+		self.pool.close()
+		self.pool.join()
+
+class QueueExecutor:
+	'''
+	Runs tasks through a queue directory, so that any number of worker processes can take part,
+	including workers started by hand with
+
+		python executor.py <queue_dir>
+
+	Each task is a file in queue_dir/tasks that a worker claims by renaming it into
+	queue_dir/claimed, and results are written to queue_dir/results where the coordinating
+	process collects them. Renames are atomic, so a task is never run by two workers at once.
+
+	Workers touch their claim every HEARTBEAT seconds while they run a task. A claim that has not
+	been touched for claim_timeout seconds belongs to a worker that died, and is put back into
+	queue_dir/tasks for another worker; should the worker turn out to be alive after all, the
+	duplicate result is ignored.
+	'''
+
+	def __init__(self, settings, workers=None, queue_dir='./queue', poll=0.2, claim_timeout=120):
+		self.workers = default_workers() if workers is None else workers
+		self.queue_dir = queue_dir
+		self.poll = poll
+		self.claim_timeout = claim_timeout
+
+		for sub in ('tasks', 'claimed', 'results'):
+			os.makedirs(os.path.join(queue_dir, sub), exist_ok=True)
+			for f in glob.glob(os.path.join(queue_dir, sub, '*')):
+				os.remove(f)
+
+		write_atomic(os.path.join(queue_dir, 'settings.json'), json.dumps(settings))
+		self.procs = []
+
+	def map(self, tasks):
+		tasks = list(tasks)
+		for n, (i, js) in enumerate(tasks):
+			write_atomic(os.path.join(self.queue_dir, 'tasks', '%08d.json' % n),
+				json.dumps({'i': int(i), 'js': [int(j) for j in js]}))
+
+		#Start the local workers, more can join from other shells
+		self.procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__), self.queue_dir])
+			for _ in range(self.workers)]
+
+		remaining = len(tasks)
+		received = set()
+		while remaining > 0:
+			finished = sorted(glob.glob(os.path.join(self.queue_dir, 'results', '*.npz')))
+
+			if len(finished) == 0:
+				self.requeue_stale_claims()
+				if self.workers > 0 and all(proc.poll() is not None for proc in self.procs):
+					self.check_local_workers()
+				time.sleep(self.poll)
+				continue
+
+			for path in finished:
+				#A task requeued from a worker presumed dead can finish twice
+				name = os.path.basename(path)[:-len('.npz')]
+				if name in received:
+					os.remove(path)
+					continue
+				received.add(name)
+
+				with np.load(path) as data:
+					i, js = int(data['i']), data['js']
+					status = [dict(zip(data['stats'].dtype.names, record.tolist())) for record in data['stats']]
+					for s, record in zip(status, data['orbit']):
+						s['orbit'] = orbit_dict(record)
+					results = list(zip(data['S'], data['I'], data['eigs'], status))
+				os.remove(path)
+				remaining -= 1
+				yield i, js, results
+
+	def requeue_stale_claims(self):
+		#Claims whose worker stopped sending heartbeats go back into the task directory
+		now = time.time()
+		for claimed in glob.glob(os.path.join(self.queue_dir, 'claimed', '*.json')):
+			try:
+				if now - os.path.getmtime(claimed) < self.claim_timeout:
+					continue
+				name = os.path.basename(claimed).split('.')[0]
+				os.rename(claimed, os.path.join(self.queue_dir, 'tasks', name + '.json'))
+			except FileNotFoundError:
+				#The worker finished the task in the meantime
+				continue
+
+			#Tasks are only started by local workers that are still running, restart them if needed
+			if self.workers > 0 and all(proc.poll() is not None for proc in self.procs):
+				self.procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__), self.queue_dir])
+					for _ in range(self.workers)]
+
+	def check_local_workers(self):
+		#Once every local worker has exited, unclaimed tasks or tasks claimed by a local worker
+		#will never finish, tasks claimed by workers on other hosts may still come in
+		local = ['%s-%d' % (os.uname().nodename, proc.pid) for proc in self.procs]
+		claimed = os.listdir(os.path.join(self.queue_dir, 'claimed'))
+		stuck = [name for name in claimed if any(name.endswith('.%s.json' % w) for w in local)]
+
+		if len(os.listdir(os.path.join(self.queue_dir, 'tasks'))) > 0 or len(stuck) > 0:
+			raise RuntimeError('All local workers exited with tasks left in %s' % self.queue_dir)
+
+	def close(self):
+		for proc in self.procs:
+			proc.wait()
+
+def write_atomic(path, text):
+	tmp = path + '.tmp'
+	with open(tmp, 'w') as f:
+		f.write(text)
+	os.replace(tmp, path)
+
+#Seconds between the heartbeats of a queue worker on the task it is running
+HEARTBEAT = 10
+
+def heartbeat(path, stop):
+	#Touch a claim until stop is set, so the coordinator knows its worker is alive
+	while not stop.wait(HEARTBEAT):
+		try:
+			os.utime(path)
+		except FileNotFoundError:
+			return
+
+def queue_worker(queue_dir):
+	'''
+	Claim and solve tasks from a queue directory until no tasks are left
+
+	Args:
+		queue_dir: Queue directory of a QueueExecutor
+	'''
+
+	with open(os.path.join(queue_dir, 'settings.json'), 'r') as f:
+		settings = json.load(f)
+
+	worker_id = '%s-%d' % (os.uname().nodename, os.getpid())
+
+	while True:
+		tasks = sorted(glob.glob(os.path.join(queue_dir, 'tasks', '*.json')))
+		if len(tasks) == 0:
+			return
+
+		for task_path in tasks:
+			name = os.path.basename(task_path)[:-len('.json')]
+			claimed = os.path.join(queue_dir, 'claimed', '%s.%s.json' % (name, worker_id))
+
+			#Another worker got to this task first
+			try:
+				os.rename(task_path, claimed)
+				#Renaming keeps the mtime of the task file, so the claim is touched straight away
+				os.utime(claimed)
+			except FileNotFoundError:
+				continue
+
+			with open(claimed, 'r') as f:
+				task = json.load(f)
+
+			stop = threading.Event()
+			beat = threading.Thread(target=heartbeat, args=(claimed, stop), daemon=True)
+			beat.start()
+
+			try:
+				i, js, results = solve_task(settings, (task['i'], np.array(task['js'])))
+			finally:
+				stop.set()
+				beat.join()
+
+			S, I, eigs, status = zip(*results)
+			stats = np.array([stats_record(s) for s in status], dtype=STATS_DTYPE)
+
+			#Cells without a limit cycle are left with a period of zero
+			orbit = np.zeros(len(status), dtype=orbit_dtype(len(S[0]), len(I[0])))
+			for n, s in enumerate(status):
+				if s.get('orbit') is not None:
+					orbit[n] = orbit_record(s['orbit'])
+
+			tmp = os.path.join(queue_dir, 'results', name + '.part')
+			with open(tmp, 'wb') as f:
+				np.savez(f, i=i, js=js, S=np.array(S), I=np.array(I), eigs=np.array(eigs), stats=stats,
+					orbit=orbit)
+			os.replace(tmp, os.path.join(queue_dir, 'results', name + '.npz'))
+
+			#The claim is gone if the coordinator took this worker for dead and requeued the task
+			try:
+				os.remove(claimed)
+			except FileNotFoundError:
+				pass
+
+backends = {'serial': SerialExecutor, 'pool': PoolExecutor, 'queue': QueueExecutor}
+
+def make_executor(backend, settings, workers=None, **kwargs):
+	'''
+	Create an executor for raster tasks
+
+	Args:
+		backend: One of 'serial', 'pool' or 'queue'
+		settings: Raster settings passed to solve_task
+		workers: Number of worker processes, default_workers() if None
+		**kwargs: Backend specific options, e.g. queue_dir for the queue backend
+
+	Returns:
+		executor: Executor with map(tasks) and close() methods
+	'''
+
+	if backend not in backends:
+		raise ValueError('Unknown backend %s, expected one of %s' % (backend, ', '.join(backends)))
+
+	return backends[backend](settings, workers, **kwargs)
+
+if __name__ == '__main__':
+	queue_worker(sys.argv[1])
@@ -2,6 +2,7 @@ import numpy as np
 
 from model import Model
 from solve import run_sim
+from cache import cached
 from utilities import get_trans
 from model import collapse_locus
 
@@ -30,6 +31,9 @@ for i in range(sim.n_loci):
 	S_0[sim.G[:,i] == 0] = S_0[sim.G[:,i] == 0] * (1 - init_cond[i])
 	S_0[sim.G[:,i] == 1] = S_0[sim.G[:,i] == 1] * (init_cond[i])
 
+#Simulations are cached on disk (cache.py), so rebuilding the figure does not rerun them
+run_sim = cached(run_sim)
+
 t, S, I = run_sim(sim, S_0, [0.9, 0.1, 0], t=(0,2000))
 
 Sc, _ = collapse_locus(sim, S, 0)
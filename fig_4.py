@@ -2,6 +2,7 @@ import numpy as np
 
 from model import Model
 from solve import run_sim
+from cache import cached
 from utilities import get_trans, load_data
 from model import collapse_locus
 
@@ -39,6 +40,9 @@ for i in range(sim.n_loci):
 	S_0_nonrecomb[sim.G[:,i] == 0] = S_0_nonrecomb[sim.G[:,i] == 0] * (1 - af_S2[i])
 	S_0_nonrecomb[sim.G[:,i] == 1] = S_0_nonrecomb[sim.G[:,i] == 1] * (af_S2[i])
 
+#Simulations are cached on disk (cache.py), so rebuilding the figure does not rerun them
+run_sim = cached(run_sim)
+
 t1, S_1, I_1 = run_sim(sim, S_0_recomb, [0.9, 0.1, 0], t=(0,20000))
 t2, S_2, I_2 = run_sim(sim, S_0_nonrecomb, [0.9, 0.1, 0], t=(0,20000))
 
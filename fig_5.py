@@ -1,8 +1,10 @@
 import numpy as np
 
-from model import Model, collapse_locus
+from model import Model
 from solve import run_sim
-from utilities import load_data, get_trans, check_stab
+from cache import cached
+from stream import reduce_sim, Series
+from utilities import load_data, check_stab
 
 from matplotlib import pyplot as plt
 from matplotlib import ticker
@@ -44,16 +46,20 @@ _, _, gs_slope, _ = load_data(gs_path, 'c_s', 'c_g')
 
 gs_masked = np.ma.masked_where(gs_mask == 1, gs_slope)
 
+#Simulations are cached on disk (cache.py), so rebuilding the figure does not rerun them
+run_sim = cached(run_sim)
+
 sim = Model(**params_0)
-t, S, I = run_sim(sim, np.ones(8)*10, np.array([10,10,0]), t=(0, 10000))
+t, S, I = run_sim(sim, np.ones(8)*10, np.array([10,10,0]), t=(0, 10000), n_points=2)
 
 S_0 = S[:,-1]
 I_0 = I[:,-1]
 
 sim = Model(**params)
-t, S, I = run_sim(sim, S_0, I_0, t=(0, 150000))
-
-Sc, _ = collapse_locus(sim, S, 0)
+#Only the allele frequencies and transitivity slope are needed from the long run
+obs = cached(reduce_sim)(sim, S_0, I_0, {'allele_freqs': Series(), 'trans_slope': Series()}, t=(0, 150000), n_points=3001)
+t, freqs = obs['allele_freqs']
+_, trans_slope = obs['trans_slope']
 
 labels = [r'$\it{gs}$', r'$\it{gS}$', r'$\it{Gs}$', r'$\it{GS}$']
 
@@ -61,9 +67,7 @@ fig, ax = plt.subplots(nrows = 1, ncols = 3, figsize=(10,3))
 fig.tight_layout()
 plt.subplots_adjust(left=None, bottom=None, right=None, top=None, wspace=0.4, hspace=0.4)
 
-f_R = np.sum(S[sim.G[:,0] == 1], axis=0) / np.sum(S, axis=0)
-f_G = np.sum(S[sim.G[:,1] == 1], axis=0) / np.sum(S, axis=0)
-f_S = np.sum(S[sim.G[:,2] == 1], axis=0) / np.sum(S, axis=0)
+f_R, f_G, f_S = freqs
 
 ax[0].plot(t, f_R, label = 'Linkage Modifier')
 ax[0].plot(t, f_G, label = 'General Resistance')
@@ -74,12 +78,6 @@ ax[0].set_xlabel('Time')
 ax[0].set_ylabel('Frequency')
 ax[0].ticklabel_format(axis='x', style='sci', scilimits=(0,0))
 
-trans_slope = np.zeros(len(t))
-
-for i in range(len(t)):
-    f_sib, h_sib = get_trans(sim, S[:,i], I[:,i])
-    trans_slope[i], _ = np.polyfit(f_sib[:,0], f_sib[:,1], 1, w=f_sib[:,2])
-
 ax[1].plot(t, trans_slope)
 ax[1].set_xlabel('Time')
 ax[1].set_ylabel('Transitivity Slope')
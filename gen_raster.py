@@ -1,78 +1,114 @@
-import numpy as np
 import tqdm
-import sys
+import os
 import json 
-import pickle as pkl
-import multiprocessing as mp
-
-from model import Model
-from solve import get_sol
-
-if len(sys.argv) == 2:
-	scenario = sys.argv[1]
-elif len(sys.argv) == 3:
-	scenario = sys.argv[1]
-	size = int(sys.argv[2])
-else:
-	scenario = 'cov_gs'			#Name of raster scenario
-	size = 200					#Raster dimension
-
-cores = 4						#Number of CPU cores
-
-with open('rasters.json', 'r') as data:
-	param_set = json.load(data)[scenario]
-
-output_path = param_set['filename']			#Output filename
-
-var_1 = param_set['var_1']					#First parameter rastered
-var_2 = param_set['var_2']					#Second parameter rastered
-
-'''
-Range of values for raster variables, too vary something other than v, c_g, or c_s, you 
-will need to add a new range array and add it to the vars dict below
-'''
-V_costs = np.linspace(0, 0.3, size)			#Range of parameters for virulence costs
-G_costs = np.linspace(0, 0.2, size)			#Range of parameters for general resistance costs
-S_costs = np.linspace(0, 0.4, size)			#Range of parameters for speific resistance costs
-
-S_init = param_set['S_init']				#Initial host allele frequencies (Recomb, General, Specific)
-I_init = param_set['I_init']				#Initial proportion of the Avr pathogen genotype
-
-params = param_set['params']
-
-vars = {'c_g': G_costs, 'c_s': S_costs, 'v': V_costs}
-
-def pass_to_sim(model):
-	return get_sol(model, S_init, I_init)
+import argparse
+
+from store import RasterStore, store_path
+from refine import adaptive_raster
+from executor import make_executor, chunk_tasks, default_workers, backends
+from sweep import axis_values
+from cache import default_cache
+
+def raster_axes(param_set, size):
+	'''
+	Values of the two rastered parameters of a scenario. Ranges come from the scenario's optional
+	"ranges" entry in rasters.json, and otherwise from sweep.DEFAULT_RANGES (0 to 0.2 for c_g,
+	0 to 0.4 for c_s and 0 to 0.3 for v)
+
+	Args:
+		param_set: Scenario dictionary from rasters.json
+		size: Raster dimension
+
+	Returns:
+		x_vals: Values of var_1
+		y_vals: Values of var_2
+	'''
+
+	ranges = param_set.get('ranges', {})
+	return axis_values(param_set['var_1'], size, ranges), axis_values(param_set['var_2'], size, ranges)
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(description='Compute a raster of equilibria for a scenario in rasters.json')
+	parser.add_argument('scenario', nargs='?', default='cov_gs', help='Name of raster scenario')
+	parser.add_argument('size', nargs='?', type=int, default=200, help='Raster dimension')
+	parser.add_argument('--adaptive', nargs='?', type=int, const=17, default=None, metavar='COARSE',
+		help='Refine adaptively around regime boundaries, starting from a COARSE x COARSE grid')
+	solvers = parser.add_mutually_exclusive_group()
+	solvers.add_argument('--continuation', action='store_true',
+		help='Seed the solve of each cell with the equilibrium of its neighbour along the row')
+	solvers.add_argument('--direct', action='store_true',
+		help='Solve for stable equilibria directly, only integrating cells where none is found')
+	parser.add_argument('--periodic', action='store_true',
+		help='Find the limit cycles of oscillating cells, whose cycle averages are then used by load_data')
+	parser.add_argument('--cores', type=int, default=default_workers(),
+		help='Number of worker processes (default: GFG_CORES or the number of CPUs)')
+	parser.add_argument('--backend', choices=sorted(backends), default='pool', 
+		help='How tasks are run: a local process pool, a queue directory other workers can join, or serially')
+	parser.add_argument('--chunk', type=int, default=64, help='Maximum number of cells per task')
+	parser.add_argument('--queue-dir', default=None, help='Queue directory for the queue backend')
+	parser.add_argument('--no-cache', action='store_true',
+		help='Solve every cell, instead of reusing cells cached by earlier runs (see cache.py)')
+
+	return parser.parse_args(argv)
+
+def main(argv=None):
+	args = parse_args(argv)
+
+	scenario = args.scenario		#Name of raster scenario
+	size = args.size				#Raster dimension
+
+	with open('rasters.json', 'r') as data:
+		param_set = json.load(data)[scenario]
+
+	output_path = param_set['filename']			#Output filename, results are stored in a directory of the same name
+
+	var_1 = param_set['var_1']					#First parameter rastered
+	var_2 = param_set['var_2']					#Second parameter rastered
+	x_vals, y_vals = raster_axes(param_set, size)
+
+	S_init = param_set['S_init']				#Initial host allele frequencies (Recomb, General, Specific)
+	I_init = param_set['I_init']				#Initial proportion of the Avr pathogen genotype
+
+	params = param_set['params']
+
+	#Results are streamed to an on-disk store, an existing store for the scenario is resumed
+	store = RasterStore.open_or_create(store_path(output_path), var_1, x_vals, var_2, y_vals,
+		params, S_init, I_init, scenario)
+
+	#Workers rebuild the models of each task from these settings
+	settings = {'params': params, 'var_1': var_1, 'x_vals': store.x_vals.tolist(), 'var_2': var_2, 
+		'y_vals': store.y_vals.tolist(), 'S_init': S_init, 'I_init': I_init, 'continuation': args.continuation,
+		'direct': args.direct, 'periodic': args.periodic}
+
+	#Workers share a result cache, so cells solved for other scenarios are not solved again
+	cache = None if args.no_cache else default_cache()
+	if cache is not None:
+		settings['cache'] = (cache.path, cache.max_bytes)
+
+	queue_dir = args.queue_dir or os.path.join(store.path, 'queue')
+	options = {'queue_dir': queue_dir} if args.backend == 'queue' else {}
+	executor = make_executor(args.backend, settings, args.cores, **options)
+
+	#Rows are split into chunks of cells, each integrated together as a single stacked system
+	def solve(rows):
+		with tqdm.tqdm(total=sum(len(js) for _, js in rows), leave=False) as pbar:
+			for i, js, row_results in executor.map(chunk_tasks(rows, args.chunk)):
+				yield i, js, row_results
+				pbar.update(len(js))
+
+	if args.adaptive is not None:
+		print('Running Simulations with adaptive refinement...')
+		n_solved = adaptive_raster(store, solve, coarse=args.adaptive)
+		print('Solved %d of %d cells' % (n_solved, size**2))
+	else:
+		pending = store.pending()
+		print('%d of %d cells left to compute' % (sum(len(js) for _, js in pending), size**2))
+
+		print('Running Simulations...')
+		for i, js, row_results in solve(pending):
+			store.write(i, js, row_results)
+
+	executor.close()
 
 if __name__ == '__main__':
-	coords = []     #x, y coordinates of each simulation in raster
-	models = []     #Empty tuple for model classes
-
-	print('Initializing Models...')
-	#Create raster of model classes for each parameter combination
-	for i in range(size):
-		for j in range(size):
-			coords.append((i,j))
-
-			params[var_1] = vars[var_1][i]
-			params[var_2] = vars[var_2][j]
-			new_model = Model(**params)
-
-			models.append(new_model)
-		
-	#Run simluations for 4 core processor
-	pool = mp.Pool(processes=cores)	
-	
-	print('Running Simulations...')
-	results = []
-	for result in tqdm.tqdm(pool.imap(pass_to_sim, models), total=len(models)):
-		results.append(result)
-
-	raster = []
-	for i in range(size):
-		inds = [j for j in range(len(coords)) if coords[j][1] == i]
-		raster.append([results[j] for j in inds])
-
-	with open(output_path, 'wb') as f:
-		pkl.dump([models, results], f)
\ No newline at end of file
+	main()
@@ -1,20 +1,33 @@
 import itertools
+import functools
 import numpy as np
+from scipy import sparse
+
+#Largest number of host genotypes for which the mating matrix is stored densely
+DENSE_GENOTYPES = 16
 
 class Model:
 
 	def __init__(self, **kwargs):
-		self.n_loci = 3	#Number of host loci, fixed at 3
-		self.S_genotypes = 2**self.n_loci	#Number of host genotypes
-		self.I_genotypes = 3	#Number of pathogen genotypes, fixed at 3
+		#Number of host loci, locus 0 is the linkage modifier, 1 general and 2 specific resistance,
+		#any further loci are neutral unless given costs or a transmission matrix
+		self.n_loci = 3
 
-		#Matrix of all possible genotypes, G[i,j] is the jth allele of the ith genotype
-		self.G = np.array(list(itertools.product([0, 1], repeat=self.n_loci)))
+		#Number of pathogen genotypes (Avr, vir, foreign), the last is always the foreign pathogen
+		self.I_genotypes = 3
 
 		#Recombination rate vector, rho[0] is the recombination rate for allele 0, rho[1] is the 
 		#recombination rate for allele 1
 		self.rho = [0.05, 0]
 
+		#Optional recombination map {(l-1, l): rate} between adjacent loci, overriding the defaults
+		#(rho between loci 1 and 2, free recombination elsewhere). A rate can also be a pair of
+		#rates for maternal linkage modifier alleles 0 and 1, as with rho
+		self.recomb = None
+
+		self.allele_costs = None	#Optional fecundity cost of each locus, defaults to [0, c_g, c_s, 0...]
+		self.transmission = None	#Optional transmission matrix [S_genotypes, I_genotypes]
+
 		self.b = 1				#Default birthrate
 		self.mu = 0.2			#Default deathrate
 		self.k = 0.001			#Coefficient of density-dependent growth
@@ -33,6 +46,14 @@ class Model:
 		for key, value in kwargs.items():
 			setattr(self, key, value)
 
+		if self.n_loci < 3:
+			raise ValueError('n_loci must be at least 3, got %d' % self.n_loci)
+
+		self.S_genotypes = 2**self.n_loci	#Number of host genotypes
+
+		#Matrix of all possible genotypes, G[i,j] is the jth allele of the ith genotype
+		self.G = np.array(list(itertools.product([0, 1], repeat=self.n_loci)))
+
 		self.C = self.cost_vector()
 		self.B = self.transmission_matrix()
 		self.M = self.mating_matrix()
@@ -46,13 +67,13 @@ class Model:
 			C: Cost vector
 		'''
 
-		allele_costs = [0, self.c_g, self.c_s]
-
-		costs = self.G * allele_costs
+		if self.allele_costs is None:
+			allele_costs = np.zeros(self.n_loci)
+			allele_costs[1:3] = [self.c_g, self.c_s]
+		else:
+			allele_costs = np.array(self.allele_costs)
 
-		C = np.ones(self.G.shape[0])
-		for i in range(self.G.shape[1]):
-			C = C * (1 - costs[:,i])
+		C = np.prod(1 - self.G * allele_costs, axis=1)
 
 		return C
 
@@ -64,83 +85,135 @@ class Model:
 		Returns:
 			B: Transmission matrix
 		'''
+
+		if self.transmission is not None:
+			B = np.array(self.transmission, dtype=float)
+			if B.shape != (self.S_genotypes, self.I_genotypes):
+				raise ValueError('transmission must have shape (%d, %d), got %s' % 
+					(self.S_genotypes, self.I_genotypes, B.shape))
+			return B
+
+		if self.I_genotypes != 3:
+			raise ValueError('A transmission matrix must be given for %d pathogen genotypes' % self.I_genotypes)
 		
 		#Define transmission matrix and apply nonhost resistance
 		B = np.ones((self.S_genotypes, self.I_genotypes)) * self.beta
 		B[:,2] = B[:,2]*(1-self.nh)
 
-		#Soft selection
-		if self.sel == 'soft':
-			for i, host in enumerate(self.G):
-				#Apply general resistance to all pathogen types
-				if host[1] == 1:
-					B[i,:] = B[i,:] * (1-self.g)
-				
-				#Apply specific resistance for resistant genotype
-				if host[2] == 1:
-					B[i,0] = B[i,0] * (1-self.s)
+		general = self.G[:,1] == 1		#Hosts carrying the general resistance allele
+		specific = self.G[:,2] == 1		#Hosts carrying the specific resistance allele
 
-				#Apply virulence costs for susceptible genotype
-				else:
-					B[i,1] = B[i,1] * (1-self.v)
+		if self.sel in ('soft', 'hard'):
+			#Apply general resistance to all pathogen types
+			B[general,:] = B[general,:] * (1-self.g)
+
+			#Apply specific resistance for resistant genotype
+			B[specific,0] = B[specific,0] * (1-self.s)
+
+		#Soft selection, virulence costs only for the susceptible genotype
+		if self.sel == 'soft':
+			B[~specific,1] = B[~specific,1] * (1-self.v)
 
-		#Hard selection
+		#Hard selection, virulence costs on all hosts
 		if self.sel == 'hard':
 			B[:,1] = B[:,1] * (1-self.v)
-
-			for i, host in enumerate(self.G):
-				#Apply general resistance to all pathogen types
-				if host[1] == 1:
-					B[i,:] = B[i,:] * (1-self.g)
-				
-				#Apply specific resistance for resistant genotype
-				if host[2] == 1:
-					B[i,0] = B[i,0] * (1-self.s)
 					
 		return B
 				
+	def recombination_map(self):
+		'''
+		Define the recombination map R, where R[l,m] is the probability that the inheritance path
+		switches parent between loci l-1 and l when the maternal linkage modifier allele is m
+
+		Returns:
+			R: Recombination map [n_loci, 2], R[0] is unused and set to 0.5
+		'''
+
+		R = np.full((self.n_loci, 2), 0.5)
+		R[2] = self.rho
+
+		if self.recomb is not None:
+			for pair, rate in self.recomb.items():
+				#Keys may be tuples or, when loaded from json, strings such as "1,2"
+				if isinstance(pair, str):
+					pair = tuple(int(l) for l in pair.split(','))
+				l_0, l_1 = sorted(pair)
+
+				if l_1 - l_0 != 1 or l_0 < 0 or l_1 >= self.n_loci:
+					raise ValueError('Recombination rates are defined between adjacent loci, got %s' % (pair,))
+				R[l_1] = rate
+
+		return R
+
 	def mating_matrix(self):
 		'''
 		Define the matring matrix M, where M[i,j] is the probability of offspring genotype j given
-		parental combination i (reduced from third order tensor)
+		parental combination i (reduced from third order tensor). M only depends on the number of
+		loci and the recombination map, so it is built once and shared between models.
 
 		Returns:
-			M: Mating matrix
+			M: Mating matrix (read only), dense for up to DENSE_GENOTYPES host genotypes and a
+				sparse CSR matrix otherwise
 		'''
 
-		paths = np.array(list(itertools.product([0, 1], repeat=self.n_loci)))
-		p_paths = np.zeros((self.S_genotypes, 2))
-
-		for i, path in enumerate(paths):
-			p_locus = np.zeros((self.n_loci, 2))
-			p_locus[0:2] = 0.5
-
-			if path[2] == path[1]:
-				p_locus[2, 0] = 1 - self.rho[0]
-				p_locus[2, 1] = 1 - self.rho[1]
-			else:
-				p_locus[2, 0] = self.rho[0]
-				p_locus[2, 1] = self.rho[1]
-			
-			p_paths[i] = np.prod(p_locus, axis=0)
-
-		M = np.zeros((self.S_genotypes, self.S_genotypes, self.S_genotypes))
-		for i, parental in enumerate(self.G):
-			for j, maternal in enumerate(self.G):
-				offspring = np.zeros(paths.shape)
-				offspring[paths==0] = np.tile(parental, (self.S_genotypes, 1))[paths==0]
-				offspring[paths==1] = np.tile(maternal, (self.S_genotypes, 1))[paths==1]
-				
-				for k, progeny in enumerate(self.G):
-					matches = np.prod(offspring == progeny, axis=1, dtype=bool)
-					
-					if maternal[0] == 0:
-						M[i,j,k]= np.dot(matches, p_paths[:,0])
-					else:
-						M[i,j,k]= np.dot(matches, p_paths[:,1])
-		
-		M = M.reshape((self.S_genotypes**2, self.S_genotypes))
-		return M
+		R = self.recombination_map()
+		return build_mating_matrix(self.n_loci, tuple(tuple(float(r) for r in rates) for rates in R))
+
+@functools.lru_cache(maxsize=None)
+def build_mating_matrix(n_loci, R):
+	'''
+	Build the mating matrix for a given number of loci and recombination map, with results
+	memoized so each combination is only computed once per process. Only the (parental, maternal,
+	offspring) triples where each offspring allele comes from one of the parents are enumerated,
+	6**n_loci of the 8**n_loci entries, and the inheritance path probabilities are accumulated
+	locus by locus as a Markov chain.
+
+	Args:
+		n_loci: Number of host loci
+		R: Recombination map as a tuple of (rate for modifier allele 0, rate for allele 1) pairs,
+			see Model.recombination_map
+
+	Returns:
+		M: Mating matrix [n_genotypes**2, n_genotypes] (read only)
+	'''
+
+	R = np.array(R)
+	n_genotypes = 2**n_loci
+
+	#Alleles at a single locus for which the offspring allele is inherited [parental, maternal, offspring]
+	combos = np.array([[0, 0, 0], [1, 1, 1], [0, 1, 0], [0, 1, 1], [1, 0, 0], [1, 0, 1]])
+
+	#Whether each inheritance path (parental, maternal) gives the offspring allele [combo, path]
+	emit = np.stack([combos[:,2] == combos[:,0], combos[:,2] == combos[:,1]], axis=1).astype(float)
+
+	#Path probabilities and genotype indices for every triple, starting from the first locus
+	p_paths = 0.5 * emit
+	triples = combos.copy()
+	modifier = combos[:,1]
+
+	for l in range(1, n_loci):
+		#Recombination switches the path with a rate set by the maternal modifier allele
+		r = R[l, modifier][:, None]
+		p_paths = (1 - r)*p_paths + r*p_paths[:, ::-1]
+
+		#Extend every triple with every allowed combination at this locus
+		p_paths = (p_paths[:, None, :] * emit[None, :, :]).reshape(-1, 2)
+		triples = (2*triples[:, None, :] + combos[None, :, :]).reshape(-1, 3)
+		modifier = np.repeat(modifier, len(combos))
+
+	p = np.sum(p_paths, axis=1)
+	rows = triples[:,0]*n_genotypes + triples[:,1]
+
+	M = sparse.csr_matrix((p, (rows, triples[:,2])), shape=(n_genotypes**2, n_genotypes))
+	M.eliminate_zeros()
+
+	if n_genotypes <= DENSE_GENOTYPES:
+		M = M.toarray()
+		M.setflags(write=False)
+	else:
+		M.data.setflags(write=False)
+
+	return M
 
 def collapse_locus(model, S, locus):
 	'''
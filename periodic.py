@@ -0,0 +1,218 @@
+import numpy as np
+from scipy.integrate import solve_ivp
+
+from solve import make_df, jacobian, initial_state
+
+'''
+Limit cycles of the ODE system. Where the system keeps oscillating the equilibrium returned by
+get_sol is unstable, so its allele frequencies describe no state the system is ever in. Only
+equilibria with an unstable pair of complex eigenvalues (solve.oscillatory) are checked. A cycle
+is detected from the autocorrelation of a trajectory, whose oscillations must not die out,
+refined by single shooting with Newton's method on the period and a point of the orbit, and
+kept only if shooting converges to an orbit whose nontrivial Floquet multipliers are below 1.
+It is summarised by its period, the amplitude of each genotype and the abundances averaged over
+one cycle, which load_data uses in place of the equilibrium.
+'''
+
+def flow(model, df, X_0, T, support, variational=False, n_points=200):
+	'''
+	Integrate the system over one period, accumulating the integral of the state and optionally
+	the monodromy matrix (the derivative of the end state with respect to the start state)
+
+	Args:
+		model: Model class instance
+		df: Right hand side of the ODE system
+		X_0: Start state
+		T: Integration time
+		support: Indices of the genotypes present, the others stay at zero
+		variational: Also integrate the variational equations
+		n_points: Number of points at which the orbit is sampled for its extremes
+
+	Returns:
+		X_T: End state
+		mean: State averaged over the integration
+		M: Monodromy matrix restricted to support, None unless variational is set
+		X_min: Smallest abundance of each genotype along the orbit
+		X_max: Largest abundance of each genotype along the orbit
+	'''
+
+	n = len(X_0)
+	m = len(support)
+
+	def rhs(t, Y):
+		X = np.zeros(n)
+		X[support] = Y[:m]
+		dX = df(t, X)[support]
+		if not variational:
+			return np.concatenate([dX, Y[:m]])
+		J = jacobian(model, X)[np.ix_(support, support)]
+		return np.concatenate([dX, Y[:m], (J @ Y[2*m:].reshape(m, m)).ravel()])
+
+	Y_0 = np.concatenate([X_0[support], np.zeros(m)] + ([np.eye(m).ravel()] if variational else []))
+	sol = solve_ivp(rhs, (0, T), Y_0, method='DOP853', rtol=1e-10, atol=1e-10,
+		t_eval=np.linspace(0, T, n_points))
+
+	X_T, mean, path = np.zeros(n), np.zeros(n), np.zeros((n, len(sol.t)))
+	X_T[support] = sol.y[:m, -1]
+	mean[support] = sol.y[m:2*m, -1] / T
+	path[support] = sol.y[:m]
+	M = sol.y[2*m:, -1].reshape(m, m) if variational else None
+
+	return X_T, mean, M, path.min(axis=1), path.max(axis=1)
+
+def detect_cycle(df, X_0, support, t_window=2000, n_points=20000, min_returns=4, tol=1e-4, decay=0.5):
+	'''
+	Look for sustained oscillations along a trajectory, from the autocorrelation of the genotype
+	that varies most. Oscillations whose range shrinks over the trajectory are damped, spiralling
+	into a stable equilibrium, and do not count
+
+	Args:
+		df: Right hand side of the ODE system
+		X_0: Start state, after any transient
+		support: Indices of the genotypes present
+		t_window: Length of the trajectory
+		n_points: Number of points at which the trajectory is sampled
+		min_returns: Least number of periods the trajectory has to cover
+		tol: Relative standard deviation below which the trajectory counts as steady
+		decay: Largest relative shrinkage of the range of the oscillations, between the first
+			and second half of the trajectory, for them to count as sustained
+
+	Returns:
+		guess: None if there are no sustained oscillations, otherwise (X, T), the end state and
+			an estimate of the period
+	'''
+
+	t = np.linspace(0, t_window, n_points)
+	sol = solve_ivp(df, (0, t_window), X_0, method='DOP853', rtol=1e-9, atol=1e-9, t_eval=t)
+	path = sol.y[support]
+
+	#Variation is relative to the total abundance, so that genotypes that are dying out do not count
+	variation = np.std(path, axis=1) / np.mean(np.sum(path, axis=0))
+	k = np.argmax(variation)
+	if variation[k] < tol:
+		return None
+
+	half = len(sol.t) // 2
+	if np.ptp(path[k, half:]) < (1 - decay)*np.ptp(path[k, :half]):
+		return None
+
+	#The period is the lag of the first peak of the autocorrelation after its first zero, which
+	#unlike crossings of the mean is not fooled by waveforms with several bumps per cycle
+	x = path[k] - np.mean(path[k])
+	corr = np.correlate(x, x, mode='full')[len(x) - 1:] / (np.dot(x, x)*(len(x) - np.arange(len(x))) / len(x))
+	negative = np.flatnonzero(corr < 0)
+	if len(negative) == 0:
+		return None
+	peaks = negative[0] + np.flatnonzero((corr[negative[0]:-2] < corr[negative[0] + 1:-1]) &
+		(corr[negative[0] + 1:-1] >= corr[negative[0] + 2:]) & (corr[negative[0] + 1:-1] > 0.5)) + 1
+	if len(peaks) == 0 or peaks[0]*min_returns > len(x):
+		return None
+
+	return sol.y[:, -1], float(peaks[0]*(sol.t[1] - sol.t[0]))
+
+def shoot(model, df, X, T, support, tol=1e-4, max_iter=20):
+	'''
+	Refine a periodic orbit by single shooting. The unknowns are a point X on the orbit and the
+	period T, with the point kept on the plane through the initial guess normal to the flow.
+	Newton steps are least squares solutions, as orbits with a second multiplier close to 1 (a
+	nearly neutral direction, e.g. from a linkage modifier) leave the system close to singular
+
+	Args:
+		model: Model class instance
+		df: Right hand side of the ODE system
+		X: Initial guess of a point on the orbit
+		T: Initial guess of the period
+		support: Indices of the genotypes present
+		tol: Mismatch after one period, relative to the state, below which the orbit has converged
+		max_iter: Largest number of Newton iterations
+
+	Returns:
+		X: Point on the orbit, the iterate with the smallest mismatch
+		T: Period
+		M: Monodromy matrix
+		converged: Whether the mismatch fell below tol
+	'''
+
+	X_g = X.copy()
+	normal = df(0, X_g)[support]
+	m = len(support)
+	best = (np.inf, X, T, None)
+
+	for _ in range(max_iter):
+		X_T, _, M, _, _ = flow(model, df, X, T, support, variational=True, n_points=2)
+		mismatch = (X_T - X)[support]
+		error = np.linalg.norm(mismatch) / np.linalg.norm(X)
+		if error < best[0]:
+			best = (error, X, T, M)
+		if error < 1e-3*tol:
+			break
+
+		A = np.zeros((m + 1, m + 1))
+		A[:m, :m] = M - np.eye(m)
+		A[:m, m] = df(0, X_T)[support]
+		A[m, :m] = normal
+		rhs = -np.append(mismatch, np.dot(normal, (X - X_g)[support]))
+		step = np.linalg.lstsq(A, rhs, rcond=1e-6)[0]
+
+		X = X.copy()
+		X[support] += step[:m]
+		T += step[m]
+		if T <= 0 or np.min(X) < 0:
+			break
+
+	error, X, T, M = best
+	return X, T, M, error < tol
+
+def periodic_sol(model, af_S, af_I, t=(0,5000), init_hosts=400, init_inf=10, t_window=2000):
+	'''
+	Find the limit cycle the system settles on, if it keeps oscillating
+
+	Args:
+		model: Model class instance
+		af_S: Initial allele frequencies for each host locus
+		af_I: Initial frequency of the Avr pathogen genotype
+		t: Time range of the transient, integrated before looking for oscillations
+		init_hosts: Initial susceptible host abundance
+		init_inf: Initial infected host abundance
+		t_window: Length of the trajectory searched for oscillations
+
+	Returns:
+		orbit: None if the system does not settle on a stable limit cycle (no sustained
+			oscillations, shooting failed, or the orbit is unstable), otherwise a dictionary with
+			the period, the amplitude (max - min) of each genotype, the abundances S and I averaged
+			over a cycle, the largest nontrivial Floquet multiplier, and the stable and converged
+			flags, which are then both set
+	'''
+
+	df = make_df(model)
+	X_0 = initial_state(model, af_S, af_I, init_hosts, init_inf)
+	support = np.flatnonzero(X_0 > 0)
+
+	sol = solve_ivp(df, t, X_0, method='DOP853', rtol=1e-6, atol=1e-9)
+	X_t = sol.y[:, -1]
+
+	#Genotypes lost during the transient are left out of the orbit
+	support = support[X_t[support] > 1e-6*np.sum(X_t)]
+	X_t = np.where(np.isin(np.arange(len(X_t)), support), X_t, 0)
+
+	guess = detect_cycle(df, X_t, support, t_window)
+	if guess is None:
+		return None
+
+	X, T = guess
+	X, T, M, converged = shoot(model, df, X, T, support)
+	if not converged:
+		return None
+
+	#One multiplier is always 1, along the orbit
+	multipliers = np.abs(np.linalg.eigvals(M))
+	floquet = np.delete(multipliers, np.argmin(np.abs(multipliers - 1)))
+	floquet = float(np.max(floquet)) if len(floquet) > 0 else 0.0
+	if floquet >= 1:
+		return None
+
+	_, mean, _, X_min, X_max = flow(model, df, X, T, support)
+	n_S = model.S_genotypes
+
+	return {'period': float(T), 'amplitude': X_max - X_min, 'S': mean[:n_S], 'I': mean[n_S:],
+		'floquet': floquet, 'stable': True, 'converged': True}
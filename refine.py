@@ -0,0 +1,180 @@
+import numpy as np
+
+from model import Model
+from utilities import raster_slopes
+
+def outcomes(store, cells, tol=1e-2, eig_tol=1e-8):
+	'''
+	Classify the outcome of solved raster cells, so that neighbouring cells can be compared.
+	Two cells have the same outcome if the general and specific resistance alleles are in the
+	same state (lost, polymorphic or fixed), the transitivity slope has the same sign and the
+	equilibria are either both stable or both unstable.
+
+	Args:
+		store: RasterStore containing the solved cells
+		cells: Raster indices of the cells [n, 2]
+		tol: Allele frequency below which an allele is considered lost (or fixed above 1 - tol)
+		eig_tol: Largest real part counted as negative, so that neutral directions (e.g. a fixed
+			linkage modifier with equal recombination rates) do not flip the stability at random
+
+	Returns:
+		codes: Integer outcome code of each cell [n]
+	'''
+
+	i, j = cells[:, 0], cells[:, 1]
+	S = np.array(store.S[i, j])
+	I = np.array(store.I[i, j])
+	eigs = np.array(store.eigs[i, j])
+
+	G = Model(**store.params).G
+	freqs = (S / np.sum(S, axis=1)[:, None]) @ G
+
+	#Allele states, 0 lost, 1 polymorphic, 2 fixed
+	states = (freqs[:, 1:3] > tol).astype(int) + (freqs[:, 1:3] > 1 - tol)
+
+	#Transitivity slope sign, only defined with general resistance polymorphism
+	slopes = np.zeros(len(cells))
+	polymorphic = states[:, 0] == 1
+	slopes[polymorphic] = raster_slopes(store.params, store.var_1, store.x_vals, store.var_2, store.y_vals,
+		S[polymorphic], I[polymorphic], cells[polymorphic])
+
+	#Stability, ignoring the last eigenvalue which corresponds to the foreign pathogen
+	stable = np.all(np.real(eigs[:, :-1]) < eig_tol, axis=1)
+
+	return states[:, 0] + 3*states[:, 1] + 9*(np.sign(slopes).astype(int) + 1) + 27*stable
+
+def grid_lines(n, stride):
+	'''
+	Indices of the coarse grid lines along an axis of length n, always including both ends
+
+	Args:
+		n: Number of cells along the axis
+		stride: Spacing between grid lines
+
+	Returns:
+		lines: Sorted indices of the grid lines
+	'''
+
+	return np.unique(np.append(np.arange(0, n, stride), n - 1))
+
+def adaptive_raster(store, solve, coarse=17):
+	'''
+	Fill a raster store by adaptive (quadtree) refinement. The raster is first solved on a
+	coarse grid, then every block whose corners disagree on the outcome is split into four
+	and its new corners solved, until blocks are a single cell wide. Blocks whose corners
+	agree are filled by interpolating between their corners, so the store ends up as a
+	dense raster that the figure scripts can use directly. Cells that were actually solved
+	are recorded in the store's solved mask.
+
+	Cells that are already done in the store are reused, so an interrupted refinement can be
+	resumed.
+
+	Args:
+		store: RasterStore opened for writing
+		solve: Function taking a list of (i, js) row tasks and yielding (i, js, results) tuples
+		coarse: Approximate number of grid lines along each axis for the initial grid
+
+	Returns:
+		n_solved: Number of cells that were solved
+	'''
+
+	if np.all(store.done):
+		return 0
+
+	n_x, n_y = store.shape
+	stride_x = max(1, 2**int(np.floor(np.log2(max(1, (n_x - 1) / (coarse - 1))))))
+	stride_y = max(1, 2**int(np.floor(np.log2(max(1, (n_y - 1) / (coarse - 1))))))
+
+	lines_x = grid_lines(n_x, stride_x)
+	lines_y = grid_lines(n_y, stride_y)
+
+	codes = {}
+
+	def solve_cells(cells):
+		#Solve the cells that are not yet in the store, row by row
+		cells = sorted(set(cells))
+		todo = [(i, j) for i, j in cells if not store.done[i, j]]
+
+		rows = {}
+		for i, j in todo:
+			rows.setdefault(i, []).append(j)
+
+		for i, js, results in solve([(i, np.array(js)) for i, js in rows.items()]):
+			store.write(i, js, results)
+
+		new = [cell for cell in cells if cell not in codes]
+		if len(new) > 0:
+			for cell, code in zip(new, outcomes(store, np.array(new))):
+				codes[cell] = code
+
+	#Blocks are given by the indices of their corners (i_0, i_1, j_0, j_1)
+	blocks = [(i_0, i_1, j_0, j_1) for i_0, i_1 in zip(lines_x[:-1], lines_x[1:])
+		for j_0, j_1 in zip(lines_y[:-1], lines_y[1:])]
+	if n_x == 1 or n_y == 1:
+		blocks = [(0, n_x - 1, 0, n_y - 1)]
+
+	uniform = []
+	while len(blocks) > 0:
+		solve_cells([corner for block in blocks for corner in corners(block)])
+
+		split = []
+		for block in blocks:
+			i_0, i_1, j_0, j_1 = block
+			if len(set(codes[corner] for corner in corners(block))) == 1:
+				uniform.append(block)
+			elif i_1 - i_0 > 1 or j_1 - j_0 > 1:
+				split.extend(subdivide(block))
+
+		blocks = split
+
+	#Fill unsolved cells of uniform blocks, abundances are interpolated bilinearly between the
+	#corners and eigenvalues are taken from the nearest corner
+	solved = np.array(store.done)
+	for i_0, i_1, j_0, j_1 in uniform:
+		ii, jj = np.meshgrid(np.arange(i_0, i_1 + 1), np.arange(j_0, j_1 + 1), indexing='ij')
+		fill = ~solved[ii, jj]
+		ii, jj = ii[fill], jj[fill]
+
+		u = ((ii - i_0) / max(1, i_1 - i_0))[:, None]
+		w = ((jj - j_0) / max(1, j_1 - j_0))[:, None]
+		for field in ('S', 'I'):
+			arr = getattr(store, field)
+			arr[ii, jj] = (1-u)*(1-w)*arr[i_0, j_0] + (1-u)*w*arr[i_0, j_1] + \
+				u*(1-w)*arr[i_1, j_0] + u*w*arr[i_1, j_1]
+
+		near_i = np.where(ii - i_0 <= i_1 - ii, i_0, i_1)
+		near_j = np.where(jj - j_0 <= j_1 - jj, j_0, j_1)
+		store.eigs[ii, jj] = store.eigs[near_i, near_j]
+
+	for field in store.fields:
+		getattr(store, field).flush()
+
+	store.set_solved(solved)
+	store.done[:] = True
+	store.done.flush()
+
+	return int(np.sum(solved))
+
+def corners(block):
+	i_0, i_1, j_0, j_1 = block
+	return [(i_0, j_0), (i_0, j_1), (i_1, j_0), (i_1, j_1)]
+
+def subdivide(block):
+	'''
+	Split a block into (up to) four, along each axis that is more than one cell wide
+
+	Args:
+		block: Corner indices (i_0, i_1, j_0, j_1)
+
+	Returns:
+		blocks: List of sub-blocks
+	'''
+
+	i_0, i_1, j_0, j_1 = block
+	i_m = (i_0 + i_1) // 2
+	j_m = (j_0 + j_1) // 2
+
+	spans_i = [(i_0, i_m), (i_m, i_1)] if i_1 - i_0 > 1 else [(i_0, i_1)]
+	spans_j = [(j_0, j_m), (j_m, j_1)] if j_1 - j_0 > 1 else [(j_0, j_1)]
+
+	return [(a, b, c, d) for a, b in spans_i for c, d in spans_j]
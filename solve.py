@@ -1,48 +1,180 @@
+import os
+import time
+import itertools
 import numpy as np
-from scipy.integrate import solve_ivp
-from scipy.optimize import root, approx_fprime
+from scipy import sparse
+from scipy.integrate import solve_ivp, RK23, RK45, DOP853, Radau, BDF, LSODA
+from scipy.optimize import root
 
-def get_sol(model, af_S, af_I, t=(0,5000), init_hosts=400, init_inf=10):
+#Numba is optional, the compiled right hand side is used when it is installed unless the
+#GFG_BACKEND environment variable is set to numpy
+try:
+	import numba
+except ImportError:
+	numba = None
+
+#Implicit solve_ivp methods that make use of a supplied Jacobian
+STIFF_METHODS = ('Radau', 'BDF', 'LSODA')
+
+#Solver classes behind the solve_ivp methods, for integrations that are stepped by hand
+solvers = {'RK23': RK23, 'RK45': RK45, 'DOP853': DOP853, 'Radau': Radau, 'BDF': BDF, 'LSODA': LSODA}
+
+if numba is not None:
+	@numba.njit(cache=True)
+	def df_kernel(X, C, B, M, k, mu, n_S, CS):
+		'''
+		Compiled right hand side of the ODE system for a dense mating matrix, births are
+		accumulated directly from S without forming the parental pair frequencies
+
+		Args:
+			X: State vector, host abundances followed by infected abundances
+			C: Cost vector
+			B: Transmission matrix
+			M: Mating matrix
+			k: Coefficient of density-dependent growth
+			mu: Deathrate
+			n_S: Number of host genotypes
+			CS: Scratch buffer of length n_S for the cost weighted abundances
+
+		Returns:
+			X_out: Time derivative of the state
+		'''
+
+		n_X = X.shape[0]
+		n_I = n_X - n_S
+		X_out = np.zeros(n_X)
+
+		S_tot = 0.0
+		for i in range(n_S):
+			S_tot += X[i]
+		N = S_tot
+		for l in range(n_I):
+			N += X[n_S + l]
+
+		for i in range(n_S):
+			CS[i] = C[i]*X[i]
+
+		#Births, sum(S) * sum_ij C[i] f[i] f[j] M[ij,k] = sum_ij C[i] S[i] S[j] M[ij,k] / sum(S)
+		for i in range(n_S):
+			for j in range(n_S):
+				w = CS[i]*X[j]/S_tot
+				if w != 0.0:
+					row = i*n_S + j
+					for o in range(n_S):
+						X_out[o] += w*M[row, o]
+
+		#Deaths and infection of hosts, and growth of infections
+		for i in range(n_S):
+			BI = 0.0
+			for l in range(n_I):
+				BI += B[i, l]*X[n_S + l]
+			X_out[i] -= X[i]*(k*N + mu + BI/N)
+
+		for l in range(n_I):
+			BS = 0.0
+			for i in range(n_S):
+				BS += B[i, l]*X[i]
+			X_out[n_S + l] = X[n_S + l]*(BS/N - mu)
+
+		return X_out
+
+def compiled_df(model):
 	'''
-	Compute the equilibrium of the ODE system for the three locus, three pathogen genotype model
+	Build the compiled right hand side of the ODE system for a model, if numba is available
+	and the mating matrix is dense
 
 	Args:
 		model: Model class instance
-		af_S: Initial allele frequencies for each of the three host allele
-		af_I: Initial frequency of the Avir pathogen genotype
-		t: Time range used for initial guess, used so that solution is interior equilibrium
-		init_hosts: Initial susceptible host abundance
-		init_inf: Initial infected host abundance
 
 	Returns:
-		S: Solution for susceptible host abundances [genotype, time]
-		I: Solution for infected host abundances [genotype, time]
-		eigs: Eigenvalues of the system at equilibrium
+		df: Function of (t, X) returning the time derivative, or None if unavailable
 	'''
 
+	if numba is None or os.environ.get('GFG_BACKEND') == 'numpy' or sparse.issparse(model.M):
+		return None
+
+	C = np.ascontiguousarray(model.C, dtype=float)
+	B = np.ascontiguousarray(model.B, dtype=float)
+	M = np.ascontiguousarray(model.M, dtype=float)
+	k = float(model.k)
+	mu = float(model.mu)
+	n_S = model.S_genotypes
+	CS = np.zeros(n_S)
+
+	def df(t, X):
+		return df_kernel(X, C, B, M, k, mu, n_S, CS)
+
+	return df
+
+def make_df(model):
+	'''
+	Build the right hand side of the ODE system for a model. The compiled kernel is used when
+	available, otherwise a NumPy closure that reuses preallocated buffers for the parental pair
+	frequencies, births and infection rates, and computes sum(S) and N once per evaluation.
+
+	The derivative itself is returned in a new array on every call, as solve_ivp keeps
+	references to the derivatives it is given.
+
+	Args:
+		model: Model class instance
+
+	Returns:
+		df: Function of (t, X) returning the time derivative
+	'''
+
+	compiled = compiled_df(model)
+	if compiled is not None:
+		return compiled
+
+	n_S = model.S_genotypes
+	C, B, M, k, mu = model.C, model.B, model.M, model.k, model.mu
+	dense = not sparse.issparse(M)
+
+	pair_freq = np.empty((n_S, n_S))
+	births = np.empty(n_S)
+	BI = np.empty(B.shape[0])
+	BS = np.empty(B.shape[1])
+
 	def df(t, X):
 		#Seperate out uninfected and infected hosts
-		S = X[:model.S_genotypes]
-		I = X[model.S_genotypes:]
+		S = X[:n_S]
+		I = X[n_S:]
 
-		N = np.sum(S) + np.sum(I)
- 
-		#Get the frequency of each genotype
-		genotype_freq = S / np.sum(S)
+		S_tot = np.sum(S)
+		N = S_tot + np.sum(I)
 
-		#Get parental pair frequencies and adjust by fecundity costs
-		pair_freq = np.outer(model.C*genotype_freq, genotype_freq).flatten()
+		#Parental pairs weighted by fecundity costs, sum(S) * outer(C*f, f) = outer(C*S, S) / sum(S)
+		np.multiply.outer(C*S, S/S_tot, out=pair_freq)
+		if dense:
+			np.dot(pair_freq.reshape(-1), M, out=births)
+		else:
+			births[:] = M.T @ pair_freq.reshape(-1)
 
-		dS = np.sum(S)*np.dot(pair_freq, model.M) - \
-			S*(model.k*N + model.mu + np.dot(model.B, I)/N)
-		dI = I*(np.dot(model.B.T, S)/N - model.mu)
+		np.dot(B, I, out=BI)
+		np.dot(B.T, S, out=BS)
 
-		X_out = np.append(dS, dI)
+		X_out = np.empty(len(X))
+		np.subtract(births, S*(k*N + mu + BI/N), out=X_out[:n_S])
+		np.multiply(I, BS/N - mu, out=X_out[n_S:])
 
 		return X_out
 
-	def pass_to_df(X):
-		return df(None, X)
+	return df
+
+def initial_state(model, af_S, af_I, init_hosts=400, init_inf=10):
+	'''
+	Build the initial state vector from host allele frequencies and the Avr frequency
+
+	Args:
+		model: Model class instance
+		af_S: Initial allele frequencies for each of the three host allele
+		af_I: Initial frequency of the Avir pathogen genotype
+		init_hosts: Initial susceptible host abundance
+		init_inf: Initial infected host abundance
+
+	Returns:
+		X_0: Initial state, host abundances followed by infected abundances
+	'''
 
 	#Assign host genotype ICs based on allele frequencies
 	S_0 = np.ones(model.S_genotypes)		
@@ -51,62 +183,482 @@ def get_sol(model, af_S, af_I, t=(0,5000), init_hosts=400, init_inf=10):
 		S_0[model.G[:,i] == 1] = S_0[model.G[:,i] == 1] * (af_S[i])
 	
 	#Assign infected ICs based on Avr frequency
-	I_0 = np.zeros(3)
+	I_0 = np.zeros(model.I_genotypes)
 	I_0[0] = af_I
 	I_0[1] = 1 - af_I
 
-	X_0 = np.append(S_0 * init_hosts, I_0 * init_inf)
-	sol = solve_ivp(df, t, X_0, method='DOP853')
-	eq = root(pass_to_df, sol.y[:,-1], tol=1e-10)
+	return np.append(S_0 * init_hosts, I_0 * init_inf)
+
+def jacobian(model, X):
+	'''
+	Closed form Jacobian of the ODE system, built from the model's C, B and M
+
+	Args:
+		model: Model class instance
+		X: State vector, host abundances followed by infected abundances
+
+	Returns:
+		J: Jacobian matrix, J[i,j] is the derivative of dX[i] with respect to X[j]
+	'''
+
+	n_S = model.S_genotypes
+
+	S = X[:n_S]
+	I = X[n_S:]
+
+	S_tot = np.sum(S)
+	N = S_tot + np.sum(I)
+
+	BI = np.dot(model.B, I)
+	BS = np.dot(model.B.T, S)
+
+	#Births are Q / sum(S), with Q[k] = sum_ij C[i] S[i] S[j] M[ij,k]
+	CS = model.C*S
+	if sparse.issparse(model.M):
+		#Accumulate over the nonzero (parental, maternal, offspring) triples only
+		M = model.M.tocoo()
+		i, j = np.divmod(M.row, n_S)
+		k = M.col
+
+		Q = np.bincount(k, weights=CS[i]*S[j]*M.data, minlength=n_S)
+		dQ = np.bincount(k*n_S + i, weights=model.C[i]*S[j]*M.data, minlength=n_S**2) + \
+			np.bincount(k*n_S + j, weights=CS[i]*M.data, minlength=n_S**2)
+		dQ = dQ.reshape((n_S, n_S))
+	else:
+		M = model.M.reshape((n_S, n_S, n_S))
+		Q = np.einsum('i,j,ijk->k', CS, S, M)
+		dQ = model.C[None, :]*np.einsum('j,mjk->km', S, M) + np.einsum('i,imk->km', CS, M)
+
+	J = np.zeros((len(X), len(X)))
+
+	#Host rows
+	J[:n_S, :n_S] = dQ/S_tot - Q[:, None]/S_tot**2 - np.diag(model.k*N + model.mu + BI/N) - \
+		(S*(model.k - BI/N**2))[:, None]
+	J[:n_S, n_S:] = -S[:, None]*(model.k + model.B/N - (BI/N**2)[:, None])
+
+	#Infected rows
+	J[n_S:, :n_S] = I[:, None]*(model.B.T/N - (BS/N**2)[:, None])
+	J[n_S:, n_S:] = np.diag(BS/N - model.mu) - (I*BS/N**2)[:, None]
+
+	return J
+
+def find_root(model, X, df):
+	'''
+	Find the equilibrium closest to an approximate one with a root finder, using the
+	analytic Jacobian, and compute its eigenvalues
+
+	Args:
+		model: Model class instance
+		X: Initial guess for the equilibrium
+		df: Right hand side of the ODE system, as a function of (t, X)
+
+	Returns:
+		eq: Result of the root finder, eq.x is the equilibrium and eq.success its status
+		eigs: Eigenvalues of the system at eq.x
+	'''
+
+	def pass_to_df(X):
+		return df(None, X)
+
+	def pass_to_jac(X):
+		return jacobian(model, X)
+
+	eq = root(pass_to_df, X, jac=pass_to_jac, tol=1e-10)
+	eigs = np.linalg.eigvals(jacobian(model, eq.x))
+
+	return eq, eigs
+
+def polish(model, X, df):
+	'''
+	Refine an approximate equilibrium with a root finder and compute its eigenvalues
+
+	Args:
+		model: Model class instance
+		X: Approximate equilibrium, e.g. the end point of a simulation
+		df: Right hand side of the ODE system, as a function of (t, X)
+
+	Returns:
+		S: Equilibrium susceptible host abundances
+		I: Equilibrium infected host abundances
+		eigs: Eigenvalues of the system at equilibrium
+	'''
+
+	eq, eigs = find_root(model, X, df)
 
 	S = eq.x[:model.S_genotypes]
 	I = eq.x[model.S_genotypes:]
-	eigs = np.linalg.eig(approx_fprime(eq.x, pass_to_df))[0]
 	
 	if not eq.success:
 		print(eq.message)
 
 	return S, I, eigs
 
-def run_sim(model, S_0, I_0, t=(0,5000)):
+def steady_rate(X, dX):
 	'''
-	Run ODE simulation for three locus, three pathogen genotype model, used to get solution trajectories
+	Relative rate of change of a state, used to detect that a trajectory has settled
+
+	Args:
+		X: State vector, or a stack of them [n, S + I]
+		dX: Time derivative of the state
+
+	Returns:
+		rate: Norm of dX over the norm of X
+	'''
+
+	return np.linalg.norm(dX, axis=-1) / np.linalg.norm(X, axis=-1)
+
+def is_stable_root(model, eq, support, eig_tol=1e-8):
+	'''
+	Check that a root is a feasible equilibrium that is stable within the subspace of genotypes
+	present initially. Genotypes that are absent stay absent, e.g. the foreign pathogen, so their
+	eigenvalues do not affect the dynamics.
+
+	Args:
+		model: Model class instance
+		eq: Result of the root finder
+		support: Boolean mask of the genotypes present initially
+		eig_tol: Largest real part counted as negative
+
+	Returns:
+		True if the trajectory can be handed off to this equilibrium
+	'''
+
+	if not eq.success or np.min(eq.x) < -1e-6:
+		return False
+
+	J = jacobian(model, eq.x)[np.ix_(support, support)]
+	return bool(np.all(np.real(np.linalg.eigvals(J)) < eig_tol))
+
+def oscillatory(eigs, eig_tol=1e-8):
+	'''
+	Check whether an equilibrium is unstable with a complex pair of eigenvalues, so that nearby
+	trajectories spiral away from it, the evidence used for sustained oscillations
+
+	Args:
+		eigs: Eigenvalues at the equilibrium, the last one belonging to the foreign pathogen
+		eig_tol: Tolerance on the real and imaginary parts
+
+	Returns:
+		True if there is an unstable complex pair
+	'''
+
+	eigs = np.asarray(eigs)[:-1]
+	return bool(np.any((np.real(eigs) > eig_tol) & (np.abs(np.imag(eigs)) > eig_tol)))
+
+def root_info(eq, eigs, df):
+	'''
+	Diagnostics of a root solve, recorded in the status dictionaries of the solvers
+
+	Args:
+		eq: Result of the root finder
+		eigs: Eigenvalues at eq.x
+		df: Right hand side of the ODE system, as a function of (t, X)
+
+	Returns:
+		info: Dictionary with the number of function evaluations of the root finder (root_iter),
+			its success flag, the norm of the residual at eq.x and the largest real part of the
+			eigenvalues, ignoring the foreign pathogen as check_stab does
+	'''
+
+	return {'root_iter': int(eq.nfev), 'root_success': bool(eq.success),
+		'residual': float(np.linalg.norm(df(None, eq.x))), 'max_eig': float(np.max(np.real(eigs[:-1])))}
+
+def count_calls(df):
+	'''
+	Wrap a right hand side so that its evaluations are counted in df.n_calls
+	'''
+
+	def counted(t, X):
+		counted.n_calls += 1
+		return df(t, X)
+
+	counted.n_calls = 0
+	return counted
+
+def get_sol(model, af_S, af_I, t=(0,5000), init_hosts=400, init_inf=10, method='DOP853',
+	steady_tol=1e-5, window=100, t_max=10000, rtol=1e-6, atol=1e-9, info=False):
+	'''
+	Compute the equilibrium of the ODE system for the three locus, three pathogen genotype model
+
+	The integration stops early once the relative rate of change (steady_rate) has stayed below
+	steady_tol for a time window and the root finder, started from the current state, converges
+	to a stable equilibrium. Runs that have not settled by the end of t, e.g. slow or sustained
+	oscillations, are extended up to t_max and flagged as reached_t_max if they still have not
+	settled, and as cycling if in addition the equilibrium they end near is oscillatory.
 
 	Args:
 		model: Model class instance
 		af_S: Initial allele frequencies for each of the three host allele
 		af_I: Initial frequency of the Avir pathogen genotype
+		t: Time range used for initial guess, used so that solution is interior equilibrium
+		init_hosts: Initial susceptible host abundance
+		init_inf: Initial infected host abundance
+		method: Integration method passed to solve_ivp, stiff methods use the analytic Jacobian
+		steady_tol: Relative rate of change below which the state counts as steady, None to always
+			integrate over the whole of t
+		window: Time the state has to stay steady before the root finder is tried
+		t_max: End time for runs that are still changing at the end of t, the end of t if None
+		rtol: Relative tolerance passed to the solver, tight enough that the numerical solution
+			settles at a stable equilibrium rather than wandering within the tolerance
+		atol: Absolute tolerance passed to the solver
+		info: Also return a dictionary with the end time of the integration, the steady,
+			reached_t_max and cycling flags and the cost of the solve: right hand side evaluations (n_rhs), solver
+			steps (n_steps), wall time and the root finder diagnostics of root_info
 
 	Returns:
-		sol.t: Time points corresponding to the solution
 		S: Solution for susceptible host abundances [genotype, time]
 		I: Solution for infected host abundances [genotype, time]
+		eigs: Eigenvalues of the system at equilibrium
+		status: Only if info is set, dictionary with t_end, steady, reached_t_max, cycling, n_rhs,
+			n_steps, wall
+			and the entries of root_info
 	'''
-	def df(t, X):
-		#Seperate out uninfected and infected hosts
-		S = X[:model.S_genotypes]
-		I = X[model.S_genotypes:]
 
-		N = np.sum(S) + np.sum(I)
- 
-		#Get the frequency of each genotype
-		genotype_freq = S / np.sum(S)
+	start = time.perf_counter()
+	df = make_df(model)
+	X_0 = initial_state(model, af_S, af_I, init_hosts, init_inf)
 
-		#Get parental pair frequencies and adjust by fecundity costs
-		pair_freq = np.outer(model.C*genotype_freq, genotype_freq).flatten()
+	options = {}
+	if method in STIFF_METHODS:
+		options['jac'] = lambda t, X: jacobian(model, X)
 
-		dS = np.sum(S)*np.dot(pair_freq, model.M) - \
-			S*(model.k*N + model.mu + np.dot(model.B, I)/N)
-		dI = I*(np.dot(model.B.T, S)/N - model.mu)
+	if steady_tol is None:
+		sol = solve_ivp(df, t, X_0, method=method, rtol=rtol, atol=atol, **options)
+		if not info:
+			return polish(model, sol.y[:,-1], df)
 
-		X_out = np.append(dS, dI)
+		eq, eigs = find_root(model, sol.y[:,-1], df)
+		if not eq.success:
+			print(eq.message)
 
-		return X_out
+		status = {'t_end': sol.t[-1], 'steady': False, 'reached_t_max': False, 'cycling': False, 'n_rhs': sol.nfev,
+			'n_steps': len(sol.t) - 1, 'wall': time.perf_counter() - start, **root_info(eq, eigs, df)}
+
+		return eq.x[:model.S_genotypes], eq.x[model.S_genotypes:], eigs, status
+
+	if t_max is None:
+		t_max = t[1]
+
+	solver = solvers[method](df, t[0], X_0, t_max, rtol=rtol, atol=atol, **options)
+	support = X_0 > 0
+
+	eq = None
+	t_steady = None
+	n_steps, root_iter = 0, 0
+	while solver.status == 'running':
+		message = solver.step()
+		n_steps += 1
+
+		#Fall back to the fixed time range with the default tolerances of solve_ivp
+		if solver.status == 'failed':
+			print(message)
+			return get_sol(model, af_S, af_I, t, init_hosts, init_inf, method, steady_tol=None,
+				rtol=1e-3, atol=1e-6, info=info)
+
+		if steady_rate(solver.y, df(solver.t, solver.y)) >= steady_tol:
+			t_steady = None
+		elif t_steady is None:
+			t_steady = solver.t
+		elif solver.t - t_steady >= window:
+			#Hand off to the root finder, and keep integrating for another window if it fails
+			eq, eigs = find_root(model, solver.y, df)
+			root_iter += eq.nfev
+			if is_stable_root(model, eq, support):
+				break
+			eq, t_steady = None, solver.t
+
+	steady = eq is not None
+	if not steady:
+		eq, eigs = find_root(model, solver.y, df)
+		root_iter += eq.nfev
+		if not eq.success:
+			print(eq.message)
+
+	S = eq.x[:model.S_genotypes]
+	I = eq.x[model.S_genotypes:]
+	if not info:
+		return S, I, eigs
+
+	#The steady check evaluates the right hand side once per step on top of the solver's own calls
+	reached = not steady and solver.t >= t_max
+	status = {'t_end': solver.t, 'steady': steady, 'reached_t_max': reached, 'cycling': reached and oscillatory(eigs),
+		'n_rhs': solver.nfev + n_steps, 'n_steps': n_steps, 'wall': time.perf_counter() - start,
+		**root_info(eq, eigs, df), 'root_iter': root_iter}
+
+	return S, I, eigs, status
+
+def pseudo_transient(model, df, X_0, keep, dt=1, max_iter=500, tol=1e-10):
+	'''
+	Pseudo-transient continuation towards an equilibrium: damped Newton steps
+	(I/dt - J) dX = df(X), with dt growing as the residual falls, so the iteration follows the
+	dynamics while far from equilibrium and becomes Newton's method close to it. Steps that make
+	abundances negative are retried with a smaller dt.
+
+	Args:
+		model: Model class instance
+		df: Right hand side of the ODE system, as a function of (t, X)
+		X_0: Starting state
+		keep: Boolean mask of the genotypes solved for, the others are held at zero
+		dt: Initial pseudo time step
+		max_iter: Maximum number of iterations
+		tol: Residual, relative to the norm of the state, at which the iteration has converged
+
+	Returns:
+		X: Final state
+		converged: Whether the residual fell below tol
+		n_iter: Number of iterations
+	'''
+
+	idx = np.flatnonzero(keep)
+	hosts = idx < model.S_genotypes
+
+	X = np.zeros(len(X_0))
+	def residual(x):
+		X[idx] = x
+		return df(None, X)[idx]
+
+	x = np.array(X_0, dtype=float)[idx]
+	f = residual(x)
+	r = np.linalg.norm(f)
+
+	for n_iter in range(1, max_iter + 1):
+		X[idx] = x
+		J = jacobian(model, X)[np.ix_(idx, idx)]
+		x_new = x + np.linalg.solve(np.eye(len(idx))/dt - J, f)
+
+		if np.min(x_new) < -1e-9*np.sum(x) or np.sum(x_new[hosts]) <= 0:
+			dt /= 4
+			continue
+
+		x_new = np.maximum(x_new, 0)
+		f_new = residual(x_new)
+		r_new = np.linalg.norm(f_new)
+
+		#Switched evolution relaxation, the step grows as the residual shrinks
+		dt = min(dt*r/max(r_new, 1e-300), 1e12)
+		x, f, r = x_new, f_new, r_new
+
+		if r < tol*np.linalg.norm(x):
+			break
+
+	X[idx] = x
+	return X.copy(), r < tol*np.linalg.norm(x), n_iter
+
+def direct_sol(model, af_S, af_I, init_hosts=400, init_inf=10, fallback=True, info=False, t=(0,5000)):
+	'''
+	Compute the equilibrium without integrating the ODE system over time. At equilibrium each
+	pathogen genotype is either absent or has B.T @ S / N = mu, so the presence patterns of the
+	initially present pathogen genotypes are tried in turn, from all present down to none. For
+	each pattern the reduced system is solved by pseudo-transient continuation from the initial
+	state, and the first equilibrium that is stable, including against invasion by the absent
+	pathogens, is returned. If no pattern gives one, e.g. because the system cycles around an
+	unstable equilibrium, get_sol is used instead.
+
+	Args:
+		model: Model class instance
+		af_S: Initial allele frequencies for each of the three host allele
+		af_I: Initial frequency of the Avir pathogen genotype
+		init_hosts: Initial susceptible host abundance
+		init_inf: Initial infected host abundance
+		fallback: Whether to fall back to get_sol, if False None is returned instead
+		info: Also return a status dictionary as get_sol does, n_steps counting the pseudo-transient
+			iterations over all patterns tried
+		t: Time range passed to get_sol when falling back to it
+
+	Returns:
+		S: Equilibrium susceptible host abundances
+		I: Equilibrium infected host abundances
+		eigs: Eigenvalues of the system at equilibrium
+		status: Only if info is set, dictionary with the entries of get_sol's status
+	'''
+
+	start = time.perf_counter()
+	df = count_calls(make_df(model))
+	n_S = model.S_genotypes
+
+	X_0 = initial_state(model, af_S, af_I, init_hosts, init_inf)
+	support = X_0 > 0
+	present = np.flatnonzero(support[n_S:])
+
+	n_steps, root_iter = 0, 0
+	for n in range(len(present), -1, -1):
+		for pattern in itertools.combinations(present, n):
+			keep = support.copy()
+			keep[n_S:] = False
+			keep[n_S + np.array(pattern, dtype=int)] = True
+
+			X, converged, n_iter = pseudo_transient(model, df, X_0, keep)
+			n_steps += n_iter
+			if not converged:
+				continue
+
+			eq, eigs = find_root(model, X, df)
+			root_iter += eq.nfev
+			if not is_stable_root(model, eq, support):
+				continue
+
+			if not info:
+				return eq.x[:n_S], eq.x[n_S:], eigs
+
+			status = {'t_end': 0, 'steady': True, 'reached_t_max': False, 'cycling': False, 'n_rhs': df.n_calls,
+				'n_steps': n_steps, 'wall': time.perf_counter() - start, **root_info(eq, eigs, df),
+				'root_iter': root_iter}
+			return eq.x[:n_S], eq.x[n_S:], eigs, status
+
+	if fallback:
+		result = get_sol(model, af_S, af_I, t, init_hosts, init_inf, info=info)
+		if info:
+			#The cost of the patterns tried first is included
+			status = result[3]
+			status['n_rhs'] += df.n_calls
+			status['n_steps'] += n_steps
+			status['root_iter'] += root_iter
+			status['wall'] = time.perf_counter() - start
+		return result
+
+def run_sim(model, S_0, I_0, t=(0,5000), method='DOP853', t_eval=None, n_points=None, max_step=None,
+	rtol=1e-3, atol=1e-6):
+	'''
+	Run ODE simulation for three locus, three pathogen genotype model, used to get solution trajectories
+
+	By default every internal step is returned, with the step size limited to 0.5 so that the
+	trajectory is finely resolved. If an output grid is given with t_eval or n_points, the solution
+	is only evaluated there from the solver's dense output, so the step size is set by the
+	tolerances alone and the memory used does not grow with the length of the time range.
+
+	Args:
+		model: Model class instance
+		S_0: Initial susceptible host abundances
+		I_0: Initial infected host abundances
+		t: Time range to integrate over
+		method: Integration method passed to solve_ivp, stiff methods use the analytic Jacobian
+		t_eval: Times at which to return the solution
+		n_points: Number of evenly spaced times over t at which to return the solution, if t_eval is None
+		max_step: Maximum step size, 0.5 if no output grid is given and unlimited otherwise
+		rtol: Relative tolerance passed to solve_ivp
+		atol: Absolute tolerance passed to solve_ivp
+
+	Returns:
+		sol.t: Time points corresponding to the solution
+		S: Solution for susceptible host abundances [genotype, time]
+		I: Solution for infected host abundances [genotype, time]
+	'''
+
+	df = make_df(model)
+
+	if t_eval is None and n_points is not None:
+		t_eval = np.linspace(t[0], t[1], n_points)
+	if max_step is None:
+		max_step = 0.5 if t_eval is None else np.inf
+
+	options = {'method': method, 't_eval': t_eval, 'max_step': max_step, 'rtol': rtol, 'atol': atol}
+	if method in STIFF_METHODS:
+		options['jac'] = lambda t, X: jacobian(model, X)
 
 	X_0 = np.append(S_0, I_0)
-	sol = solve_ivp(df, t, X_0, method='DOP853', max_step=0.5)
+	sol = solve_ivp(df, t, X_0, **options)
 
 	S = sol.y[:model.S_genotypes, :]
 	I = sol.y[model.S_genotypes:, :]
 
-	return sol.t, S, I
\ No newline at end of file
+	return sol.t, S, I
@@ -0,0 +1,285 @@
+import numpy as np
+from scipy import sparse
+
+from solve import initial_state
+from batch import stack_models
+
+'''
+Stochastic simulations of the model, for the demographic noise that decides the fate of rare
+alleles and pathogens at low abundance. Individuals are counted as integers and the rates of
+the ODE system are turned into events: births of each host genotype (from the mating matrix
+and fecundity costs), deaths of susceptible hosts at rate k*N + mu, infection of a susceptible
+host of genotype i by pathogen genotype j at rate B[i,j]*I[j]/N, moving it into I[j], and deaths
+of infected hosts at rate mu.
+
+Time is advanced by tau-leaping with a fixed step, with rates taken at the deterministic
+midpoint of the step. Births are Poisson distributed, and losses are binomial (each individual
+leaves its class with probability 1 - exp(-hazard*tau), split between death and the pathogen
+genotypes in proportion to their hazards), so abundances can never become negative whatever the
+step. Mean abundances match the ODE system to second order in tau. Replicates, and replicates of
+several models, are stacked into one array and advanced together.
+
+By default all replicates of a stack share one random generator, which is fastest but makes a
+replicate's trajectory depend on the replicates stacked with it. With independent streams the
+replicates are split into blocks of consecutive replicates, each drawing from its own generator
+spawned from the seed, so a block can be reproduced whatever it is stacked with. Each block is
+drawn in one call per step, so the cost grows with the number of blocks: one block per model is
+as fast as a shared generator, while a block per replicate (block=1) is about 30x slower for
+1000 replicates.
+'''
+
+class ReplicateStreams:
+	'''
+	Random draws with one generator per block of consecutive replicates, each block drawing the
+	rows of the arrays it owns in one call
+	'''
+
+	def __init__(self, seeds, size):
+		self.rngs = [np.random.default_rng(seed) for seed in seeds]
+		self.size = size
+
+	def blocks(self):
+		return [(rng, slice(b*self.size, (b + 1)*self.size)) for b, rng in enumerate(self.rngs)]
+
+	def poisson(self, lam):
+		return np.concatenate([rng.poisson(lam[rows]) for rng, rows in self.blocks()])
+
+	def binomial(self, n, p):
+		out = np.zeros(np.shape(n), dtype=np.int64)
+		for rng, rows in self.blocks():
+			out[rows] = binomial(rng, n[rows], p[rows])
+		return out
+
+def binomial(rng, n, p):
+	#Binomial draws, skipping the (often many) entries with no individuals or zero probability,
+	#block by block for independent streams
+	if isinstance(rng, ReplicateStreams):
+		return rng.binomial(n, p)
+
+	out = np.zeros(np.shape(n), dtype=np.int64)
+	draw = (n > 0) & (p > 0)
+	out[draw] = rng.binomial(n[draw], p[draw])
+	return out
+
+def tau_leap(params, S_0, I_0, t=(0,500), tau=0.1, seed=None, idx=None, G=None, t_eval=None, block=None):
+	'''
+	Advance a stack of replicates by tau-leaping
+
+	Args:
+		params: Stacked model parameters from batch.stack_models
+		S_0: Initial susceptible host counts [n, S_genotypes]
+		I_0: Initial infected host counts [n, I_genotypes]
+		t: Time range
+		tau: Time step
+		seed: Seed, SeedSequence or Generator for the random draws, shared by all replicates so
+			that a run is reproducible for the same seed and stack of replicates, or a list of
+			seeds giving each block of replicates its own stream, reproducible whatever it is
+			stacked with
+		idx: Index of the model of each replicate into params, replicate i uses model i if None
+		G: Genotype matrix [S_genotypes, n_loci], to record the time each host allele is lost
+		t_eval: Times at which to record the counts, none if None
+		block: Number of consecutive replicates drawn from each seed of a list, the replicates
+			split evenly between the seeds if None
+
+	Returns:
+		result: Dictionary with the final counts S [n, S_genotypes] and I [n, I_genotypes], the
+			time each pathogen genotype went extinct t_extinct [n, I_genotypes] (inf if it did
+			not), with G the times host alleles were lost t_lost and fixed t_fixed [n, n_loci],
+			and with t_eval the recorded times t and counts S_t [n_t, n, S_genotypes] and I_t
+	'''
+
+	S = np.rint(np.asarray(S_0, dtype=float)).astype(np.int64)
+	I = np.rint(np.asarray(I_0, dtype=float)).astype(np.int64)
+	n, n_S = S.shape
+
+	if isinstance(seed, (list, tuple)):
+		rng = ReplicateStreams(seed, block or -(-n // len(seed)))
+	else:
+		rng = np.random.default_rng(seed)
+	idx = np.arange(n) if idx is None else np.asarray(idx)
+
+	C, B = params['C'][idx], params['B'][idx]
+	k, mu = params['k'][idx], params['mu'][idx]
+	M = params['M'] if params['M'].ndim == 2 else params['M'][idx]
+
+	t_cur = float(t[0])
+	n_steps = int(np.ceil((t[1] - t[0]) / tau - 1e-9))
+
+	t_extinct = np.where(I == 0, t_cur, np.inf)
+	if G is not None:
+		carriers = S @ G
+		t_lost = np.where(carriers == 0, t_cur, np.inf)
+		t_fixed = np.where(carriers == S.sum(axis=1)[:, None], t_cur, np.inf)
+
+	if t_eval is not None:
+		t_eval = np.asarray(t_eval, dtype=float)
+		S_t = np.zeros((len(t_eval),) + S.shape, dtype=np.int64)
+		I_t = np.zeros((len(t_eval),) + I.shape, dtype=np.int64)
+		n_done = np.searchsorted(t_eval, t_cur, side='right')
+		S_t[:n_done], I_t[:n_done] = S, I
+
+	def rates(S, I):
+		#Birth rates of each genotype and per individual hazards of susceptible hosts, of death and
+		#of infection by each pathogen, as in the ODE system
+		S_tot = S.sum(axis=1)
+		N = np.maximum(S_tot + I.sum(axis=1), 1e-300)
+
+		f = S / np.maximum(S_tot, 1e-300)[:, None]
+		pair = ((C*S)[:, :, None] * f[:, None, :]).reshape(n, -1)
+		if sparse.issparse(M):
+			births = (M.T @ pair.T).T
+		elif M.ndim == 2:
+			births = pair @ M
+		else:
+			births = np.einsum('np,npk->nk', pair, M)
+
+		death = np.broadcast_to((k*N + mu)[:, None], (n, n_S))
+		infection = B * (I / N[:, None])[:, None, :]
+
+		return np.maximum(births, 0), death, infection
+
+	for step in range(n_steps):
+		dt = min(tau, t[1] - t_cur)
+
+		#Rates are taken at the deterministic midpoint of the step (midpoint tau-leaping), which
+		#keeps the mean second order accurate in tau
+		births, death, infection = rates(S, I)
+		S_mid = np.maximum(S + dt/2*(births - S*(death + infection.sum(axis=2))), 0)
+		I_mid = np.maximum(I + dt/2*(np.einsum('ni,nij->nj', S, infection) - mu[:, None]*I), 0)
+		births, death, infection = rates(S_mid, I_mid)
+		total = death + infection.sum(axis=2)
+
+		#Individuals born (or infected) during the step are exposed to their hazards for half of
+		#it on average
+		n_births = rng.poisson(births*dt)
+		n_out = binomial(rng, S, -np.expm1(-total*dt)) + binomial(rng, n_births, -np.expm1(-total*dt/2))
+
+		#Split the hosts leaving each class between the pathogens by conditional binomial draws,
+		#the remainder die
+		n_inf = np.zeros_like(I)
+		remaining, left = n_out, total
+		for j in np.flatnonzero(np.any(I > 0, axis=0)):
+			n_j = binomial(rng, remaining, infection[:, :, j] / np.maximum(left, 1e-300))
+			n_inf[:, j] = n_j.sum(axis=1)
+			remaining, left = remaining - n_j, left - infection[:, :, j]
+
+		mu_I = np.broadcast_to(mu[:, None], I.shape)
+		n_Ideath = binomial(rng, I, -np.expm1(-mu_I*dt)) + binomial(rng, n_inf, -np.expm1(-mu_I*dt/2))
+
+		S = S + n_births - n_out
+		I = I + n_inf - n_Ideath
+		t_cur = t[0] + (step + 1)*tau if step < n_steps - 1 else float(t[1])
+
+		#Extinction is absorbing, as there is no mutation
+		t_extinct = np.where((I == 0) & np.isinf(t_extinct), t_cur, t_extinct)
+		if G is not None:
+			carriers = S @ G
+			t_lost = np.where((carriers == 0) & np.isinf(t_lost), t_cur, t_lost)
+			t_fixed = np.where((carriers == S.sum(axis=1)[:, None]) & np.isinf(t_fixed), t_cur, t_fixed)
+
+		if t_eval is not None:
+			n_new = np.searchsorted(t_eval, t_cur + 1e-9*tau, side='right')
+			S_t[n_done:n_new], I_t[n_done:n_new] = S, I
+			n_done = n_new
+
+	result = {'S': S, 'I': I, 't_extinct': t_extinct}
+	if G is not None:
+		result['t_lost'] = t_lost
+		result['t_fixed'] = t_fixed
+	if t_eval is not None:
+		result['t'] = t_eval
+		result['S_t'] = S_t
+		result['I_t'] = I_t
+
+	return result
+
+def run_stochastic(model, S_0, I_0, n_reps=1000, t=(0,500), tau=0.1, seed=None, t_eval=None, n_points=None,
+	independent=False, block=100):
+	'''
+	Run replicate stochastic simulations of a model from the same initial counts, the stochastic
+	counterpart of run_sim
+
+	Args:
+		model: Model class instance
+		S_0: Initial susceptible host counts, rounded to integers
+		I_0: Initial infected host counts, rounded to integers
+		n_reps: Number of replicates
+		t: Time range
+		tau: Time step
+		seed: Seed of the random draws
+		t_eval: Times at which to record the counts
+		n_points: Number of evenly spaced times over t at which to record the counts, if t_eval is None
+		independent: Give each block of replicates its own stream, block b being drawn from
+			SeedSequence(seed).spawn(n_blocks)[b]
+		block: Number of consecutive replicates sharing a stream when independent is set, 1 to
+			give every replicate its own, which is about 30x slower than a shared generator for
+			1000 replicates as each block is drawn in a separate call
+
+	Returns:
+		result: Dictionary as returned by tau_leap, with host allele loss and fixation times
+	'''
+
+	if t_eval is None and n_points is not None:
+		t_eval = np.linspace(t[0], t[1], n_points)
+
+	params = stack_models([model])
+	S_0 = np.tile(np.asarray(S_0, dtype=float), (n_reps, 1))
+	I_0 = np.tile(np.asarray(I_0, dtype=float), (n_reps, 1))
+
+	if independent:
+		seed = np.random.SeedSequence(seed).spawn(-(-n_reps // block))
+
+	return tau_leap(params, S_0, I_0, t, tau, seed, np.zeros(n_reps, dtype=int), model.G, t_eval, block)
+
+def extinction_probability(models, af_S, af_I, n_reps=1000, t=(0,500), tau=0.1, init_hosts=400,
+	init_inf=10, seed=None, max_rows=200000, independent=False):
+	'''
+	Probabilities that pathogen genotypes go extinct and host alleles are lost or fixed by the end
+	of t, for each of many models (e.g. the cells of a raster), starting from the initial state
+	get_sol uses. Replicates of many models are simulated together, at most max_rows at a time.
+
+	Args:
+		models: List of Model class instances with the same number of genotypes
+		af_S: Initial allele frequencies for each host locus
+		af_I: Initial frequency of the Avr pathogen genotype
+		n_reps: Number of replicates per model
+		t: Time range
+		tau: Time step
+		init_hosts: Initial susceptible host abundance
+		init_inf: Initial infected host abundance
+		seed: Seed of the random draws, each block of models gets an independent child seed
+		max_rows: Largest number of replicates simulated at once
+		independent: Give the replicates of each model their own stream, spawned from seed by model
+			index, so results do not depend on how the models are split into blocks. As the
+			replicates of a model are drawn together, this costs about as much as a shared stream
+
+	Returns:
+		probs: Dictionary with the probabilities of pathogen extinction 'extinct' [n_models,
+			I_genotypes], and host allele loss 'lost' and fixation 'fixed' [n_models, n_loci]
+	'''
+
+	per_block = max(1, max_rows // n_reps)
+	blocks = [list(range(start, min(start + per_block, len(models)))) for start in range(0, len(models), per_block)]
+	if independent:
+		streams = np.random.SeedSequence(seed).spawn(len(models))
+		seeds = [[streams[m] for m in block] for block in blocks]
+	else:
+		seeds = np.random.SeedSequence(seed).spawn(len(blocks))
+
+	probs = {'extinct': [], 'lost': [], 'fixed': []}
+	for block, block_seed in zip(blocks, seeds):
+		block_models = [models[i] for i in block]
+		params = stack_models(block_models)
+
+		X_0 = np.stack([initial_state(model, af_S, af_I, init_hosts, init_inf) for model in block_models])
+		idx = np.repeat(np.arange(len(block)), n_reps)
+		n_S = params['nS']
+
+		result = tau_leap(params, X_0[idx, :n_S], X_0[idx, n_S:], t, tau, block_seed, idx, models[0].G, block=n_reps)
+
+		#Replicates are grouped by model, so averaging over the second axis gives per model probabilities
+		for key, field in (('extinct', 't_extinct'), ('lost', 't_lost'), ('fixed', 't_fixed')):
+			ended = np.isfinite(result[field]).reshape(len(block), n_reps, -1)
+			probs[key].append(ended.mean(axis=1))
+
+	return {key: np.concatenate(value) for key, value in probs.items()}
@@ -0,0 +1,482 @@
+import os
+import json
+import pickle as pkl
+import numpy as np
+
+from model import Model
+from sweep import Sweep, set_param
+
+#Per-cell solver telemetry, from the status dictionaries of the solvers (see get_sol)
+STATS_DTYPE = np.dtype([('n_rhs', np.int64), ('n_steps', np.int64), ('wall', float), ('root_iter', np.int64),
+	('root_success', bool), ('residual', float), ('max_eig', float), ('steady', bool), ('cached', bool),
+	('reached_t_max', bool), ('cycling', bool)])
+
+def stats_record(status, dtype=STATS_DTYPE):
+	'''
+	Convert a solver status dictionary into a record of STATS_DTYPE, missing entries are zero
+
+	Args:
+		status: Status dictionary, or None for cells solved without telemetry
+		dtype: Record dtype, that of the stats field for stores created with fewer fields
+
+	Returns:
+		record: Tuple of the dtype's fields
+	'''
+
+	status = status or {}
+	return tuple(status.get(name, 0) for name in dtype.names)
+
+def orbit_dtype(n_S, n_I):
+	'''
+	Record of the limit cycle of a cell (see periodic_sol), a period of zero meaning the cell
+	does not oscillate or was not checked
+
+	Args:
+		n_S: Number of host genotypes
+		n_I: Number of pathogen genotypes
+
+	Returns:
+		dtype: Structured dtype with the period, amplitude, cycle averages S and I, the largest
+			Floquet multiplier, and the stable and converged flags
+	'''
+
+	return np.dtype([('period', float), ('amplitude', float, (n_S + n_I,)), ('S', float, (n_S,)),
+		('I', float, (n_I,)), ('floquet', float), ('stable', bool), ('converged', bool)])
+
+def orbit_record(orbit):
+	#Convert an orbit dictionary from periodic_sol into a record of orbit_dtype
+	return (orbit['period'], orbit['amplitude'], orbit['S'], orbit['I'], orbit['floquet'],
+		orbit['stable'], orbit['converged'])
+
+def orbit_dict(record):
+	#Inverse of orbit_record, None for cells without a limit cycle
+	if record['period'] <= 0:
+		return None
+	return {name: record[name].copy() if record[name].ndim > 0 else record[name].item() for name in record.dtype.names}
+
+class RasterStore:
+	'''
+	On-disk store for a raster of equilibria. Each field is a .npy file that is memory mapped,
+	so cells can be written as they finish and read back without loading the whole raster:
+
+		meta.json	Scenario, swept parameters and their values, base parameters and initial conditions
+		S.npy		Susceptible host abundances [n_x, n_y, S_genotypes]
+		I.npy		Infected host abundances [n_x, n_y, I_genotypes]
+		eigs.npy	Eigenvalues at equilibrium [n_x, n_y, S_genotypes + I_genotypes]
+		done.npy	Completion flag for each cell [n_x, n_y]
+		stats.npy	Solver telemetry of each cell, records of STATS_DTYPE [n_x, n_y]
+		orbit.npy	Limit cycle of each oscillating cell, records of orbit_dtype [n_x, n_y]
+		solved.npy	Optional, cells that were solved rather than filled by adaptive refinement [n_x, n_y]
+
+	The completion flags are only set once the results of a cell have been flushed, so an
+	interrupted run can be resumed from the cells that are not done.
+	'''
+
+	fields = ('S', 'I', 'eigs')
+
+	def __init__(self, path, mode='r'):
+		self.path = path
+
+		with open(os.path.join(path, 'meta.json'), 'r') as f:
+			self.meta = json.load(f)
+
+		self.var_1 = self.meta['var_1']
+		self.var_2 = self.meta['var_2']
+		self.x_vals = np.array(self.meta['axes'][self.var_1])
+		self.y_vals = np.array(self.meta['axes'][self.var_2])
+		self.params = self.meta['params']
+
+		for field in self.fields + ('done',):
+			setattr(self, field, np.load(os.path.join(path, field + '.npy'), mmap_mode=mode))
+
+		solved_path = os.path.join(path, 'solved.npy')
+		self.solved = np.load(solved_path) if os.path.exists(solved_path) else None
+
+		self.stats = load_stats(path, mode)
+		self.orbit = load_optional(path, 'orbit', mode)
+
+	@classmethod
+	def create(cls, path, var_1, x_vals, var_2, y_vals, params, S_init, I_init, scenario=None):
+		'''
+		Create an empty store for a raster over two parameters
+
+		Args:
+			path: Directory of the store
+			var_1: Parameter varied along the first axis
+			x_vals: Values of the first parameter
+			var_2: Parameter varied along the second axis
+			y_vals: Values of the second parameter
+			params: Base parameters of the Model, the swept parameters are overwritten per cell
+			S_init: Initial host allele frequencies
+			I_init: Initial proportion of the Avr pathogen genotype
+			scenario: Name of the scenario in rasters.json
+
+		Returns:
+			store: RasterStore opened for writing
+		'''
+
+		model = Model(**params)
+		n_x, n_y = len(x_vals), len(y_vals)
+		n_S, n_I = model.S_genotypes, model.I_genotypes
+
+		shapes = {'S': ((n_x, n_y, n_S), float), 'I': ((n_x, n_y, n_I), float),
+			'eigs': ((n_x, n_y, n_S + n_I), complex), 'done': ((n_x, n_y), bool), 'stats': ((n_x, n_y), STATS_DTYPE),
+			'orbit': ((n_x, n_y), orbit_dtype(n_S, n_I))}
+
+		meta = {'scenario': scenario, 'var_1': var_1, 'var_2': var_2,
+			'axes': {var_1: [float(x) for x in x_vals], var_2: [float(y) for y in y_vals]},
+			'params': params, 'S_init': S_init, 'I_init': I_init}
+
+		create_fields(path, shapes, meta)
+
+		return cls(path, mode='r+')
+
+	@classmethod
+	def open_or_create(cls, path, var_1, x_vals, var_2, y_vals, params, S_init, I_init, scenario=None):
+		'''
+		Open an existing store to resume it, or create it if it does not exist yet. An existing
+		store must have been created with the same axes, parameters and initial conditions.
+
+		Returns:
+			store: RasterStore opened for writing
+		'''
+
+		if not os.path.exists(os.path.join(path, 'meta.json')):
+			return cls.create(path, var_1, x_vals, var_2, y_vals, params, S_init, I_init, scenario)
+
+		store = cls(path, mode='r+')
+		same = store.var_1 == var_1 and store.var_2 == var_2 and \
+			np.array_equal(store.x_vals, x_vals) and np.array_equal(store.y_vals, y_vals) and \
+			store.params == params and store.meta['S_init'] == S_init and store.meta['I_init'] == I_init
+
+		if not same:
+			raise ValueError('%s was created with different settings, remove it to start over' % path)
+
+		return store
+
+	@property
+	def shape(self):
+		return self.done.shape
+
+	def cell_params(self, i, j):
+		'''
+		Model parameters of a particular raster cell
+
+		Args:
+			i: Index along the first axis
+			j: Index along the second axis
+
+		Returns:
+			params: Dictionary of parameters for Model
+		'''
+
+		params = set_param(self.params, self.var_1, self.x_vals[i])
+		return set_param(params, self.var_2, self.y_vals[j])
+
+	def pending(self):
+		'''
+		Cells that still need to be computed, grouped by row
+
+		Returns:
+			rows: List of (i, js) tuples, js being the indices of unfinished cells in row i
+		'''
+
+		rows = []
+		for i in range(self.shape[0]):
+			js = np.flatnonzero(~self.done[i])
+			if len(js) > 0:
+				rows.append((i, js))
+
+		return rows
+
+	def write(self, i, js, results):
+		'''
+		Write the results of a chunk of cells in one row and mark them as done
+
+		Args:
+			i: Row index
+			js: Column indices of the cells
+			results: List of (S, I, eigs) or (S, I, eigs, status) tuples in the same order as js,
+				the status dictionaries are recorded in stats, and their limit cycles (the 'orbit'
+				entry, if any) in orbit
+		'''
+
+		for j, result in zip(js, results):
+			self.S[i, j], self.I[i, j], self.eigs[i, j] = result[:3]
+			if self.stats is not None and len(result) > 3:
+				self.stats[i, j] = stats_record(result[3], self.stats.dtype)
+			if self.orbit is not None and len(result) > 3 and result[3].get('orbit') is not None:
+				self.orbit[i, j] = orbit_record(result[3]['orbit'])
+
+		for field in self.fields + ('stats', 'orbit'):
+			if getattr(self, field) is not None:
+				getattr(self, field).flush()
+
+		self.done[i, js] = True
+		self.done.flush()
+
+	def set_solved(self, solved):
+		'''
+		Record which cells were solved, for rasters where the remaining cells were filled in
+
+		Args:
+			solved: Boolean mask of solved cells [n_x, n_y]
+		'''
+
+		self.solved = np.array(solved, dtype=bool)
+		np.save(os.path.join(self.path, 'solved.npy'), self.solved)
+
+	def oriented(self, var_1, var_2):
+		'''
+		Views of the raster with the first axis along var_1 and the second along var_2,
+		transposing (without copying) if the store was generated with the axes swapped
+
+		Args:
+			var_1: Parameter for the first axis
+			var_2: Parameter for the second axis
+
+		Returns:
+			x_vals: Values of var_1
+			y_vals: Values of var_2
+			arrays: Dictionary of S, I, eigs and done arrays oriented as [var_1, var_2, ...], and
+				of orbit for stores that record limit cycles
+		'''
+
+		arrays = {field: getattr(self, field) for field in self.fields + ('done',)}
+		if self.orbit is not None:
+			arrays['orbit'] = self.orbit
+
+		if (var_1, var_2) == (self.var_1, self.var_2):
+			return self.x_vals, self.y_vals, arrays
+		elif (var_1, var_2) == (self.var_2, self.var_1):
+			arrays = {field: np.swapaxes(arr, 0, 1) for field, arr in arrays.items()}
+			return self.y_vals, self.x_vals, arrays
+		else:
+			raise ValueError('%s is a raster over %s and %s, not %s and %s' % 
+				(self.path, self.var_1, self.var_2, var_1, var_2))
+
+class SweepStore:
+	'''
+	On-disk store for the equilibria of a sweep (see sweep.py), laid out like a RasterStore but
+	with one flat index over the points of the sweep:
+
+		meta.json	Scenario, sweep definition and initial conditions
+		S.npy		Susceptible host abundances [n, S_genotypes]
+		I.npy		Infected host abundances [n, I_genotypes]
+		eigs.npy	Eigenvalues at equilibrium [n, S_genotypes + I_genotypes]
+		done.npy	Completion flag for each point [n]
+		stats.npy	Solver telemetry of each point, records of STATS_DTYPE [n]
+		orbit.npy	Limit cycle of each oscillating point, records of orbit_dtype [n]
+
+	The swept parameters must leave the number of genotypes unchanged.
+	'''
+
+	fields = ('S', 'I', 'eigs')
+
+	def __init__(self, path, mode='r'):
+		self.path = path
+
+		with open(os.path.join(path, 'meta.json'), 'r') as f:
+			self.meta = json.load(f)
+
+		self.sweep = Sweep.from_dict(self.meta['sweep'])
+
+		for field in self.fields + ('done',):
+			setattr(self, field, np.load(os.path.join(path, field + '.npy'), mmap_mode=mode))
+
+		self.stats = load_stats(path, mode)
+		self.orbit = load_optional(path, 'orbit', mode)
+
+	@classmethod
+	def create(cls, path, sweep, S_init, I_init, scenario=None):
+		'''
+		Create an empty store for a sweep
+
+		Args:
+			path: Directory of the store
+			sweep: Sweep instance
+			S_init: Initial host allele frequencies
+			I_init: Initial proportion of the Avr pathogen genotype
+			scenario: Name of the scenario in rasters.json
+
+		Returns:
+			store: SweepStore opened for writing
+		'''
+
+		model = Model(**sweep.cell_params(0))
+		n, n_S, n_I = len(sweep), model.S_genotypes, model.I_genotypes
+
+		shapes = {'S': ((n, n_S), float), 'I': ((n, n_I), float),
+			'eigs': ((n, n_S + n_I), complex), 'done': ((n,), bool), 'stats': ((n,), STATS_DTYPE),
+			'orbit': ((n,), orbit_dtype(n_S, n_I))}
+		meta = {'scenario': scenario, 'sweep': sweep.to_dict(), 'S_init': S_init, 'I_init': I_init}
+
+		create_fields(path, shapes, meta)
+
+		return cls(path, mode='r+')
+
+	@classmethod
+	def open_or_create(cls, path, sweep, S_init, I_init, scenario=None):
+		'''
+		Open an existing store to resume it, or create it if it does not exist yet. An existing
+		store must have been created for the same sweep and initial conditions.
+
+		Returns:
+			store: SweepStore opened for writing
+		'''
+
+		if not os.path.exists(os.path.join(path, 'meta.json')):
+			return cls.create(path, sweep, S_init, I_init, scenario)
+
+		store = cls(path, mode='r+')
+		same = store.meta['sweep'] == json.loads(json.dumps(sweep.to_dict())) and \
+			store.meta['S_init'] == S_init and store.meta['I_init'] == I_init
+
+		if not same:
+			raise ValueError('%s was created with different settings, remove it to start over' % path)
+
+		return store
+
+	def pending(self):
+		'''
+		Points that still need to be computed
+
+		Returns:
+			ks: Flat indices of the unfinished points
+		'''
+
+		return np.flatnonzero(~self.done)
+
+	def write(self, ks, results):
+		'''
+		Write the results of a set of points and mark them as done
+
+		Args:
+			ks: Flat indices of the points
+			results: List of (S, I, eigs) or (S, I, eigs, status) tuples in the same order as ks
+		'''
+
+		for k, result in zip(ks, results):
+			self.S[k], self.I[k], self.eigs[k] = result[:3]
+			if self.stats is not None and len(result) > 3:
+				self.stats[k] = stats_record(result[3], self.stats.dtype)
+			if self.orbit is not None and len(result) > 3 and result[3].get('orbit') is not None:
+				self.orbit[k] = orbit_record(result[3]['orbit'])
+
+		for field in self.fields + ('stats', 'orbit'):
+			if getattr(self, field) is not None:
+				getattr(self, field).flush()
+
+		self.done[ks] = True
+		self.done.flush()
+
+	def grid(self, field):
+		'''
+		View of a field with one axis per swept parameter, for grid sweeps
+
+		Args:
+			field: One of S, I, eigs, done, stats or orbit
+
+		Returns:
+			arr: Field reshaped to the grid shape followed by the field's own axes
+		'''
+
+		if self.sweep.axes is None:
+			raise ValueError('%s is a sampled sweep, not a grid' % self.path)
+
+		arr = getattr(self, field)
+		return arr.reshape(self.sweep.shape + arr.shape[1:])
+
+def load_stats(path, mode='r'):
+	#Stores created before telemetry was recorded have no stats field
+	return load_optional(path, 'stats', mode)
+
+def load_optional(path, field, mode='r'):
+	#Fields added after a store was created (e.g. stats or orbit) are None for older stores
+	field_path = os.path.join(path, field + '.npy')
+	return np.load(field_path, mmap_mode=mode) if os.path.exists(field_path) else None
+
+def create_fields(path, shapes, meta):
+	'''
+	Create the memory mapped fields and metadata of a store
+
+	Args:
+		path: Directory of the store
+		shapes: Dictionary mapping field names to (shape, dtype)
+		meta: Metadata written to meta.json
+	'''
+
+	os.makedirs(path, exist_ok=True)
+
+	for field, (shape, dtype) in shapes.items():
+		arr = np.lib.format.open_memmap(os.path.join(path, field + '.npy'), mode='w+', dtype=dtype, shape=shape)
+		arr.flush()
+		del arr
+
+	#Metadata is written last so a half created store is never mistaken for a valid one
+	with open(os.path.join(path, 'meta.json'), 'w') as f:
+		json.dump(meta, f, indent=4)
+
+def store_path(filename):
+	'''
+	Location of the raster store for an output filename from rasters.json, e.g.
+	./data/cov_gs.p is stored in the directory ./data/cov_gs
+
+	Args:
+		filename: Output filename of a raster scenario
+
+	Returns:
+		path: Directory of the raster store
+	'''
+
+	return os.path.splitext(filename)[0]
+
+def is_store(path):
+	'''
+	Check whether a raster filename or directory refers to a raster store
+
+	Args:
+		path: Raster filename or store directory
+
+	Returns:
+		True if a store exists for the path
+	'''
+
+	return os.path.exists(os.path.join(store_path(path), 'meta.json'))
+
+def from_pickle(path, var_1, var_2):
+	'''
+	Convert a [models, results] pickle written by earlier versions of gen_raster into a raster
+	store next to it, so it can be memory mapped from then on
+
+	Args:
+		path: Filename of the pickle
+		var_1: Parameter varied along the first axis
+		var_2: Parameter varied along the second axis
+
+	Returns:
+		store: RasterStore of the converted raster
+	'''
+
+	with open(path, 'rb') as f:
+		models, data = pkl.load(f)
+
+	x_vals = np.unique([getattr(model, var_1) for model in models])
+	y_vals = np.unique([getattr(model, var_2) for model in models])
+
+	#Parameters are the plain attributes of the model, without the derived matrices
+	derived = ('C', 'B', 'M', 'G', 'S_genotypes')
+	params = {key: np.asarray(value).tolist() for key, value in vars(models[0]).items() if key not in derived}
+
+	store = RasterStore.create(store_path(path), var_1, x_vals, var_2, y_vals, params, None, None)
+
+	for model, (S, I, eigs) in zip(models, data):
+		i = np.searchsorted(x_vals, getattr(model, var_1))
+		j = np.searchsorted(y_vals, getattr(model, var_2))
+		store.S[i, j], store.I[i, j], store.eigs[i, j] = S, I, eigs
+		store.done[i, j] = True
+
+	for field in store.fields + ('done',):
+		getattr(store, field).flush()
+
+	return RasterStore(store_path(path))
@@ -0,0 +1,227 @@
+import numpy as np
+
+from model import collapse_locus
+from solve import make_df, jacobian, solvers, STIFF_METHODS
+from utilities import trans_slopes
+
+'''
+Streaming simulations, for runs that are too long to keep the whole state history. stream_sim
+steps the solver itself and yields the trajectory in chunks, and reduce_sim passes each chunk
+through observables (functions of the state) and reducers (which combine the observable over
+time), so only the reduced results are kept.
+'''
+
+def stream_sim(model, S_0, I_0, t=(0,5000), method='DOP853', t_eval=None, n_points=None, max_step=None,
+	rtol=1e-3, atol=1e-6, chunk=1000):
+	'''
+	Run an ODE simulation as in run_sim, yielding the trajectory in chunks as it is computed.
+	Output times follow run_sim, every solver step by default or the points of an output grid.
+
+	Args:
+		model: Model class instance
+		S_0: Initial susceptible host abundances
+		I_0: Initial infected host abundances
+		t: Time range to integrate over
+		method: Integration method, one of the solve_ivp methods
+		t_eval: Times at which to return the solution
+		n_points: Number of evenly spaced times over t at which to return the solution, if t_eval is None
+		max_step: Maximum step size, 0.5 if no output grid is given and unlimited otherwise
+		rtol: Relative tolerance of the solver
+		atol: Absolute tolerance of the solver
+		chunk: Number of time points in each chunk
+
+	Yields:
+		t: Time points of the chunk
+		S: Susceptible host abundances [genotype, time]
+		I: Infected host abundances [genotype, time]
+	'''
+
+	if t_eval is None and n_points is not None:
+		t_eval = np.linspace(t[0], t[1], n_points)
+	if max_step is None:
+		max_step = 0.5 if t_eval is None else np.inf
+
+	options = {'max_step': max_step, 'rtol': rtol, 'atol': atol}
+	if method in STIFF_METHODS:
+		options['jac'] = lambda t, X: jacobian(model, X)
+
+	X_0 = np.append(S_0, I_0).astype(float)
+	solver = solvers[method](make_df(model), t[0], X_0, t[1], **options)
+	n_S = model.S_genotypes
+
+	times, states = [], []
+
+	def flush():
+		t_out, X = np.array(times), np.array(states).T
+		times.clear()
+		states.clear()
+		return t_out, X[:n_S], X[n_S:]
+
+	#Without an output grid the initial state is returned as well, as solve_ivp does
+	if t_eval is None:
+		times.append(t[0])
+		states.append(X_0)
+	else:
+		t_eval = np.asarray(t_eval, dtype=float)
+		n_done = 0
+
+	while solver.status == 'running':
+		message = solver.step()
+
+		if solver.status == 'failed':
+			print(message)
+			break
+
+		if t_eval is None:
+			times.append(solver.t)
+			states.append(solver.y.copy())
+		else:
+			#Grid points passed in this step are taken from the step's dense output
+			n_new = np.searchsorted(t_eval, solver.t, side='right')
+			if n_new > n_done:
+				sol = solver.dense_output()
+				for t_i in t_eval[n_done:n_new]:
+					times.append(t_i)
+					states.append(sol(t_i))
+				n_done = n_new
+
+		if len(times) >= chunk:
+			yield flush()
+
+	if len(times) > 0:
+		yield flush()
+
+observables = {}
+
+def register_observable(name, func):
+	'''
+	Register a function of the state that can be computed by reduce_sim
+
+	Args:
+		name: Name of the observable
+		func: Function of (model, t, S, I) for a chunk of the trajectory, returning an array
+			with time along the last axis
+	'''
+
+	observables[name] = func
+
+def allele_freqs(model, t, S, I):
+	#Frequency of the 1 allele at each host locus [locus, time]
+	return (model.G.T @ S) / np.sum(S, axis=0)
+
+def collapsed(model, t, S, I):
+	#Host abundances with the linkage modifier locus collapsed [genotype, time]
+	return collapse_locus(model, S, 0)[0]
+
+def trans_slope(model, t, S, I):
+	#Transitivity slope [time]
+	return trans_slopes(model, S.T, I.T)
+
+register_observable('S', lambda model, t, S, I: S)
+register_observable('I', lambda model, t, S, I: I)
+register_observable('allele_freqs', allele_freqs)
+register_observable('collapsed', collapsed)
+register_observable('trans_slope', trans_slope)
+
+class Series:
+	'''
+	Keeps the observable at every stride-th time point
+	'''
+
+	def __init__(self, stride=1):
+		self.stride = stride
+		self.n = 0
+		self.t, self.values = [], []
+
+	def update(self, t, values):
+		keep = (self.n + np.arange(len(t))) % self.stride == 0
+		self.t.append(t[keep])
+		self.values.append(values[..., keep])
+		self.n += len(t)
+
+	def result(self):
+		return np.concatenate(self.t), np.concatenate(self.values, axis=-1)
+
+class Last:
+	'''
+	Keeps the observable at the last time point
+	'''
+
+	def __init__(self):
+		self.value = None
+
+	def update(self, t, values):
+		self.value = values[..., -1]
+
+	def result(self):
+		return self.value
+
+class Mean:
+	'''
+	Time average of the observable, integrating with the trapezoidal rule
+	'''
+
+	def __init__(self):
+		self.total = 0
+		self.prev = None
+		self.t_start = None
+
+	def update(self, t, values):
+		#Carry the last point of the previous chunk so the chunks join up
+		if self.prev is not None:
+			t = np.append(self.prev[0], t)
+			values = np.concatenate([self.prev[1][..., None], values], axis=-1)
+		else:
+			self.t_start = t[0]
+
+		self.total = self.total + np.sum(np.diff(t)*(values[..., 1:] + values[..., :-1])/2, axis=-1)
+		self.prev = (t[-1], values[..., -1])
+
+	def result(self):
+		duration = self.prev[0] - self.t_start
+		return self.total / duration if duration > 0 else self.prev[1]
+
+class Extrema:
+	'''
+	Minimum and maximum of the observable over time
+	'''
+
+	def __init__(self):
+		self.low = None
+		self.high = None
+
+	def update(self, t, values):
+		low = np.min(values, axis=-1)
+		high = np.max(values, axis=-1)
+		self.low = low if self.low is None else np.minimum(self.low, low)
+		self.high = high if self.high is None else np.maximum(self.high, high)
+
+	def result(self):
+		return self.low, self.high
+
+def reduce_sim(model, S_0, I_0, reducers, **kwargs):
+	'''
+	Run a streaming simulation and reduce each chunk as it arrives, so that only the reduced
+	observables are held in memory
+
+	Args:
+		model: Model class instance
+		S_0: Initial susceptible host abundances
+		I_0: Initial infected host abundances
+		reducers: Dictionary mapping observable names to reducer instances (Series, Last, Mean,
+			Extrema or any object with update(t, values) and result() methods)
+		**kwargs: Options passed to stream_sim
+
+	Returns:
+		results: Dictionary mapping observable names to the results of their reducers
+	'''
+
+	for name in reducers:
+		if name not in observables:
+			raise ValueError('Unknown observable %s, expected one of %s' % (name, ', '.join(observables)))
+
+	for t, S, I in stream_sim(model, S_0, I_0, **kwargs):
+		for name, reducer in reducers.items():
+			reducer.update(t, observables[name](model, t, S, I))
+
+	return {name: reducer.result() for name, reducer in reducers.items()}
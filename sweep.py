@@ -0,0 +1,328 @@
+import re
+import json
+import argparse
+import numpy as np
+from scipy.stats import qmc
+
+from model import Model
+
+'''
+Parameter sweeps over any Model attribute. A sweep is either a grid, the product of the values
+along each axis, or a set of sampled points (Latin hypercube or Sobol) over a box of ranges.
+Parameters are given by name, and components of list parameters by index, e.g. 'rho[0]'.
+Every point of a sweep has a flat index, which is how points are stored and handed to workers.
+'''
+
+#Ranges used for parameters that a scenario does not give a range for
+DEFAULT_RANGES = {'c_g': [0, 0.2], 'c_s': [0, 0.4], 'v': [0, 0.3]}
+
+def parse_name(name):
+	'''
+	Split a parameter name into the Model attribute and an optional component index
+
+	Args:
+		name: Parameter name, e.g. 'c_g' or 'rho[0]'
+
+	Returns:
+		attr: Model attribute
+		index: Component index, or None for the whole attribute
+	'''
+
+	match = re.fullmatch(r'(\w+)(?:\[(\d+)\])?', name)
+	if match is None or not hasattr(Model(), match.group(1)):
+		raise ValueError('%s is not a Model parameter' % name)
+
+	index = match.group(2)
+	return match.group(1), None if index is None else int(index)
+
+def set_param(params, name, value):
+	'''
+	Set a parameter in a copy of a parameter dictionary
+
+	Args:
+		params: Dictionary of Model parameters
+		name: Parameter name, e.g. 'c_g' or 'rho[0]'
+		value: Value of the parameter
+
+	Returns:
+		params: Dictionary with the parameter set
+	'''
+
+	attr, index = parse_name(name)
+	params = dict(params)
+
+	if isinstance(value, np.generic):
+		value = value.item()
+
+	if index is None:
+		params[attr] = value
+	else:
+		component = list(params.get(attr, getattr(Model(), attr)))
+		component[index] = value
+		params[attr] = component
+
+	return params
+
+def axis_values(name, size, ranges=None):
+	'''
+	Values of a parameter along a grid axis. A range is either [low, high], giving size evenly
+	spaced values, or a list of the values themselves, e.g. ["hard", "soft"] for sel
+
+	Args:
+		name: Parameter name
+		size: Number of values for [low, high] ranges
+		ranges: Dictionary of ranges, e.g. from rasters.json, DEFAULT_RANGES are used otherwise
+
+	Returns:
+		values: List of values
+	'''
+
+	ranges = dict(DEFAULT_RANGES, **(ranges or {}))
+	if name not in ranges:
+		raise ValueError('No range given for %s' % name)
+
+	value_range = ranges[name]
+	if len(value_range) == 2 and all(isinstance(x, (int, float)) for x in value_range):
+		return np.linspace(value_range[0], value_range[1], size).tolist()
+
+	return list(value_range)
+
+class Sweep:
+	'''
+	A set of points in parameter space, each given by the base parameters with the swept
+	parameters overwritten
+
+		names		Swept parameters
+		axes		Values along each parameter for grids, None for sampled points
+		points		Parameter values of each point [n, len(names)]
+	'''
+
+	def __init__(self, params, names, axes=None, points=None):
+		for name in names:
+			parse_name(name)
+
+		self.params = params
+		self.names = list(names)
+		self.axes = None if axes is None else [list(values) for values in axes]
+		self.points = None if points is None else np.asarray(points, dtype=float)
+
+	@classmethod
+	def grid(cls, params, axes):
+		'''
+		Sweep over the product of values along each axis
+
+		Args:
+			params: Base parameters of the Model
+			axes: Dictionary mapping parameter names to their values, in axis order
+
+		Returns:
+			sweep: Grid sweep
+		'''
+
+		return cls(params, list(axes), axes=list(axes.values()))
+
+	@classmethod
+	def sample(cls, params, ranges, n, method='lhs', seed=None):
+		'''
+		Sweep over points sampled from a box of parameter ranges
+
+		Args:
+			params: Base parameters of the Model
+			ranges: Dictionary mapping parameter names to [low, high]
+			n: Number of points, a power of 2 for Sobol sampling
+			method: 'lhs' for a Latin hypercube or 'sobol' for a scrambled Sobol sequence
+			seed: Seed of the sampler
+
+		Returns:
+			sweep: Sampled sweep
+		'''
+
+		samplers = {'lhs': qmc.LatinHypercube, 'sobol': qmc.Sobol}
+		if method not in samplers:
+			raise ValueError('Unknown sampling method %s, expected one of %s' % (method, ', '.join(samplers)))
+
+		sampler = samplers[method](d=len(ranges), seed=seed)
+		low, high = np.array(list(ranges.values()), dtype=float).T
+		points = qmc.scale(sampler.random(n), low, high)
+
+		return cls(params, list(ranges), points=points)
+
+	@classmethod
+	def from_dict(cls, data):
+		return cls(data['params'], data['names'], data.get('axes'), data.get('points'))
+
+	def to_dict(self):
+		data = {'params': self.params, 'names': self.names}
+		if self.axes is not None:
+			data['axes'] = self.axes
+		else:
+			data['points'] = self.points.tolist()
+
+		return data
+
+	@property
+	def shape(self):
+		#Grid shape, or the number of points for sampled sweeps
+		if self.axes is not None:
+			return tuple(len(values) for values in self.axes)
+		return (len(self.points),)
+
+	def __len__(self):
+		return int(np.prod(self.shape))
+
+	def values(self, k):
+		'''
+		Values of the swept parameters at a point
+
+		Args:
+			k: Flat index of the point
+
+		Returns:
+			values: List of values, in the order of names
+		'''
+
+		if self.axes is not None:
+			index = np.unravel_index(k, self.shape)
+			return [values[i] for values, i in zip(self.axes, index)]
+
+		return self.points[k].tolist()
+
+	def cell_params(self, k):
+		'''
+		Model parameters at a point
+
+		Args:
+			k: Flat index of the point
+
+		Returns:
+			params: Dictionary of parameters for Model
+		'''
+
+		params = self.params
+		for name, value in zip(self.names, self.values(k)):
+			params = set_param(params, name, value)
+
+		return params
+
+	def models(self, ks=None):
+		'''
+		Models at a set of points
+
+		Args:
+			ks: Flat indices of the points, all points if None
+
+		Returns:
+			models: List of Model class instances
+		'''
+
+		ks = range(len(self)) if ks is None else ks
+		return [Model(**self.cell_params(k)) for k in ks]
+
+def scenario_sweep(param_set, names=None, size=200, sample=None, n=None, seed=None):
+	'''
+	Sweep for a scenario from rasters.json. Ranges are taken from the scenario's optional
+	"ranges" entry, falling back to DEFAULT_RANGES, and the swept parameters default to var_1
+	and var_2
+
+	Args:
+		param_set: Scenario dictionary from rasters.json
+		names: Parameters to sweep, [var_1, var_2] if None
+		size: Number of values along each grid axis
+		sample: None for a grid, or 'lhs' or 'sobol' to sample n points
+		n: Number of sampled points
+		seed: Seed of the sampler
+
+	Returns:
+		sweep: Sweep over the scenario
+	'''
+
+	names = names or [param_set['var_1'], param_set['var_2']]
+	ranges = dict(DEFAULT_RANGES, **param_set.get('ranges', {}))
+
+	if sample is None:
+		return Sweep.grid(param_set['params'], {name: axis_values(name, size, ranges) for name in names})
+
+	missing = [name for name in names if name not in ranges]
+	if len(missing) > 0:
+		raise ValueError('No range given for %s' % ', '.join(missing))
+
+	return Sweep.sample(param_set['params'], {name: ranges[name] for name in names}, n, sample, seed)
+
+def run_sweep(sweep, store, S_init, I_init, backend='pool', workers=None, chunk=64, direct=False, cache=None, **kwargs):
+	'''
+	Solve the pending points of a sweep store with an executor, writing results as they finish
+
+	Args:
+		sweep: Sweep to solve
+		store: SweepStore for the sweep
+		S_init: Initial host allele frequencies
+		I_init: Initial proportion of the Avr pathogen genotype
+		backend: Executor backend, 'pool', 'queue' or 'serial'
+		workers: Number of worker processes
+		chunk: Maximum number of points per task
+		direct: Whether to use the direct equilibrium solver
+		cache: ResultCache shared by the workers, None to solve every point
+		**kwargs: Backend specific options, e.g. queue_dir
+
+	Returns:
+		n_solved: Number of points solved
+	'''
+
+	#Imported here so that the sweep definitions do not depend on the solvers
+	from executor import make_executor
+
+	pending = store.pending()
+	tasks = [(block, pending[start:start + chunk]) for block, start in enumerate(range(0, len(pending), chunk))]
+
+	settings = {'sweep': sweep.to_dict(), 'S_init': S_init, 'I_init': I_init, 'direct': direct}
+	if cache is not None:
+		settings['cache'] = (cache.path, cache.max_bytes)
+	executor = make_executor(backend, settings, workers, **kwargs)
+
+	try:
+		for _, ks, results in executor.map(tasks):
+			store.write(ks, results)
+	finally:
+		executor.close()
+
+	return len(pending)
+
+def main(argv=None):
+	from store import SweepStore
+	from executor import default_workers, backends
+	from cache import default_cache
+
+	parser = argparse.ArgumentParser(description='Sweep any parameters of a scenario in rasters.json')
+	parser.add_argument('scenario', help='Name of the scenario supplying base parameters and ranges')
+	parser.add_argument('names', nargs='*', help='Parameters to sweep, e.g. c_g "rho[0]" (default: var_1 var_2)')
+	parser.add_argument('--range', nargs=3, action='append', default=[], metavar=('NAME', 'LOW', 'HIGH'),
+		help='Range of a swept parameter, overriding the scenario ranges, e.g. --range "rho[0]" 0 0.5')
+	parser.add_argument('--size', type=int, default=20, help='Number of values along each grid axis')
+	parser.add_argument('--sample', choices=['lhs', 'sobol'], default=None, help='Sample points instead of a grid')
+	parser.add_argument('-n', type=int, default=1024, help='Number of sampled points')
+	parser.add_argument('--seed', type=int, default=None, help='Seed of the sampler')
+	parser.add_argument('--output', default=None, help='Store directory (default: ./data/sweeps/<scenario>_<names>)')
+	parser.add_argument('--direct', action='store_true', help='Use the direct equilibrium solver')
+	parser.add_argument('--cores', type=int, default=default_workers(), help='Number of worker processes')
+	parser.add_argument('--backend', choices=sorted(backends), default='pool', help='How tasks are run')
+	parser.add_argument('--chunk', type=int, default=64, help='Maximum number of points per task')
+	parser.add_argument('--no-cache', action='store_true', help='Solve every point instead of reusing cached results')
+	args = parser.parse_args(argv)
+
+	with open('rasters.json', 'r') as f:
+		param_set = json.load(f)[args.scenario]
+
+	ranges = dict(param_set.get('ranges', {}), **{name: [float(low), float(high)] for name, low, high in args.range})
+	param_set = dict(param_set, ranges=ranges)
+
+	sweep = scenario_sweep(param_set, args.names, args.size, args.sample, args.n, args.seed)
+	path = args.output or './data/sweeps/%s_%s' % (args.scenario, '_'.join(re.sub(r'\W', '', name) for name in sweep.names))
+
+	store = SweepStore.open_or_create(path, sweep, param_set['S_init'], param_set['I_init'], args.scenario)
+	print('%d of %d points left to compute' % (len(store.pending()), len(sweep)))
+
+	run_sweep(sweep, store, param_set['S_init'], param_set['I_init'], args.backend, args.cores, args.chunk, args.direct,
+		None if args.no_cache else default_cache())
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,166 @@
+import json
+import argparse
+import numpy as np
+
+from store import RasterStore, store_path, is_store
+
+'''
+Summary of the per-cell solver telemetry recorded in a raster store (stats.npy, see STATS_DTYPE
+in store.py). Prints where the run time went and the slowest and failed cells, and renders each
+telemetry field as a raster so expensive regions of parameter space stand out:
+
+	python telemetry.py cov_gs
+	python telemetry.py cov_gs --top 20 --output ./figures/telemetry_cov_gs.svg
+'''
+
+#Fields rendered as rasters, and whether they are shown on a log scale
+PANELS = [('wall', True), ('n_rhs', True), ('n_steps', True), ('root_iter', True), ('residual', True),
+	('max_eig', False)]
+
+def solved_cells(store):
+	'''
+	Cells with telemetry, i.e. done cells that were solved rather than filled by refinement
+
+	Args:
+		store: RasterStore with a stats field
+
+	Returns:
+		mask: Boolean mask of the cells [n_x, n_y]
+	'''
+
+	mask = np.array(store.done)
+	if store.solved is not None:
+		mask &= store.solved
+
+	return mask & (np.array(store.stats['wall']) > 0)
+
+def outliers(store, field='wall', top=10):
+	'''
+	Cells with the largest values of a telemetry field
+
+	Args:
+		store: RasterStore with a stats field
+		field: Field of STATS_DTYPE to rank by
+		top: Number of cells
+
+	Returns:
+		cells: List of (i, j) raster indices, largest first
+	'''
+
+	mask = solved_cells(store)
+	values = np.where(mask, store.stats[field], -np.inf)
+	order = np.argsort(values, axis=None)[::-1][:min(top, int(np.sum(mask)))]
+
+	return [tuple(int(k) for k in np.unravel_index(n, values.shape)) for n in order]
+
+def unsettled(stats):
+	#Cells that were integrated to the end of their time range without settling, stores from
+	#before reached_t_max was recorded only have the steady flag
+	if 'reached_t_max' in stats.dtype.names:
+		return stats['reached_t_max']
+	return ~stats['steady'] & (stats['n_steps'] > 0)
+
+def describe(store, i, j):
+	stats = store.stats[i, j]
+	flags = [name for name in ('reached_t_max', 'cycling', 'cached') if name in stats.dtype.names and stats[name]]
+	return '%s=%-8.4g %s=%-8.4g wall %8.3fs  rhs %8d  steps %7d  root %5d %s  residual %9.2e  max eig %9.2e%s' % (
+		store.var_1, store.x_vals[i], store.var_2, store.y_vals[j], stats['wall'], stats['n_rhs'],
+		stats['n_steps'], stats['root_iter'], 'ok  ' if stats['root_success'] else 'FAIL', stats['residual'],
+		stats['max_eig'], ''.join('  (%s)' % flag for flag in flags))
+
+def report(store, top=10):
+	'''
+	Print a summary of the telemetry of a raster: totals, how concentrated the run time is, the
+	slowest cells and the cells where the root finder failed
+
+	Args:
+		store: RasterStore with a stats field
+		top: Number of cells listed
+	'''
+
+	mask = solved_cells(store)
+	stats = np.array(store.stats)[mask]
+	if len(stats) == 0:
+		print('No cells with telemetry in %s' % store.path)
+		return
+
+	wall = np.sort(stats['wall'])[::-1]
+	n_top = max(1, len(wall) // 20)
+
+	print('%d cells with telemetry, %d cached' % (len(stats), np.sum(stats['cached'])))
+	print('Total wall time %.1fs, median %.3fs per cell, slowest 5%% of cells take %.0f%% of the time' %
+		(np.sum(wall), np.median(wall), 100*np.sum(wall[:n_top]) / max(np.sum(wall), 1e-300)))
+	print('Right hand side evaluations: median %d, max %d' % (np.median(stats['n_rhs']), np.max(stats['n_rhs'])))
+	print('Root finder failures: %d, cells integrated to the end of their time range: %d' %
+		(np.sum(~stats['root_success']), np.sum(unsettled(stats))))
+	if 'cycling' in stats.dtype.names:
+		print('Cells cycling around an oscillatory equilibrium: %d' % np.sum(stats['cycling']))
+
+	print('\nSlowest cells:')
+	for i, j in outliers(store, 'wall', top):
+		print('  ' + describe(store, i, j))
+
+	failed = np.argwhere(mask & ~np.array(store.stats['root_success']))
+	if len(failed) > 0:
+		print('\nRoot finder failures:')
+		for i, j in failed[:top]:
+			print('  ' + describe(store, i, j))
+
+def plot(store, output):
+	'''
+	Render the telemetry fields as rasters, with var_1 along the x axis and var_2 along the y axis
+
+	Args:
+		store: RasterStore with a stats field
+		output: Filename of the figure
+	'''
+
+	from matplotlib import pyplot as plt
+	from matplotlib import colors
+
+	mask = solved_cells(store)
+	extent = [store.x_vals[0], store.x_vals[-1], store.y_vals[0], store.y_vals[-1]]
+
+	fig, axes = plt.subplots(nrows=2, ncols=4, figsize=(14, 6))
+	fig.tight_layout()
+	plt.subplots_adjust(wspace=0.4, hspace=0.4)
+
+	panels = PANELS + [('root_success', False),
+		('reached_t_max' if 'reached_t_max' in store.stats.dtype.names else 'steady', False)]
+	for ax, (field, log) in zip(axes.flat, panels):
+		values = np.ma.masked_where(~mask, np.array(store.stats[field], dtype=float))
+		if log:
+			values = np.ma.masked_where(values <= 0, values)
+		norm = colors.LogNorm() if log and values.count() > 0 else None
+
+		image = ax.imshow(values.T, origin='lower', extent=extent, aspect='auto', norm=norm, cmap='viridis')
+		fig.colorbar(image, ax=ax)
+		ax.set_title(field)
+		ax.set_xlabel(store.var_1)
+		ax.set_ylabel(store.var_2)
+
+	fig.savefig(output, bbox_inches='tight', pad_inches=0.1)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Summarise the solver telemetry of a raster')
+	parser.add_argument('scenario', help='Name of the raster scenario in rasters.json, or a raster store directory')
+	parser.add_argument('--top', type=int, default=10, help='Number of slow or failed cells listed')
+	parser.add_argument('--output', default=None, help='Filename of the telemetry figure (default: none)')
+	args = parser.parse_args(argv)
+
+	if is_store(args.scenario):
+		path = store_path(args.scenario)
+	else:
+		with open('rasters.json', 'r') as f:
+			path = store_path(json.load(f)[args.scenario]['filename'])
+
+	store = RasterStore(path)
+	if store.stats is None:
+		raise ValueError('%s was computed before telemetry was recorded' % path)
+
+	report(store, args.top)
+	if args.output is not None:
+		plot(store, args.output)
+
+if __name__ == '__main__':
+	main()
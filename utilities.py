@@ -1,14 +1,21 @@
 import numpy as np
-import pickle as pkl
 
-def get_trans(model, S, I):
+from model import Model
+from store import RasterStore, store_path, is_store, from_pickle
+from sweep import set_param
+
+#Parameters that leave the transmission and mating matrices unchanged
+FECUNDITY_PARAMS = ('b', 'mu', 'k', 'c_g', 'c_s', 'allele_costs')
+
+def get_trans(model, S, I, B=None):
 	'''
 	Calculate the transitivity slope for a particular set of equilibrium 
-	conditions
+	conditions, or for a stack of them at once
 
 	Args:
-		S: Vector of length 4 of equilibrium host abundances
-		I: Vector of length 3 of equilibrium pathogen abundances
+		S: Vector of length 4 of equilibrium host abundances, or a stack of them [n, genotype]
+		I: Vector of length 3 of equilibrium pathogen abundances, or a stack of them [n, genotype]
+		B: Transmission matrix for each state in the stack [n, S, I], model.B if None
 		**kwargs: Set of parameters defining a simulation
 
 	Returns:
@@ -17,120 +24,227 @@ def get_trans(model, S, I):
 		half_sib_freq: expected frequency of each half-sib family
 	'''
 
+	S = np.asarray(S, dtype=float)
+	I = np.asarray(I, dtype=float)
+	batched = S.ndim == 2
+
+	S = np.atleast_2d(S)
+	I = np.atleast_2d(I)
+	n = S.shape[0]
+
+	if B is None:
+		B = model.B
+
 	#Get the proability of each mating pair
-	freq_matrix = np.outer(S, S)
-	freq_matrix = freq_matrix / (np.sum(S))**2
+	freq_matrix = (S[:, :, None] * S[:, None, :]).reshape(n, -1)
+	freq_matrix = freq_matrix / (np.sum(S, axis=1)[:, None])**2
 
 	#Calculate the susceptibility of each genotype to the endemic pathogen 
 	#by weighting their suseptibility to vir and avr by the relative abundances
-	I_freq = I / np.sum(I)
-	sus = np.dot(model.B, I_freq)
+	I_freq = I / np.sum(I, axis=1)[:, None]
+	sus = np.einsum('nij,nj->ni', np.broadcast_to(B, (n,) + B.shape[-2:]), I_freq)
+
+	full_sib = np.zeros((n, model.S_genotypes**2, 3))
+	half_sib = np.zeros((n, model.S_genotypes, 3))
 
-	full_sib = np.zeros((model.S_genotypes**2, 3))
-	half_sib = np.zeros((model.S_genotypes, 3))
+	full_sib[:, :, 0] = (model.M @ sus.T).T					#Full sibling susceptibility to endemic pathogen
+	full_sib[:, :, 1] = (model.M @ B[..., -1].T).T		#Full sib susceptiblity to foreign pathogen
+	full_sib[:, :, 2] = freq_matrix								#Full sib family frequency
 
-	full_sib[:, 0] = np.dot(model.M, sus)				#Full sibling susceptibility to endemic pathogen
-	full_sib[:, 1] = np.dot(model.M, model.B[:, 2])		#Full sib susceptiblity to foreign pathogen
-	full_sib[:, 2] = freq_matrix.flatten()				#Full sib family frequency
+	families = full_sib.reshape(n, model.S_genotypes, model.S_genotypes, 3)
+	half_sib[:, :, 0] = np.average(families[:, :, :, 0], axis=2)
+	half_sib[:, :, 1] = np.average(families[:, :, :, 1], axis=2)
+	half_sib[:, :, 2] = np.sum(families[:, :, :, 2], axis=2)
 
-	half_sib[:, 0] = np.average(full_sib[:, 0].reshape(-1, model.S_genotypes), axis=1)
-	half_sib[:, 1] = np.average(full_sib[:, 1].reshape(-1, model.S_genotypes), axis=1)
-	half_sib[:, 2] = np.sum(full_sib[:, 2].reshape(-1, model.S_genotypes), axis=1)
+	if not batched:
+		return (full_sib[0], half_sib[0])
 
 	return (full_sib, half_sib)
 
-def load_data(path, var_1, var_2):
-	#Load simulation raster data
-	with open(path, 'rb') as f:
-		models, data = pkl.load(f)
-	
-	#Get all parameter values for focal parameters
-	x_vals = np.sort(list(set([getattr(model, var_1) for model in models])))
-	y_vals = np.sort(list(set([getattr(model, var_2) for model in models])))
+def wls_slope(x, y, w):
+	'''
+	Slope of a weighted least squares line along the last axis, in closed form. Weights are
+	applied to the residuals as in np.polyfit, so the result matches np.polyfit(x, y, 1, w=w)
 
-	#Number of unique focal parameter values
-	n_x = len(x_vals)
-	n_y = len(y_vals)   
+	Args:
+		x: Independent variable [..., n]
+		y: Dependent variable [..., n]
+		w: Weights [..., n]
 
-	allele_freq_raster = np.zeros((models[0].n_loci, n_x, n_y))
-	V_raster, T_raster, D_raster = [np.zeros((n_x, n_y)) for _ in range(3)]
+	Returns:
+		slope: Slope of the fitted line [...]
+	'''
 
-	for i in range(len(data)):
-		x_param = getattr(models[i], var_1)
-		y_param = getattr(models[i], var_2)
-		x_ind = np.where(x_vals == x_param)
-		y_ind = np.where(y_vals == y_param) 
+	W = w**2
+	W_tot = np.sum(W, axis=-1)
+	x_mean = np.sum(W*x, axis=-1) / W_tot
+	y_mean = np.sum(W*y, axis=-1) / W_tot
 
-		sus, inf, _ = data[i]
+	dx = x - x_mean[..., None]
+	dy = y - y_mean[..., None]
 
-		#Find the t indexes equal to the range over which to average solution
-		N = np.sum(sus)
-		sus_freq = sus/N
-		avir_freq = inf[0] / np.sum(inf)
+	return np.sum(W*dx*dy, axis=-1) / np.sum(W*dx**2, axis=-1)
 
-		#Compute the average allele frequency for each locus
-		for j in range(models[i].n_loci):
-			allele_freq_raster[j, x_ind, y_ind] = np.sum(sus_freq[models[i].G[:, j] == 1])
+def trans_slopes(model, S, I, B=None, chunk=4096):
+	'''
+	Calculate the transitivity slope for a stack of states, processing them in chunks so that
+	the full-sib tables of long trajectories or large rasters are never all held in memory
 
-		G_freq = np.sum(sus[models[i].G[:,1] == 1]) / N
-		S_freq = np.sum(sus[models[i].G[:,2] == 1]) / N
-		GS_freq = np.sum(sus[np.logical_and(models[i].G[:,1], models[i].G[:,2] == 1)]) / N
+	Args:
+		model: Model class instance
+		S: Host abundances [n, genotype]
+		I: Pathogen abundances [n, genotype]
+		B: Transmission matrix for each state [n, S, I], model.B if None
+		chunk: Number of states processed at once
 
-		D = GS_freq - G_freq*S_freq
+	Returns:
+		slopes: Transitivity slope of each state [n]
+	'''
 
-		D_max = np.max((-1*G_freq*S_freq, -1*(1-G_freq)*(1-S_freq)))
-		D_min = np.min((G_freq*(1-S_freq), (1-G_freq)*S_freq))
-		min_freq = np.min((G_freq, S_freq, 1-G_freq, 1-S_freq))
-
-		if D < 0 and min_freq > 0.01:
-			D_prime = D / D_max
-		elif D > 0 and min_freq > 0.01:
-			D_prime = D / D_min
-		else:
-			D_prime = 0
-
-		#Take the average solution value over range to account for oscillations
-		full_sib, _ = get_trans(models[i], sus, inf)
-
-		#Check if there is sufficient G polymorphism, and if so, append the transitivity slope
-		if 1e-2 < allele_freq_raster[1, x_ind, y_ind] < 1 - 1e-2:
-			T_raster[x_ind, y_ind] = np.polyfit(full_sib[:, 0], full_sib[:, 1], 1, w=full_sib[:, 2])[0]
-		#Set the transitivity slope to 0 if there isn't sufficient polymorpism
-		else:
-			T_raster[x_ind, y_ind] = 0
-	
-		V_raster[x_ind, y_ind] = avir_freq
-		D_raster[x_ind, y_ind] = D_prime
+	slopes = np.zeros(len(S))
+	for start in range(0, len(S), chunk):
+		end = start + chunk
+		B_chunk = None if B is None else B[start:end]
+		full_sib, _ = get_trans(model, S[start:end], I[start:end], B_chunk)
+		slopes[start:end] = wls_slope(full_sib[..., 0], full_sib[..., 1], full_sib[..., 2])
 
-	return allele_freq_raster, V_raster, T_raster, D_raster
+	return slopes
+
+def open_raster(path, var_1, var_2):
+	'''
+	Open the raster store of a raster produced by gen_raster, converting pickles written by
+	earlier versions to a store on first use
+
+	Args:
+		path: Raster filename as given in rasters.json
+		var_1: Parameter for the first axis
+		var_2: Parameter for the second axis
+
+	Returns:
+		store: RasterStore of the raster
+		x_vals: Values of var_1
+		y_vals: Values of var_2
+		arrays: Dictionary of S, I, eigs and done arrays oriented as [var_1, var_2, ...]
+	'''
+
+	if is_store(path):
+		store = RasterStore(store_path(path))
+	else:
+		store = from_pickle(path, var_1, var_2)
 
-def check_stab(path, var_1, var_2):
-	#Load simulation raster data
-	with open(path, 'rb') as f:
-		models, data = pkl.load(f)
-	
-	#Get all parameter values for focal parameters
-	x_vals = np.sort(list(set([getattr(model, var_1) for model in models])))
-	y_vals = np.sort(list(set([getattr(model, var_2) for model in models])))
+	return (store,) + store.oriented(var_1, var_2)
+
+def raster_slopes(params, var_1, x_vals, var_2, y_vals, S, I, cells, chunk=4096):
+	'''
+	Calculate the transitivity slopes of a set of raster cells. Models are only built for the
+	distinct transmission and mating matrices in the raster, so a raster over fecundity costs
+	needs a single model, and cells sharing a mating matrix are processed in batches.
+
+	Args:
+		params: Base parameters of the raster
+		var_1: Parameter varied along the first axis
+		x_vals: Values of the first parameter
+		var_2: Parameter varied along the second axis
+		y_vals: Values of the second parameter
+		S: Host abundances of the cells [n, genotype]
+		I: Pathogen abundances of the cells [n, genotype]
+		cells: Raster indices of the cells [n, 2]
+		chunk: Number of cells processed at once
+
+	Returns:
+		slopes: Transitivity slope of each cell [n]
+	'''
+
+	slopes = np.zeros(len(cells))
+	if len(cells) == 0:
+		return slopes
+
+	#Collapse the axes of parameters that leave B and M unchanged
+	varies = np.array([var_1 not in FECUNDITY_PARAMS, var_2 not in FECUNDITY_PARAMS])
+	keys, inverse = np.unique(cells * varies, axis=0, return_inverse=True)
+	inverse = inverse.reshape(-1)
+
+	#Parameters are set as in gen_raster, so component axes such as 'rho[0]' are supported
+	models = [Model(**set_param(set_param(params, var_1, x_vals[i]), var_2, y_vals[j])) for i, j in keys]
+	B_table = np.stack([model.B for model in models])
+
+	#Group the cells by mating matrix, which models with the same recombination rates share
+	M_ids = np.array([id(model.M) for model in models])
+	for M_id in np.unique(M_ids):
+		key = np.flatnonzero(M_ids == M_id)[0]
+		inds = np.flatnonzero(M_ids[inverse] == M_id)
+
+		for start in range(0, len(inds), chunk):
+			sub = inds[start:start + chunk]
+			full_sib, _ = get_trans(models[key], S[sub], I[sub], B_table[inverse[sub]])
+			slopes[sub] = wls_slope(full_sib[..., 0], full_sib[..., 1], full_sib[..., 2])
+
+	return slopes
+
+def load_data(path, var_1, var_2):
+	#Load simulation raster data, arrays are memory mapped and indexed as [var_1, var_2, ...]
+	store, x_vals, y_vals, arrays = open_raster(path, var_1, var_2)
+	done = arrays['done']
+
+	#Unfinished cells are left at zero
+	sus = np.where(done[:, :, None], arrays['S'], 0)
+	inf = np.where(done[:, :, None], arrays['I'], 0)
+
+	#Cells that settle on a stable limit cycle (see periodic.py) are described by their averages
+	#over the cycle rather than by the unstable equilibrium
+	if 'orbit' in arrays:
+		orbit = arrays['orbit']
+		cycling = done & (orbit['period'] > 0) & orbit['converged'] & orbit['stable']
+		sus = np.where(cycling[:, :, None], orbit['S'], sus)
+		inf = np.where(cycling[:, :, None], orbit['I'], inf)
+
+	G = Model(**store.params).G
 
 	#Number of unique focal parameter values
 	n_x = len(x_vals)
 	n_y = len(y_vals)   
 
-	stab = np.zeros((n_x, n_y))
+	with np.errstate(divide='ignore', invalid='ignore'):
+		N = np.sum(sus, axis=2)
+		sus_freq = sus / N[:, :, None]
+		avir_freq = inf[:, :, 0] / np.sum(inf, axis=2)
+
+		#Compute the average allele frequency for each locus
+		allele_freq_raster = np.moveaxis(sus_freq @ G, 2, 0)
+
+		G_freq = allele_freq_raster[1]
+		S_freq = allele_freq_raster[2]
+		GS_freq = sus_freq @ np.logical_and(G[:,1], G[:,2] == 1)
 
-	for i in range(len(data)):
-		x_param = getattr(models[i], var_1)
-		y_param = getattr(models[i], var_2)
-		x_ind = np.where(x_vals == x_param)
-		y_ind = np.where(y_vals == y_param) 
+		D = GS_freq - G_freq*S_freq
+
+		D_max = np.maximum(-1*G_freq*S_freq, -1*(1-G_freq)*(1-S_freq))
+		D_min = np.minimum(G_freq*(1-S_freq), (1-G_freq)*S_freq)
+		min_freq = np.min((G_freq, S_freq, 1-G_freq, 1-S_freq), axis=0)
+
+		D_raster = np.where((D < 0) & (min_freq > 0.01), D / D_max, 0)
+		D_raster = np.where((D > 0) & (min_freq > 0.01), D / D_min, D_raster)
+
+	allele_freq_raster = np.where(done, allele_freq_raster, 0)
+	V_raster = np.where(done, avir_freq, 0)
+	D_raster = np.where(done, D_raster, 0)
+	T_raster = np.zeros((n_x, n_y))
+
+	#Check if there is sufficient G polymorphism, and if so, compute the transitivity slope,
+	#the slope is set to 0 if there isn't sufficient polymorpism
+	polymorphic = done & (1e-2 < allele_freq_raster[1]) & (allele_freq_raster[1] < 1 - 1e-2)
+	T_raster[polymorphic] = raster_slopes(store.params, var_1, x_vals, var_2, y_vals, 
+		sus[polymorphic], inf[polymorphic], np.argwhere(polymorphic))
+
+	return allele_freq_raster, V_raster, T_raster, D_raster
 
-		_, _, eigs = data[i]
+def check_stab(path, var_1, var_2, eig_tol=1e-8):
+	#Load simulation raster data, arrays are memory mapped and indexed as [var_1, var_2, ...]
+	_, _, _, arrays = open_raster(path, var_1, var_2)
 
-		#Check if all eigenvalues are negative (except last which corresponds to foreign pathogen)
-		if np.prod(np.real(eigs[:-1]) < 0):
-			stab[x_ind, y_ind] = 1
-		else:
-			stab[x_ind, y_ind] = 0
+	#Check if all eigenvalues are negative (except last which corresponds to foreign pathogen),
+	#neutral directions (e.g. a fixed linkage modifier) have eigenvalues of zero up to rounding
+	#and are counted as stable
+	stab = np.all(np.real(arrays['eigs'][:, :, :-1]) < eig_tol, axis=2) & arrays['done']
 
-	return stab
+	return stab.astype(float)